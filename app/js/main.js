@@ -52,7 +52,28 @@ import './backbone.js';  // requires Zepto for Ajax
 	main.PlayRound = Backbone.Collection.extend({
 		url: main.makeAPI('/playround/1'),
 		model: main.Play,
-		parse: (data) => { return data.plays; }
+		parse: (data) => { return data.plays; },
+
+		unsaved: function () {
+			return this.filter((model) => model.unsaved);
+		},
+
+		// results from the server, but not over the ones not saved yet.
+		// Returns true if there are new plays of this round.
+		mergePlays: function (plays) {
+			let added = false;
+			plays.forEach((play) => {
+				const model = this.get(play.id_playround);
+				if (!model) {
+					added = added || this.url === main.makeAPI('/playround/' + play.round_number);
+				} else if (!model.unsaved) {
+					// only the rows of changed plays are rendered again
+					model.set(_.pick(play, 'points_a', 'points_b', 'start_time'));
+					model.trigger('remote-change', model);
+				}
+			});
+			return added;
+		},
 	});
 
 	/* Views */
@@ -66,12 +87,15 @@ import './backbone.js';  // requires Zepto for Ajax
 			//this.listenTo(this.model, 'sync change', this.render);
 			//this.listenTo(this.model, 'change', this.render);
 			//this.listenTo(this.model, 'destroy', this.remove);
+			// results entered elsewhere, see main.listenEvents
+			this.listenTo(this.model, 'remote-change', this.render);
 		},
 
 		render: function() {
 			const data = this.model.toJSON();
 			const html = this.template(data);
 			this.$el.html(html);
+			this.$el.toggleClass('unsaved', !!this.model.unsaved);
 			return this;
 		},
 
@@ -82,17 +106,14 @@ import './backbone.js';  // requires Zepto for Ajax
 		onChange: function(ev) {
 			const field = ev.target.name;
 
-			window.model = this.model;
-			const old_value = this.model.get(field);
 			const el = this.$(ev.target)
 			const new_value = Number.parseInt(el.val());
 
-			const links = this.model.get('_links');
-			const url = links.self.href;
-			this.model.url = url;
-
-			this.model.set(field, new_value);
-			this.model.save();
+			// saved with the other changes, see PlayRoundListView.onSave
+			this.model.set(field, Number.isNaN(new_value) ? null : new_value);
+			this.model.unsaved = true;
+			this.$el.addClass('unsaved');
+			this.model.trigger('unsaved', this.model);
 		},
 	});
 
@@ -102,6 +123,7 @@ import './backbone.js';  // requires Zepto for Ajax
 
 		initialize: function() {
 			this.listenTo(this.collection, 'sync', this.render);
+			this.listenTo(this.collection, 'unsaved', this.renderUnsaved);
 		},
 
 		render: function() {
@@ -112,16 +134,47 @@ import './backbone.js';  // requires Zepto for Ajax
 				$list.append(item.render().$el);
 			}, this);
 
+			this.renderUnsaved();
 			return this;
 		},
 
+		renderUnsaved: function() {
+			const count = this.collection.unsaved().length;
+			this.$('.unsaved-info').text(count ? 'Nicht gespeichert: ' + count : '');
+		},
+
 		events: {
 			'click .save-button': 'onSave',
 			'change .playround-input': 'onPlayRoundChange',
 		},
 
 		onSave: function(ev) {
-			this.collection.sync();
+			// only the results changed here, in one request and transaction,
+			// not over the ones entered on other devices meanwhile
+			const changed = this.collection.unsaved();
+			if (!changed.length) {
+				return;
+			}
+			const result = (model) => {
+				return _.pick(model.toJSON(), 'id_playround', 'points_a', 'points_b');
+			};
+			const plays = changed.map(result);
+			Backbone.ajax({
+				type: 'PUT',
+				url: this.collection.url,
+				contentType: 'application/json',
+				data: JSON.stringify({plays: plays}),
+				success: (data) => {
+					changed.forEach((model, num) => {
+						// changed again while saving
+						if (_.isEqual(result(model), plays[num])) {
+							model.unsaved = false;
+						}
+					});
+					this.collection.mergePlays(this.collection.parse(data));
+					this.render();
+				},
+			});
 		},
 
 		onPlayRoundChange: function (ev) {
@@ -132,6 +185,37 @@ import './backbone.js';  // requires Zepto for Ajax
 		},
 	});
 
+	/* Live updates */
+
+	main.listenEvents = function (playRounds) {
+		if (!_window.EventSource) {
+			return null;
+		}
+		const events = new EventSource(main.makeAPI('/events'));
+		let connected = false;
+		const merge = (plays) => {
+			if (playRounds.mergePlays(plays)) {
+				// a new round, the plays come with their teams
+				playRounds.fetch();
+			}
+		};
+		events.addEventListener('open', () => {
+			// changes may have been missed while disconnected
+			if (connected) {
+				Backbone.ajax({
+					url: playRounds.url,
+					dataType: 'json',
+					success: (data) => merge(playRounds.parse(data)),
+				});
+			}
+			connected = true;
+		});
+		events.addEventListener('change', (ev) => {
+			merge(JSON.parse(ev.data).plays);
+		});
+		return events;
+	};
+
 	/* Main part with on ready handler */
 
 	HTMLDocument.prototype.ready = function () {
@@ -149,6 +233,7 @@ import './backbone.js';  // requires Zepto for Ajax
 		var playRounds = new main.PlayRound();
 		var playRoundView = new main.PlayRoundListView({collection: playRounds});
 		playRounds.fetch();
+		main.listenEvents(playRounds);
 	});
 
 	return main;
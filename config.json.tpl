@@ -4,11 +4,19 @@
 	"user": "stuser",
 	"password": "SECRET",
 	"port": 5432,
+	"pool_size": 5,
+	"pool_pre_ping": true,
+	"pool_recycle": 3600,
+	"busy_timeout": 5000,
     "play_settings": {
         "start_time": "2020-02-15T17:45:00+01:00",
         "play_time": 480,
         "rotation_time": 60,
         "pause_time": 600,
-        "courts": 4
+        "courts": 4,
+        "pairing": "greedy",
+        "ranking_backend": "python",
+        "by_category": false,
+        "workers": 1
     }
 }
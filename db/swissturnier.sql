@@ -95,6 +95,8 @@ ALTER TABLE ONLY playround
     ADD CONSTRAINT playround_id_team_a_fkey FOREIGN KEY (id_team_a) REFERENCES team(id_team);
 ALTER TABLE ONLY playround
     ADD CONSTRAINT playround_id_team_b_fkey FOREIGN KEY (id_team_b) REFERENCES team(id_team);
+CREATE INDEX ix_playround_round_number ON playround (round_number);
+CREATE INDEX playround_id_teams_idx ON playround (id_team_a, id_team_b);
 ALTER TABLE public.playround_id_playround_seq OWNER TO stuser;
 ALTER SEQUENCE playround_id_playround_seq OWNED BY playround.id_playround;
 
@@ -114,7 +116,10 @@ CREATE TABLE rankings (
     id_team integer NOT NULL,
     rank integer,
     wins float,
-    points integer
+    points integer,
+    buchholz float DEFAULT 0,
+    median_buchholz float DEFAULT 0,
+    sonneborn_berger float DEFAULT 0
 );
 
 ALTER TABLE public.rankings OWNER TO stuser;
@@ -125,9 +130,58 @@ ALTER TABLE ONLY rankings
     ADD CONSTRAINT id_team_key UNIQUE (id_team);
 ALTER TABLE ONLY rankings
     ADD CONSTRAINT rankings_id_team_fkey FOREIGN KEY (id_team) REFERENCES team(id_team);
+CREATE INDEX ix_rankings_rank ON rankings (rank);
 ALTER TABLE public.rankings_id_rankings_seq OWNER TO stuser;
 ALTER SEQUENCE rankings_id_rankings_seq OWNED BY rankings.id_rank;
 
+--
+-- Table rankings_history
+--
+
+CREATE TABLE rankings_history (
+    round_number integer NOT NULL,
+    id_team integer NOT NULL,
+    rank integer,
+    wins float,
+    points integer,
+    buchholz float DEFAULT 0,
+    median_buchholz float DEFAULT 0,
+    sonneborn_berger float DEFAULT 0
+);
+
+ALTER TABLE public.rankings_history OWNER TO stuser;
+ALTER TABLE ONLY rankings_history
+    ADD CONSTRAINT rankings_history_pkey PRIMARY KEY (round_number, id_team);
+ALTER TABLE ONLY rankings_history
+    ADD CONSTRAINT rankings_history_id_team_fkey FOREIGN KEY (id_team) REFERENCES team(id_team);
+
+--
+-- Table schema_version
+--
+
+CREATE TABLE schema_version (
+    version integer NOT NULL
+);
+
+ALTER TABLE public.schema_version OWNER TO stuser;
+ALTER TABLE ONLY schema_version
+    ADD CONSTRAINT schema_version_pkey PRIMARY KEY (version);
+INSERT INTO schema_version (version) VALUES (1), (2), (3), (4);
+
+--
+-- Table change_counter
+--
+
+CREATE TABLE change_counter (
+    id integer NOT NULL,
+    counter integer NOT NULL
+);
+
+ALTER TABLE public.change_counter OWNER TO stuser;
+ALTER TABLE ONLY change_counter
+    ADD CONSTRAINT change_counter_pkey PRIMARY KEY (id);
+INSERT INTO change_counter (id, counter) VALUES (1, 0);
+
 --
 -- PostgreSQL database create
 --
@@ -1,2 +1,2 @@
 # -*- coding: utf-8 -*-
-__all__ = [ 'api', 'db', 'ranking', 'report' ]
+__all__ = [ 'aioapi', 'api', 'db', 'matching', 'pairing', 'ranking', 'report', 'schedule', 'standings', 'state' ]
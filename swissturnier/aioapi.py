@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+""" The RESTful SwissTurnier webservice API on an asyncio server """
+
+# Copyright © 2020 Andreas Stricker <andy@knitter.ch>
+#
+# This file is part of SwissTurnier.
+#
+# SwissTurnier is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Same routes and HAL documents as swissturnier.api, the handlers there
+# do the work. Reads come from the turnier state, writes are blocking
+# SQLAlchemy, so both run in a thread pool while the event loop keeps
+# serving: a slow report doesn't hold up the score entries. Writes still
+# go through DB.write().
+
+import sys
+import os
+sys.path.append(os.getcwd())
+import argparse
+import asyncio
+import concurrent.futures
+import datetime
+import functools
+import logging
+import swissturnier.db
+import swissturnier.report
+import swissturnier.state
+from swissturnier import api
+from swissturnier.api import PREFIX
+
+try:
+    import aiohttp.web
+except ImportError:
+    aiohttp = None
+
+# Threads for the DB work of the requests
+WORKERS = 16
+
+logger = logging.getLogger(__name__)
+
+
+def conditional(handler):
+    """
+    ETag and Last-Modified of the turnier state version on the response
+    of the handler, 304 Not Modified if the client has this version
+    already. Same as swissturnier.api.conditional().
+    """
+    @functools.wraps(handler)
+    async def wrapper(self, request):
+        etag, date = await self._run(self.state.validators)
+        date = date.replace(tzinfo=datetime.timezone.utc)
+        headers = {'Cache-Control': 'no-cache'}
+        if request.if_none_match is not None:
+            # the ETag decides, dates are only precise to the second
+            unchanged = any(tag.value in (etag, '*')
+                            for tag in request.if_none_match)
+        else:
+            since = request.if_modified_since
+            unchanged = since is not None and date.replace(microsecond=0) <= since
+        if unchanged:
+            response = aiohttp.web.HTTPNotModified(headers=headers)
+        else:
+            response = await handler(self, request)
+            response.headers.update(headers)
+        response.etag = etag
+        response.last_modified = date
+        if unchanged:
+            raise response
+        return response
+    return wrapper
+
+
+class Handlers(object):
+    """ aiohttp request handlers on top of the web.py resources """
+
+    def __init__(self, db, state, workers=WORKERS):
+        self._db = db
+        self._state = state
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    @property
+    def db(self):
+        return self._db
+
+    @property
+    def state(self):
+        return self._state
+
+    def close(self):
+        self._executor.shutdown()
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def watch(self, app):
+        """
+        Check for changes by other processes, e.g. a new round of
+        bin/turnier, while the app runs. Event streams don't read the
+        state, without requests nothing else would notice them.
+        """
+        task = None
+        if self.state.check_interval is not None:
+            task = asyncio.create_task(self._check_changes())
+        yield
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def _check_changes(self):
+        interval = self.state.check_interval or swissturnier.state.CHECK_INTERVAL
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                # a reload publishes the changes to the event streams
+                await self._run(self.state.check)
+            except Exception:
+                logger.exception("Checking the DB for changes failed")
+
+    def _json(self, obj):
+        return aiohttp.web.Response(
+            text=api.api_json_encoder.encode(obj),
+            content_type='application/json')
+
+    def _html(self, text):
+        return aiohttp.web.Response(text=text, content_type='text/html')
+
+    def _found(self, obj, message):
+        if obj is None:
+            raise aiohttp.web.HTTPNotFound(text=message)
+        return self._json(obj)
+
+    @conditional
+    async def index(self, request):
+        return self._html(await self._run(api.Index().load, self.state))
+
+    @conditional
+    async def ranking(self, request):
+        return self._html(await self._run(
+            api.APIv1Ranking().load, self.db, self.state, True))
+
+    @conditional
+    async def playtable(self, request):
+        return self._html(await self._run(
+            api.APIv1PlayTable().load, self.db, self.state, True))
+
+    @conditional
+    async def categories(self, request):
+        return self._json(await self._run(api.APIv1Categories().load, self.state))
+
+    @conditional
+    async def category(self, request):
+        obj = await self._run(api.APIv1Category().load, self.state, request.match_info['id'])
+        return self._found(obj, 'Category does not exist')
+
+    @conditional
+    async def teams(self, request):
+        category = request.query.get('category')
+        try:
+            obj = await self._run(api.Teams().load, self.state, category, dict(request.query))
+        except ValueError as e:
+            raise aiohttp.web.HTTPBadRequest(text=str(e))
+        return self._json(obj)
+
+    @conditional
+    async def team(self, request):
+        obj = await self._run(api.Team().load, self.state, request.match_info['id'])
+        return self._found(obj, 'Team does not exist')
+
+    @conditional
+    async def current_round(self, request):
+        return self._json(await self._run(api.CurrentPlayRound().load, self.state))
+
+    @conditional
+    async def playround(self, request):
+        try:
+            obj = await self._run(api.PlayRounds().load, self.state,
+                                  request.match_info['id'], dict(request.query))
+        except ValueError as e:
+            raise aiohttp.web.HTTPBadRequest(text=str(e))
+        return self._json(obj)
+
+    async def update_playround(self, request):
+        resource = api.PlayRounds()
+        try:
+            results = resource.parse_results(
+                await request.read(), request.headers.get('Content-Type'))
+            obj = await self._run(
+                resource.update, self.db, self.state, request.match_info['id'], results)
+        except ValueError as e:
+            raise aiohttp.web.HTTPBadRequest(text=str(e))
+        return self._json(obj)
+
+    @conditional
+    async def play(self, request):
+        obj = await self._run(api.Play().load, self.state, request.match_info['id'])
+        return self._found(obj, 'Play does not exist')
+
+    async def update_play(self, request):
+        resource = api.Play()
+        try:
+            points_a, points_b = resource.parse_result(
+                request.match_info['id'], await request.read())
+            obj = await self._run(resource.update, self.db, self.state,
+                                  request.match_info['id'], points_a, points_b)
+        except ValueError as e:
+            raise aiohttp.web.HTTPBadRequest(text=str(e))
+        return self._found(obj, 'Play does not exist')
+
+    async def events(self, request):
+        """
+        Server-sent events of the changes of the turnier state, until the
+        client disconnects. Unlike the web.py server it takes no thread
+        per client.
+        """
+        loop = asyncio.get_running_loop()
+        changes = asyncio.Queue()
+        def publish(change):
+            loop.call_soon_threadsafe(changes.put_nowait, change)
+        await self._run(self.state.subscribe, publish)
+        try:
+            response = aiohttp.web.StreamResponse(headers={
+                'Content-Type': 'text/event-stream',
+                'Cache-Control': 'no-cache',
+            })
+            await response.prepare(request)
+            # clients reconnect after 3 seconds and fetch the data again
+            await response.write(b'retry: 3000\n\n')
+            while True:
+                try:
+                    change = await asyncio.wait_for(changes.get(), api.KEEPALIVE)
+                except asyncio.TimeoutError:
+                    await response.write(b': keepalive\n\n')
+                    continue
+                await response.write(api.format_event(change).encode('UTF-8'))
+        except ConnectionResetError:
+            return response  # the client is gone
+        finally:
+            self.state.unsubscribe(publish)
+
+    async def reload(self, request):
+        return self._json(await self._run(api.Reload().load, self.state))
+
+
+def _redirect(location):
+    async def redirect(request):
+        raise aiohttp.web.HTTPSeeOther(location)
+    return redirect
+
+def get_application(db=None, workers=WORKERS, state=None):
+    """
+    The aiohttp application with one DB instance and one turnier state
+    shared by all requests
+    """
+    if aiohttp is None:
+        raise RuntimeError("The asyncio API server requires the aiohttp library")
+    if db is None:
+        db = swissturnier.db.DB()
+    if state is None:
+        state = swissturnier.state.TurnierState(db)
+    swissturnier.report.templates.compile()
+    handlers = Handlers(db, state, workers)
+    app = aiohttp.web.Application()
+    app.router.add_get('/', handlers.index)
+    app.router.add_get(PREFIX + '/ranking', handlers.ranking)
+    app.router.add_get(PREFIX + '/ranking/', _redirect('/ranking'))
+    app.router.add_get(PREFIX + '/playtable', handlers.playtable)
+    app.router.add_get(PREFIX + '/playtable/', _redirect('/playtable'))
+    app.router.add_get(PREFIX + '/categories', handlers.categories)
+    app.router.add_get(PREFIX + '/category/{id:\\d+}', handlers.category)
+    app.router.add_get(PREFIX + '/teams', handlers.teams)
+    app.router.add_get(PREFIX + '/teams/', _redirect('/teams'))
+    app.router.add_get(PREFIX + '/team/{id:\\d+}', handlers.team)
+    app.router.add_get(PREFIX + '/currentround', handlers.current_round)
+    app.router.add_get(PREFIX + '/playround/{id:\\d+}', handlers.playround)
+    app.router.add_put(PREFIX + '/playround/{id:\\d+}', handlers.update_playround)
+    app.router.add_get(PREFIX + '/play/{id:\\d+}', handlers.play)
+    app.router.add_put(PREFIX + '/play/{id:\\d+}', handlers.update_play)
+    app.router.add_post(PREFIX + '/reload', handlers.reload)
+    app.router.add_get(PREFIX + '/events', handlers.events)
+
+    app.cleanup_ctx.append(handlers.watch)
+    async def close(app):
+        handlers.close()
+    app.on_cleanup.append(close)
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='aioapi',
+        description="Swissturnier API on an asyncio server"
+    )
+    parser.add_argument('--host', default='0.0.0.0',
+                        help="Address to listen on")
+    parser.add_argument('--port', default=8080, type=int,
+                        help="Port to listen on")
+    parser.add_argument('--workers', default=WORKERS, type=int,
+                        help="Threads for the DB work")
+    args = parser.parse_args()
+    aiohttp.web.run_app(get_application(workers=args.workers),
+                        host=args.host, port=args.port)
+
+if __name__ == '__main__':
+    main()
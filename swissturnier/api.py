@@ -26,13 +26,13 @@ import web.webapi
 import json
 import decimal
 import datetime
+import urllib.parse
 import sqlalchemy
 import swissturnier.db
 import swissturnier.ranking
 import swissturnier.report
+import swissturnier.state
 
-from web.contrib.template import render_cheetah
-import Cheetah.Template
 
 # RESTful API with JSON including HAL (http://stateless.co/hal_spefication.html)
 
@@ -48,13 +48,27 @@ urls = (
     PREFIX + '/currentround', 'CurrentPlayRound',
     PREFIX + '/playround/(\d+)', 'PlayRounds',
     PREFIX + '/play/(\d+)', 'Play',
+    PREFIX + '/reload', 'Reload',
+    PREFIX + '/events', 'Events',
 )
 
+# Seconds until an idle event stream gets a comment to keep it open
+KEEPALIVE = 15
+
 def _create_api_path(resource, *parts):
     path = [PREFIX, resource]
     path.extend([str(p) for p in parts])
     return '/'.join(path)
 
+def _is_number(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def _check_points(id_playround, points_a, points_b):
+    """ Raises ValueError unless the points are None or not negative integers """
+    if not all(points is None or (_is_number(points) and points >= 0)
+               for points in (points_a, points_b)):
+        raise ValueError("Invalid result of play {!r}".format(id_playround))
+
 class JSONEncoder(json.JSONEncoder):
     def default(self, o):
         if isinstance(o, decimal.Decimal):
@@ -65,31 +79,50 @@ class JSONEncoder(json.JSONEncoder):
 
 api_json_encoder = JSONEncoder()
 
+def conditional(state):
+    """
+    Set ETag and Last-Modified of the turnier state version and answer
+    304 Not Modified if the client has this version already
+    """
+    etag, date = state.validators()
+    # always revalidate, no heuristic caching from Last-Modified
+    web.header('Cache-Control', 'no-cache')
+    if web.ctx.env.get('HTTP_IF_NONE_MATCH'):
+        # the ETag decides, dates are only precise to the second
+        web.lastmodified(date)
+        date = None
+    web.modified(date, etag)
+
 
 class Index:
     def GET(self):
-        db = swissturnier.db.DB()
-        with db.session_scope() as session:
-            total_teams = session.query(swissturnier.db.Team).count()
+        conditional(web.ctx.state)
+        web.header('Content-Type', 'text/html')
+        return self.load(web.ctx.state)
 
-            stats = {
-                'total_teams': total_teams,
-            }
+    def load(self, state):
+        stats = {
+            'total_teams': len(state.teams()),
+        }
 
-            web.header('Content-Type', 'text/html')
-            render = render_cheetah('reports/api')
-            return render.index(title='Teams', statistics=stats)
+        return swissturnier.report.templates.render(
+            'reports/api/index.html', {'title': 'Teams', 'statistics': stats})
 
 class APIv1Ranking:
     def GET(self, slash):
         if slash:
             raise web.seeother('/ranking')
 
+        conditional(web.ctx.state)
         #turnier = swissturnier.ranking.Turnier(db)
         #ranking.rank()
-        db = swissturnier.db.DB()
         web.header('Content-Type', 'text/html')
-        report = swissturnier.report.HTMLRankingTableReport(db)
+        return self.load(web.ctx.db, web.ctx.state)
+
+    def load(self, db, state, live_events=False):
+        """ The ranking, with live_events updated from the /v1/events stream """
+        report = swissturnier.report.HTMLRankingTableReport(db, state)
+        report.live_events = live_events
         return report.create()
 
 class APIv1PlayTable:
@@ -97,9 +130,14 @@ class APIv1PlayTable:
         if slash:
             raise web.seeother('/playtable')
 
-        db = swissturnier.db.DB()
-        report = swissturnier.report.HTMLPlayTable(db)
+        conditional(web.ctx.state)
         web.header('Content-Type', 'text/html')
+        return self.load(web.ctx.db, web.ctx.state)
+
+    def load(self, db, state, live_events=False):
+        """ The play table, with live_events updated from the /v1/events stream """
+        report = swissturnier.report.HTMLPlayTable(db, state)
+        report.live_events = live_events
         return report.create()
 
 class APIv1CategoryBase(object):
@@ -115,35 +153,38 @@ class APIv1CategoryBase(object):
 
 class APIv1Categories(APIv1CategoryBase):
     def GET(self):
-        db = swissturnier.db.DB()
-        result = []
-        with db.session_scope() as session:
-            categories = session.query(swissturnier.db.Category).all()
-            for category in categories:
-                result.append(self.get_category_dict(category))
-
+        conditional(web.ctx.state)
         web.header('Content-Type', 'application/json')
-        return api_json_encoder.encode({
+        return api_json_encoder.encode(self.load(web.ctx.state))
+
+    def load(self, state):
+        result = [self.get_category_dict(category) for category in state.categories()]
+
+        return {
             'count': len(result),
             'items': result,
             '_links': {
                 'self': { 'href': _create_api_path('categories') },
             },
-        })
+        }
 
 class APIv1Category(APIv1CategoryBase):
     def GET(self, id_category):
-        db = swissturnier.db.DB()
-        category = None
-        with db.session_scope() as session:
-            category = session.query(swissturnier.db.Category).get(int(id_category))
-            if category is None:
-                raise web.notfound(message='Category does not exist')
-            obj = self.get_category_dict(category)
+        conditional(web.ctx.state)
+        obj = self.load(web.ctx.state, id_category)
+        if obj is None:
+            raise web.notfound(message='Category does not exist')
 
         web.header('Content-Type', 'application/json')
         return api_json_encoder.encode(obj)
 
+    def load(self, state, id_category):
+        """ The category or None if it does not exist """
+        category = state.category(int(id_category))
+        if category is None:
+            return None
+        return self.get_category_dict(category)
+
 class TeamBase(object):
     TEAM_ATTRIBUTES = ['id_team', 'name', 'category']
 
@@ -158,57 +199,115 @@ class TeamBase(object):
         }
         return obj
 
+class ListPage(object):
+    """
+    The query parameters of a list resource
+
+    after=<id>&limit=<n>: keyset pagination, the items with an ID after
+    the given one, at most limit of them. A next link continues the list.
+    fields=<name>,...: only these attributes of the items plus _links.
+    embed=false: no _embedded items, only their IDs and links.
+
+    Raises ValueError if a parameter is invalid.
+    """
+    def __init__(self, params=None, attributes=()):
+        self._params = dict(params or {})
+        self.after = self._number('after')
+        self.limit = self._number('limit')
+        if self.limit is not None and self.limit < 1:
+            raise ValueError("The limit must be at least 1")
+        self.fields = None
+        if self._params.get('fields'):
+            self.fields = [name.strip() for name in self._params['fields'].split(',')]
+            unknown = set(self.fields) - set(attributes)
+            if unknown:
+                raise ValueError("Unknown fields: {}".format(', '.join(sorted(unknown))))
+        self.embed = self._params.get('embed', 'true').lower() not in ('false', '0', 'no')
+        self.more = False
+
+    def _number(self, name):
+        value = self._params.get(name)
+        if value is None or value == '':
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError("{} must be a number".format(name))
+
+    def select(self, items, key):
+        """ The items of this page given their IDs by key(item) """
+        if self.after is not None:
+            items = [item for item in items if key(item) > self.after]
+        self.more = self.limit is not None and len(items) > self.limit
+        return items if self.limit is None else items[:self.limit]
+
+    def shape(self, obj):
+        """ Leave out the attributes not asked for """
+        if self.fields is None:
+            return obj
+        return dict((name, value) for name, value in obj.items()
+                    if name in self.fields or name.startswith('_'))
+
+    def links(self, path, last_id):
+        """ The self link and a next link if there are more items """
+        links = {
+            'self': { 'href': path },
+        }
+        if self.more:
+            params = dict(self._params, after=last_id)
+            links['next'] = { 'href': path + '?' + urllib.parse.urlencode(params) }
+        return links
+
 class Teams(TeamBase):
     def GET(self, slash=False):
         if slash:
             raise web.seeother('/teams')
 
+        conditional(web.ctx.state)
         params = web.input(_unicode=True)
-        result = []
+        try:
+            obj = self.load(web.ctx.state, params.get('category'), params)
+        except ValueError as e:
+            raise web.badrequest(message=str(e))
+        web.header('Content-Type', 'application/json')
+        return api_json_encoder.encode(obj)
 
-        db = swissturnier.db.DB()
-        with db.session_scope() as session:
-            query = []
-            if 'category' in params and len(params['category']) > 0:
-                query.append(swissturnier.db.Category.name == params['category'])
-            teams = (session
-                .query(swissturnier.db.Team)
-                .join(swissturnier.db.Team.category)
-                .filter(*query)
-                .all())
-            for team in teams:
-                result.append(self.get_team_dict(team))
+    def load(self, state, category=None, params=None):
+        page = ListPage(params, self.TEAM_ATTRIBUTES)
+        teams = page.select(state.teams(category or None), lambda team: team.id_team)
+        result = [page.shape(self.get_team_dict(team)) for team in teams]
 
-        web.header('Content-Type', 'application/json')
-        return api_json_encoder.encode({
+        return {
             'count': len(result),
             'items': result,
-            '_links': {
-                'self': { 'href': _create_api_path('teams') },
-            }
-        })
+            '_links': page.links(_create_api_path('teams'), teams[-1].id_team if teams else None),
+        }
 
 class Team(TeamBase):
     def GET(self, id_team):
-        db = swissturnier.db.DB()
-        team = None
-        with db.session_scope() as session:
-            team = session.query(swissturnier.db.Team).get(int(id_team))
-            if team is None:
-                raise web.notfound(message='Team does not exist')
-            obj = self.get_team_dict(team)
+        conditional(web.ctx.state)
+        obj = self.load(web.ctx.state, id_team)
+        if obj is None:
+            raise web.notfound(message='Team does not exist')
 
         web.header('Content-Type', 'application/json')
         return api_json_encoder.encode(obj)
 
+    def load(self, state, id_team):
+        """ The team or None if it does not exist """
+        team = state.team(int(id_team))
+        if team is None:
+            return None
+        return self.get_team_dict(team)
+
 class CurrentPlayRound(object):
     def GET(self):
-        db = swissturnier.db.DB()
-        current_round = None
-        with db.session_scope() as session:
-            current_round = swissturnier.db.query_current_round(session)
+        conditional(web.ctx.state)
+        return self.load(web.ctx.state)
+
+    def load(self, state):
         return {
-            'round': current_round,
+            'round': state.current_round(),
         }
     
 class PlayRoundBase(TeamBase):
@@ -222,66 +321,231 @@ class PlayRoundBase(TeamBase):
         'start_time',
     ]
 
-    def get_play_dict(self, playround):
+    def query_plays(self, session):
+        """ Query plays with both teams and their categories at once """
+        Team = swissturnier.db.Team
+        PlayRound = swissturnier.db.PlayRound
+        return session.query(PlayRound).options(
+            sqlalchemy.orm.joinedload(PlayRound.team_a).joinedload(Team.category),
+            sqlalchemy.orm.joinedload(PlayRound.team_b).joinedload(Team.category))
+
+    def get_play_dict(self, playround, embed=True):
+        """ The play with both teams embedded or only linked """
         obj = {}
         for name in self.PLAYROUND_ATTRIBUTES:
             obj[name] = getattr(playround, name)
-        obj['_embedded'] = {
-            'team_a': self.get_team_dict(playround.team_a),
-            'team_b': None if playround.team_b is None else self.get_team_dict(playround.team_b),
-        }
         obj['_links'] = {
             'self': { 'href': _create_api_path('play', playround.id_playround) },
         }
+        if embed:
+            obj['_embedded'] = {
+                'team_a': self.get_team_dict(playround.team_a),
+                'team_b': None if playround.team_b is None else self.get_team_dict(playround.team_b),
+            }
+        else:
+            obj['_links']['team_a'] = { 'href': _create_api_path('team', playround.id_team_a) }
+            if playround.id_team_b is not None:
+                obj['_links']['team_b'] = { 'href': _create_api_path('team', playround.id_team_b) }
         return obj
         
 class PlayRounds(PlayRoundBase):
+    # JSON lines, one result entry per line
+    JSON_LINES_TYPES = ('application/x-ndjson', 'application/jsonl')
 
     def GET(self, round_number):
-        params = web.input(_unicode=True)
-        db = swissturnier.db.DB()
-        results = []
-        with db.session_scope() as session:
-            filters = [swissturnier.db.PlayRound.round_number == int(round_number)]
-            #if 'round' in params:
-            #    filters.append(swissturnier.db.PlayRound.round_number == int(params['round']))
+        conditional(web.ctx.state)
+        try:
+            obj = self.load(web.ctx.state, round_number, web.input(_unicode=True))
+        except ValueError as e:
+            raise web.badrequest(message=str(e))
+        web.header('Content-Type', 'application/json')
+        return api_json_encoder.encode(obj)
 
-            playrounds = session.query(swissturnier.db.PlayRound).filter(*filters).order_by('id_playround').all()
-            results = [self.get_play_dict(playround) for playround in playrounds]
+    def PUT(self, round_number):
+        try:
+            results = self.parse_results(web.data(), web.ctx.env.get('CONTENT_TYPE'))
+            obj = self.update(web.ctx.db, web.ctx.state, round_number, results)
+        except ValueError as e:
+            raise web.badrequest(message=str(e))
 
         web.header('Content-Type', 'application/json')
-        return api_json_encoder.encode({
+        return api_json_encoder.encode(obj)
+
+    def load(self, state, round_number, params=None):
+        page = ListPage(params, self.PLAYROUND_ATTRIBUTES)
+        plays = page.select(state.plays(int(round_number)), lambda play: play.id_playround)
+        results = [page.shape(self.get_play_dict(playround, page.embed))
+                   for playround in plays]
+
+        return {
             'count': len(results),
             'plays': results,
-        })
+            '_links': page.links(
+                _create_api_path('playround', round_number),
+                plays[-1].id_playround if plays else None),
+        }
+
+
+    def parse_results(self, data, content_type=None):
+        """
+        The (id_playround, points_a, points_b) tuples of the entries in
+        a JSON list, in {'plays': [...]} as GET returns it or in JSON
+        lines. Raises ValueError if an entry is invalid.
+        """
+        content_type = (content_type or '').split(';')[0].strip()
+        if content_type in self.JSON_LINES_TYPES:
+            entries = [json.loads(line) for line in data.decode('UTF-8').splitlines()
+                       if line.strip()]
+        else:
+            entries = json.loads(data)
+            if isinstance(entries, dict):
+                entries = entries.get('plays')
+        if not isinstance(entries, list):
+            raise ValueError("Expected a list of plays")
+        results = []
+        for entry in entries:
+            if not isinstance(entry, dict) or not all(
+                    name in entry for name in ('id_playround', 'points_a', 'points_b')):
+                raise ValueError("Each play needs id_playround, points_a and points_b")
+            result = (entry['id_playround'], entry['points_a'], entry['points_b'])
+            if not _is_number(result[0]):
+                raise ValueError("Invalid result of play {!r}".format(entry['id_playround']))
+            _check_points(*result)
+            results.append(result)
+        return results
+
+    def update(self, db, state, round_number, results):
+        """ Enter the results of many plays of the round in one transaction """
+        def update(session):
+            plays = state.turnier.update_round_results(session, int(round_number), results)
+            ranks = session.query(swissturnier.db.Rankings).all() if plays else []
+            state.update_after_commit(
+                session,
+                plays,
+                [swissturnier.state.values(rank) for rank in ranks])
+        db.write(update)
+        return self.load(state, round_number)
 
 
 class Play(PlayRoundBase):
     def GET(self, id_play):
-        db = swissturnier.db.DB()
-        obj = {}
-        with db.session_scope() as session:
-            play = session.query(swissturnier.db.PlayRound).get(int(id_play))
-            obj = self.get_play_dict(play)
+        conditional(web.ctx.state)
+        obj = self.load(web.ctx.state, id_play)
+        if obj is None:
+            raise web.notfound(message='Play does not exist')
+
         web.header('Content-Type', 'application/json')
         return api_json_encoder.encode(obj)
 
     def PUT(self, id_play):
-        data = json.loads(web.data())
-
-        db = swissturnier.db.DB()
-        with db.session_scope() as session:
-            play = session.query(swissturnier.db.PlayRound).get(int(id_play))
-            play.points_a = data.get('points_a')
-            play.points_b = data.get('points_b')
-            obj = self.get_play_dict(play)
+        try:
+            points_a, points_b = self.parse_result(id_play, web.data())
+            obj = self.update(web.ctx.db, web.ctx.state, id_play, points_a, points_b)
+        except ValueError as e:
+            raise web.badrequest(message=str(e))
+        if obj is None:
+            raise web.notfound(message='Play does not exist')
 
         web.header('Content-Type', 'application/json')
         return api_json_encoder.encode(obj)
 
+    def load(self, state, id_play):
+        """ The play or None if it does not exist """
+        play = state.play(int(id_play))
+        if play is None:
+            return None
+        return self.get_play_dict(play)
+
+    def parse_result(self, id_play, data):
+        """
+        The points_a and points_b of a play as JSON object. Raises
+        ValueError if they are missing or invalid.
+        """
+        entry = json.loads(data)
+        if not isinstance(entry, dict) or not all(
+                name in entry for name in ('points_a', 'points_b')):
+            raise ValueError("The play needs points_a and points_b")
+        _check_points(int(id_play), entry['points_a'], entry['points_b'])
+        return entry['points_a'], entry['points_b']
+
+    def update(self, db, state, id_play, points_a, points_b):
+        """
+        Enter the result of a play, returns None if the play does not
+        exist. Raises ValueError if a bye gets points_b.
+        """
+        def update(session):
+            play = self.query_plays(session).get(int(id_play))
+            if play is None:
+                return None
+            if play.id_team_b is None and points_b is not None:
+                raise ValueError("Play {} is a bye without points_b".format(play.id_playround))
+            ranks = state.turnier.update_play_result(session, play, points_a, points_b)
+            if ranks is None:
+                ranks = session.query(swissturnier.db.Rankings).all()
+            # the state follows once the result is committed
+            state.update_after_commit(
+                session,
+                [swissturnier.state.values(play)],
+                [swissturnier.state.values(rank) for rank in ranks])
+            return self.get_play_dict(play)
+        # one writer at a time, concurrent score entries wait in the queue
+        return db.write(update)
+
+class Reload(object):
+    def POST(self):
+        web.header('Content-Type', 'application/json')
+        return api_json_encoder.encode(self.load(web.ctx.state))
+
+    def load(self, state):
+        """ Load the state again after changes by other processes """
+        state.reload()
+        return {
+            'version': state.version,
+        }
 
-def get_application():
-    return web.application(urls, globals())
+
+def format_event(change):
+    """
+    A state.Change as server-sent event: the changed plays and rankings
+    rows, the current round and the version
+    """
+    data = api_json_encoder.encode({
+        'version': change.version,
+        'round': change.current_round,
+        'plays': change.plays,
+        'rankings': change.rankings,
+    })
+    return 'id: {:d}\nevent: change\ndata: {}\n\n'.format(change.version, data)
+
+class Events(object):
+    def GET(self):
+        # a stream would hold one of the few server threads per client
+        # until it disconnects, see swissturnier.aioapi
+        raise web.HTTPError(
+            '501 Not Implemented',
+            {'Content-Type': 'text/plain'},
+            'Events are streamed by the asyncio server (swissturnier.aioapi)')
+
+
+def get_application(db=None, state=None):
+    """
+    The web application with one DB instance shared by all requests
+
+    Engine, connection pool and session registry are created once when
+    the application starts, the handlers find the DB in web.ctx.db. The
+    reads are served from the turnier state in web.ctx.state.
+    """
+    if db is None:
+        db = swissturnier.db.DB()
+    if state is None:
+        state = swissturnier.state.TurnierState(db)
+    swissturnier.report.templates.compile()
+    def load():
+        web.ctx.db = db
+        web.ctx.state = state
+    app = web.application(urls, globals())
+    app.add_processor(web.loadhook(load))
+    return app
 
 if __name__ == '__main__':
     app = get_application()
@@ -17,11 +17,13 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import sqlalchemy
-from sqlalchemy import Column, String, Integer, Float, DateTime, ForeignKey
+from sqlalchemy import Column, String, Integer, Float, DateTime, ForeignKey, Index
 import sqlalchemy.orm
 import sqlalchemy.ext.declarative
  
 from contextlib import contextmanager
+import concurrent.futures
+import threading
 import urllib.parse
 import datetime
 import json
@@ -53,6 +55,32 @@ class PlaySettings(dict):
         """ Number of available courts """
         return self['courts']
 
+    @property
+    def pairing(self):
+        """ Pairing engine, 'greedy' top down (default) or 'matching' """
+        return self.get('pairing', 'greedy')
+
+    @property
+    def ranking_backend(self):
+        """
+        Standings calculation, 'python' (default), 'numpy' or 'sql' for
+        a single statement in the DB
+        """
+        return self.get('ranking_backend', 'python')
+
+    @property
+    def by_category(self):
+        """ Rank and pair each category on its own """
+        return self.get('by_category', False)
+
+    @property
+    def workers(self):
+        """
+        Processes to rank and pair the categories of big fields, 1
+        (default) for none, None for all CPUs
+        """
+        return self.get('workers', 1)
+
 
 class Configuration(dict):
     @property
@@ -80,8 +108,24 @@ class Configuration(dict):
         return self['port']
 
     @property
-    def port(self):
-        return self['port']
+    def pool_size(self):
+        """ Connections kept open by the engine """
+        return self['pool_size']
+
+    @property
+    def pool_pre_ping(self):
+        """ Test pooled connections before using them """
+        return self['pool_pre_ping']
+
+    @property
+    def pool_recycle(self):
+        """ Seconds after pooled connections are replaced, -1 for never """
+        return self['pool_recycle']
+
+    @property
+    def busy_timeout(self):
+        """ Milliseconds SQLite waits for a lock before it gives up """
+        return self['busy_timeout']
 
     @property
     def play_settings(self):
@@ -100,8 +144,15 @@ class DB(object):
             'password': None,
             'host': 'localhost',
             'port': 5432,
+            'pool_size': 5,
+            'pool_pre_ping': True,
+            'pool_recycle': 3600,
+            'busy_timeout': 5000,
         })
         self._engine = None
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._inline_lock = threading.RLock()
         self._connection = None
         self._sessionmaker = None
         self._init_config(config_file)
@@ -127,9 +178,38 @@ class DB(object):
         to the DB.
         """
         if not self._engine:
-            self._engine = sqlalchemy.create_engine(self._buildurl())
+            self._engine = sqlalchemy.create_engine(
+                self._buildurl(), **self._engine_options())
+            if self.is_sqlite:
+                sqlalchemy.event.listen(self._engine, 'connect', self._configure_sqlite)
         return self._engine
 
+    @property
+    def is_sqlite(self):
+        """ Embedded SQLite DB instead of a DB server """
+        return self.config.schema.startswith('sqlite')
+
+    def _configure_sqlite(self, dbapi_connection, connection_record):
+        """
+        With the write-ahead log readers go on while one writes, and a
+        writer waits for the lock instead of failing at once
+        """
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA busy_timeout={:d}".format(self.config.busy_timeout))
+        cursor.close()
+
+    def _engine_options(self):
+        """ Connection pool settings, SQLite has no server to connect to """
+        if self.is_sqlite:
+            return {}
+        return {
+            'pool_size': self.config.pool_size,
+            'pool_pre_ping': self.config.pool_pre_ping,
+            'pool_recycle': self.config.pool_recycle,
+        }
+
     @property
     def connection(self):
         """ Return a connection to the DB. But better use a session instead """
@@ -139,11 +219,14 @@ class DB(object):
 
     @property
     def sessionmaker(self):
-        """ SQL Alchemy specific session maker """
+        """
+        SQL Alchemy specific session maker, a thread local registry
+        shared by all users of this instance
+        """
         if not self._sessionmaker:
-            self._sessionmaker = sqlalchemy.orm.sessionmaker()
-            self._sessionmaker.configure(bind=self.engine, autocommit=False)
-        return sqlalchemy.orm.scoped_session(self._sessionmaker)
+            self._sessionmaker = sqlalchemy.orm.scoped_session(
+                sqlalchemy.orm.sessionmaker(bind=self.engine, autocommit=False))
+        return self._sessionmaker
 
     def create_session(self):
         return self.sessionmaker()
@@ -160,6 +243,30 @@ class DB(object):
             raise
         finally:
             session.close()
+            self.sessionmaker.remove()
+
+    def write(self, func):
+        """
+        Call func(session) in a transaction as the only writer and return
+        its result
+
+        SQLite locks the whole DB file for a write, so all writes of this
+        instance are queued to a single thread. Readers are not queued.
+        Other DBs and in-memory SQLite (one DB per thread) call func
+        right away in the calling thread, but one at a time as well. So
+        caches of the writers like the tie-breakers of
+        swissturnier.state.TurnierState.turnier need no locks.
+        """
+        def transaction():
+            with self.session_scope() as session:
+                return func(session)
+        if not self.is_sqlite or self.engine.url.database in (None, '', ':memory:'):
+            with self._inline_lock:
+                return transaction()
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        return self._writer.submit(transaction).result()
 
     def _init_config(self, config_file):
         try:
@@ -171,6 +278,9 @@ class DB(object):
                 raise
 
     def _buildurl(self):
+        if self.is_sqlite:
+            # a file name or an in-memory DB without a database name
+            return "{}:///{}".format(self.config.schema, self.config.database or '')
         cfg = self.config.copy()
         cfg['credentials'] = cfg['user']
         if cfg['password']:
@@ -181,10 +291,30 @@ class DB(object):
         if self._connection:
             self._connection.close()
             self._connection = None
+        if self._sessionmaker:
+            self._sessionmaker.remove()
+        if self._writer:
+            self._writer.shutdown()
+            self._writer = None
 
     def createdb(self):
-        """ FIXME Never tried this method """
+        """
+        Create the missing tables and migrate the schema to the latest
+        version
+
+        Returns the list of the schema versions applied.
+        """
         Base.metadata.create_all(self.engine)
+        applied = []
+        with self.engine.begin() as connection:
+            version = connection.execute(
+                sqlalchemy.select([sqlalchemy.func.max(SchemaVersion.version)])
+            ).scalar() or 0
+            for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+                migration(connection)
+                connection.execute(SchemaVersion.__table__.insert(), version=number)
+                applied.append(number)
+        return applied
 
 class DBError(Exception): pass
 
@@ -214,8 +344,11 @@ class Team(Base):
 class PlayRound(Base):
     """ For each team encounter store the round and the teams """
     __tablename__ = 'playround'
+    __table_args__ = (
+        Index('playround_id_teams_idx', 'id_team_a', 'id_team_b'),
+    )
     id_playround = Column(Integer, primary_key=True)
-    round_number = Column(Integer, nullable=False)
+    round_number = Column(Integer, nullable=False, index=True)
     id_team_a = Column(ForeignKey('team.id_team'), nullable=False)
     id_team_b = Column(ForeignKey('team.id_team'))
     points_a = Column(Integer)
@@ -232,11 +365,17 @@ class PlayRound(Base):
 class Rankings(Base):
     """ The ranking table based on all rounds played yet """
     __tablename__ = 'rankings'
+    __table_args__ = (
+        Index('rankings_id_team_key', 'id_team', unique=True),
+    )
     id_rank = Column(Integer, primary_key=True)
     id_team = Column(Integer, ForeignKey('team.id_team'))
-    rank = Column(Integer)
+    rank = Column(Integer, index=True)
     wins = Column(Float)
     points = Column(Integer)
+    buchholz = Column(Float, default=0)
+    median_buchholz = Column(Float, default=0)
+    sonneborn_berger = Column(Float, default=0)
     team = sqlalchemy.orm.relationship(
         Team,
         backref=sqlalchemy.orm.backref('teams', uselist=True, cascade='delete,all'))
@@ -245,6 +384,84 @@ class Rankings(Base):
         return "<Rankings ID {id_rank} #'{rank}' ({category.name})>".format(**vars(self))
 
 
+class RankingsHistory(Base):
+    """ The rankings as they were after each complete round """
+    __tablename__ = 'rankings_history'
+    round_number = Column(Integer, primary_key=True)
+    id_team = Column(Integer, ForeignKey('team.id_team'), primary_key=True)
+    rank = Column(Integer)
+    wins = Column(Float)
+    points = Column(Integer)
+    buchholz = Column(Float, default=0)
+    median_buchholz = Column(Float, default=0)
+    sonneborn_berger = Column(Float, default=0)
+    team = sqlalchemy.orm.relationship(Team)
+
+    def __repr__(self):
+        return "<RankingsHistory #{round_number} ID {id_team} #'{rank}'>".format(**vars(self))
+
+
+class SchemaVersion(Base):
+    """ The schema migrations applied to the DB """
+    __tablename__ = 'schema_version'
+    version = Column(Integer, primary_key=True)
+
+
+class ChangeCounter(Base):
+    """ One row counting the transactions writing the turnier """
+    __tablename__ = 'change_counter'
+    id = Column(Integer, primary_key=True)
+    counter = Column(Integer, nullable=False, default=0)
+
+
+def _migrate_tiebreak_columns(connection):
+    """ Version 1: the tie-breaker columns of the rankings """
+    inspector = sqlalchemy.inspect(connection)
+    columns = [column['name'] for column in inspector.get_columns('rankings')]
+    for name in ('buchholz', 'median_buchholz', 'sonneborn_berger'):
+        if name not in columns:
+            connection.execute(
+                "ALTER TABLE rankings ADD COLUMN {} float DEFAULT 0".format(name))
+
+def _migrate_indexes(connection):
+    """ Version 2: indexes of the pairing, ranking and API queries """
+    for statement in [
+            "CREATE INDEX IF NOT EXISTS ix_playround_round_number ON playround (round_number)",
+            "CREATE INDEX IF NOT EXISTS playround_id_teams_idx ON playround (id_team_a, id_team_b)",
+            "CREATE INDEX IF NOT EXISTS ix_rankings_rank ON rankings (rank)",
+        ]:
+        connection.execute(statement)
+    # the dumped schema already has a unique constraint on the team
+    inspector = sqlalchemy.inspect(connection)
+    unique = [constraint['column_names']
+              for constraint in inspector.get_unique_constraints('rankings')]
+    unique.extend([index['column_names']
+                   for index in inspector.get_indexes('rankings') if index['unique']])
+    if ['id_team'] not in unique:
+        connection.execute(
+            "CREATE UNIQUE INDEX rankings_id_team_key ON rankings (id_team)")
+
+def _migrate_rankings_history(connection):
+    """ Version 3: the rankings snapshot after each round """
+    RankingsHistory.__table__.create(connection, checkfirst=True)
+
+def _migrate_change_counter(connection):
+    """ Version 4: the counter of writes, see bump_change_counter() """
+    table = ChangeCounter.__table__
+    table.create(connection, checkfirst=True)
+    if connection.execute(sqlalchemy.select([table.c.id])).first() is None:
+        connection.execute(table.insert(), id=1, counter=0)
+
+# Schema migrations in order, each brings the schema to its version
+# (position + 1). They must also pass on tables create_all() just created.
+MIGRATIONS = [
+    _migrate_tiebreak_columns,
+    _migrate_indexes,
+    _migrate_rankings_history,
+    _migrate_change_counter,
+]
+
+
 def query_current_round(session):
     """
     Get the current round number from DB
@@ -254,6 +471,39 @@ def query_current_round(session):
     current_round = session.query(sqlalchemy.func.max(PlayRound.round_number)).scalar()
     return 0 if current_round is None else current_round
 
+def bump_change_counter(session):
+    """
+    Count the transaction of session as a change of the turnier and
+    return the new count. Only the first call of a transaction counts.
+
+    Each write to teams, plays or rankings calls it, so readers like
+    swissturnier.state.TurnierState notice the changes made by other
+    processes with query_change_counter().
+    """
+    counted = session.info.get('change_counter')
+    if counted is not None and counted[0] is session.transaction:
+        return counted[1]
+    table = ChangeCounter.__table__
+    result = session.execute(table.update().values(counter=table.c.counter + 1))
+    if result.rowcount == 0:
+        session.execute(table.insert().values(id=1, counter=1))
+    counter = query_change_counter(session)
+    session.info['change_counter'] = (session.transaction, counter)
+    return counter
+
+def query_change_counter(session):
+    """ The number of transactions counted by bump_change_counter() """
+    return session.query(ChangeCounter.counter).scalar() or 0
+
 def query_team_count(session):
     """ Get the current round number from DB """
     return session.query(Team).count()
+
+def query_round_rankings(session, round_number):
+    """ The rankings snapshot after a round, empty if there is none """
+    return (session
+        .query(RankingsHistory)
+        .options(sqlalchemy.orm.joinedload(RankingsHistory.team))
+        .filter(RankingsHistory.round_number == round_number)
+        .order_by(RankingsHistory.rank)
+        .all())
@@ -0,0 +1,475 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2020 Andreas Stricker <andy@knitter.ch>
+#
+# This file is part of SwissTurnier.
+#
+# SwissTurnier is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Maximum weight matching in general graphs
+
+Edmonds' blossom algorithm with the primal-dual method of Galil, "Efficient
+algorithms for finding maximum matching in graphs" (1986). It runs in
+O(n^3). The structure follows the public domain implementation of
+Joris van Rantwijk (mwmatching.py).
+
+In addition the matching can be started from a partial matching, as long
+as all its edges have the maximum weight. Those edges are tight for the
+initial dual variables, so the algorithm only has to augment from the
+remaining single vertices.
+"""
+
+def max_weight_matching(edges, maxcardinality=False, initial=()):
+    """
+    Compute a maximum weight matching
+
+    edges is a list of (i, j, weight) tuples with vertices numbered from
+    zero and integer weights. With maxcardinality only maximum cardinality
+    matchings are considered. initial is an optional list of edge indices
+    of a partial matching, all of maximum weight.
+
+    Returns a list mate with mate[i] == j if vertex i is matched to j,
+    or -1 for single vertices.
+    """
+    if not edges:
+        return []
+
+    nedge = len(edges)
+    nvertex = 0
+    for (i, j, w) in edges:
+        assert i >= 0 and j >= 0 and i != j
+        nvertex = max(nvertex, i + 1, j + 1)
+    maxweight = max(0, max(w for (i, j, w) in edges))
+
+    # endpoint[p] is the vertex to which endpoint p is attached, the
+    # endpoints of edge k are 2*k and 2*k+1
+    endpoint = [edges[p // 2][p % 2] for p in range(2 * nedge)]
+    # neighbend[v] is the list of remote endpoints of the edges of v
+    neighbend = [[] for i in range(nvertex)]
+    for k, (i, j, w) in enumerate(edges):
+        neighbend[i].append(2 * k + 1)
+        neighbend[j].append(2 * k)
+    weight2 = [2 * w for (i, j, w) in edges]
+
+    # mate[v] is the remote endpoint of the matched edge of v or -1
+    mate = nvertex * [-1]
+    # label of top level blossoms: 0 free, 1 S-vertex, 2 T-vertex
+    label = (2 * nvertex) * [0]
+    # labelend[b] is the remote endpoint of the edge through which
+    # blossom b got its label
+    labelend = (2 * nvertex) * [-1]
+    # inblossom[v] is the top level blossom to which vertex v belongs
+    inblossom = list(range(nvertex))
+    blossomparent = (2 * nvertex) * [-1]
+    blossomchilds = (2 * nvertex) * [None]
+    blossombase = list(range(nvertex)) + nvertex * [-1]
+    # blossomendps[b][i] is the endpoint connecting sub-blossom i to i+1
+    blossomendps = (2 * nvertex) * [None]
+    # bestedge[b] is the least-slack edge to a different S-blossom
+    bestedge = (2 * nvertex) * [-1]
+    blossombestedges = (2 * nvertex) * [None]
+    unusedblossoms = list(range(nvertex, 2 * nvertex))
+    usedblossoms = set()
+    # dual variables, vertices first then blossoms
+    dualvar = nvertex * [maxweight] + nvertex * [0]
+    allowedge = nedge * [False]
+    queue = []
+    # Only vertices and blossoms touched in the current stage are looked
+    # at for the dual updates, that keeps a stage linear in its tree size
+    labeled = set()
+    withbestedge = set()
+
+    for k in initial:
+        (i, j, w) = edges[k]
+        assert w == maxweight and mate[i] == -1 and mate[j] == -1
+        mate[i] = 2 * k + 1
+        mate[j] = 2 * k
+
+    def slack(k):
+        (i, j, w) = edges[k]
+        return dualvar[i] + dualvar[j] - weight2[k]
+
+    def blossom_leaves(b):
+        """ All vertices of blossom b, without recursion for deep nesting """
+        if b < nvertex:
+            return [b]
+        leaves = []
+        stack = [b]
+        while stack:
+            t = stack.pop()
+            if t < nvertex:
+                leaves.append(t)
+            else:
+                stack.extend(reversed(blossomchilds[t]))
+        return leaves
+
+    def assign_label(w, t, p):
+        """ Label vertex w and its top level blossom through endpoint p """
+        b = inblossom[w]
+        label[w] = label[b] = t
+        labelend[w] = labelend[b] = p
+        bestedge[w] = bestedge[b] = -1
+        leaves = blossom_leaves(b)
+        labeled.update(leaves)
+        if t == 1:
+            queue.extend(leaves)
+        elif t == 2:
+            # the mate of a T-blossom's base becomes an S-vertex
+            base = blossombase[b]
+            assign_label(endpoint[mate[base]], 1, mate[base] ^ 1)
+
+    def scan_blossom(v, w):
+        """
+        Trace back from v and w to find a new blossom or an augmenting path
+
+        Returns the base of the new blossom or -1 for an augmenting path.
+        """
+        path = []
+        base = -1
+        while v != -1 or w != -1:
+            b = inblossom[v]
+            if label[b] & 4:
+                base = blossombase[b]
+                break
+            path.append(b)
+            label[b] = 5
+            if labelend[b] == -1:
+                # the base of b is single, stop tracing this path
+                v = -1
+            else:
+                v = endpoint[labelend[b]]
+                b = inblossom[v]
+                v = endpoint[labelend[b]]
+            if w != -1:
+                v, w = w, v
+        for b in path:
+            label[b] = 1
+        return base
+
+    def add_blossom(base, k):
+        """ Construct a new S-blossom with the given base through edge k """
+        (v, w, wt) = edges[k]
+        bb = inblossom[base]
+        bv = inblossom[v]
+        bw = inblossom[w]
+        b = unusedblossoms.pop()
+        usedblossoms.add(b)
+        blossombase[b] = base
+        blossomparent[b] = -1
+        blossomparent[bb] = b
+        blossomchilds[b] = path = []
+        blossomendps[b] = endps = []
+        while bv != bb:
+            blossomparent[bv] = b
+            path.append(bv)
+            endps.append(labelend[bv])
+            v = endpoint[labelend[bv]]
+            bv = inblossom[v]
+        path.append(bb)
+        path.reverse()
+        endps.reverse()
+        endps.append(2 * k)
+        while bw != bb:
+            blossomparent[bw] = b
+            path.append(bw)
+            endps.append(labelend[bw] ^ 1)
+            w = endpoint[labelend[bw]]
+            bw = inblossom[w]
+        label[b] = 1
+        labelend[b] = labelend[bb]
+        dualvar[b] = 0
+        for v in blossom_leaves(b):
+            if label[inblossom[v]] == 2:
+                # former T-vertices become S-vertices in the new blossom
+                queue.append(v)
+            inblossom[v] = b
+        # compute the least-slack edges to the neighbouring S-blossoms
+        bestedgeto = {}
+        for bv in path:
+            if blossombestedges[bv] is None:
+                nblists = [[p // 2 for p in neighbend[v]]
+                           for v in blossom_leaves(bv)]
+            else:
+                nblists = [blossombestedges[bv]]
+            for nblist in nblists:
+                for k in nblist:
+                    (i, j, wt) = edges[k]
+                    if inblossom[j] == b:
+                        i, j = j, i
+                    bj = inblossom[j]
+                    if (bj != b and label[bj] == 1 and
+                            (bj not in bestedgeto or
+                             slack(k) < slack(bestedgeto[bj]))):
+                        bestedgeto[bj] = k
+            blossombestedges[bv] = None
+            bestedge[bv] = -1
+        blossombestedges[b] = [bestedgeto[bj] for bj in sorted(bestedgeto)]
+        bestedge[b] = -1
+        for k in blossombestedges[b]:
+            if bestedge[b] == -1 or slack(k) < slack(bestedge[b]):
+                bestedge[b] = k
+                withbestedge.add(b)
+
+    def expand_blossom(b, endstage):
+        """ Expand blossom b, relabel its sub-blossoms unless at stage end """
+        for s in blossomchilds[b]:
+            blossomparent[s] = -1
+            if s < nvertex:
+                inblossom[s] = s
+            elif endstage and dualvar[s] == 0:
+                expand_blossom(s, endstage)
+            else:
+                for v in blossom_leaves(s):
+                    inblossom[v] = s
+        if not endstage and label[b] == 2:
+            # relabel the sub-blossoms on the even path from the entry
+            # child to the base
+            entrychild = inblossom[endpoint[labelend[b] ^ 1]]
+            j = blossomchilds[b].index(entrychild)
+            if j & 1:
+                j -= len(blossomchilds[b])
+                jstep = 1
+                endptrick = 0
+            else:
+                jstep = -1
+                endptrick = 1
+            p = labelend[b]
+            while j != 0:
+                label[endpoint[p ^ 1]] = 0
+                label[endpoint[blossomendps[b][j - endptrick] ^ endptrick ^ 1]] = 0
+                assign_label(endpoint[p ^ 1], 2, p)
+                allowedge[blossomendps[b][j - endptrick] // 2] = True
+                j += jstep
+                p = blossomendps[b][j - endptrick] ^ endptrick
+                allowedge[p // 2] = True
+                j += jstep
+            # the base becomes a T-blossom without labeling its mate
+            bv = blossomchilds[b][j]
+            label[endpoint[p ^ 1]] = label[bv] = 2
+            labelend[endpoint[p ^ 1]] = labelend[bv] = p
+            bestedge[bv] = -1
+            j += jstep
+            while blossomchilds[b][j] != entrychild:
+                # sub-blossoms on the odd path keep a T label if they
+                # are reachable from outside
+                bv = blossomchilds[b][j]
+                if label[bv] == 1:
+                    j += jstep
+                    continue
+                for v in blossom_leaves(bv):
+                    if label[v] != 0:
+                        break
+                if label[v] != 0:
+                    label[v] = 0
+                    label[endpoint[mate[blossombase[bv]]]] = 0
+                    assign_label(v, 2, labelend[v])
+                j += jstep
+        label[b] = labelend[b] = -1
+        blossomchilds[b] = blossomendps[b] = None
+        blossombase[b] = -1
+        blossombestedges[b] = None
+        bestedge[b] = -1
+        unusedblossoms.append(b)
+        usedblossoms.discard(b)
+
+    def augment_blossom(b, v):
+        """ Swap matched and unmatched edges from vertex v to the base of b """
+        t = v
+        while blossomparent[t] != b:
+            t = blossomparent[t]
+        if t >= nvertex:
+            augment_blossom(t, v)
+        i = j = blossomchilds[b].index(t)
+        if i & 1:
+            j -= len(blossomchilds[b])
+            jstep = 1
+            endptrick = 0
+        else:
+            jstep = -1
+            endptrick = 1
+        while j != 0:
+            j += jstep
+            t = blossomchilds[b][j]
+            p = blossomendps[b][j - endptrick] ^ endptrick
+            if t >= nvertex:
+                augment_blossom(t, endpoint[p])
+            j += jstep
+            t = blossomchilds[b][j]
+            if t >= nvertex:
+                augment_blossom(t, endpoint[p ^ 1])
+            mate[endpoint[p]] = p ^ 1
+            mate[endpoint[p ^ 1]] = p
+        # rotate the sub-blossoms so that v's sub-blossom is the new base
+        blossomchilds[b] = blossomchilds[b][i:] + blossomchilds[b][:i]
+        blossomendps[b] = blossomendps[b][i:] + blossomendps[b][:i]
+        blossombase[b] = blossombase[blossomchilds[b][0]]
+
+    def augment_matching(k):
+        """ Swap matched and unmatched edges along the path through edge k """
+        (v, w, wt) = edges[k]
+        for (s, p) in ((v, 2 * k + 1), (w, 2 * k)):
+            while True:
+                bs = inblossom[s]
+                if bs >= nvertex:
+                    augment_blossom(bs, s)
+                mate[s] = p
+                if labelend[bs] == -1:
+                    # reached a single vertex, the root of the tree
+                    break
+                t = endpoint[labelend[bs]]
+                bt = inblossom[t]
+                s = endpoint[labelend[bt]]
+                j = endpoint[labelend[bt] ^ 1]
+                if bt >= nvertex:
+                    augment_blossom(bt, j)
+                mate[j] = labelend[bt]
+                p = labelend[bt] ^ 1
+
+    # Each stage grows alternating trees from all single vertices until
+    # an augmenting path is found, at most one stage per single vertex
+    for t in range(nvertex):
+        label[:] = (2 * nvertex) * [0]
+        bestedge[:] = (2 * nvertex) * [-1]
+        blossombestedges[nvertex:] = nvertex * [None]
+        allowedge[:] = nedge * [False]
+        queue[:] = []
+        labeled.clear()
+        withbestedge.clear()
+
+        for v in [v for v in range(nvertex) if mate[v] == -1]:
+            if label[inblossom[v]] == 0:
+                assign_label(v, 1, -1)
+
+        augmented = False
+        while True:
+            while queue and not augmented:
+                v = queue.pop()
+                for p in neighbend[v]:
+                    k = p // 2
+                    w = endpoint[p]
+                    if inblossom[v] == inblossom[w]:
+                        continue
+                    if not allowedge[k]:
+                        kslack = dualvar[v] + dualvar[w] - weight2[k]
+                        if kslack <= 0:
+                            allowedge[k] = True
+                    if allowedge[k]:
+                        if label[inblossom[w]] == 0:
+                            # w is free, label it T and its mate S
+                            assign_label(w, 2, p ^ 1)
+                        elif label[inblossom[w]] == 1:
+                            base = scan_blossom(v, w)
+                            if base >= 0:
+                                add_blossom(base, k)
+                            else:
+                                augment_matching(k)
+                                augmented = True
+                                break
+                        elif label[w] == 0:
+                            # w is inside a T-blossom, but not yet reached
+                            label[w] = 2
+                            labelend[w] = p ^ 1
+                    elif label[inblossom[w]] == 1:
+                        b = inblossom[v]
+                        if bestedge[b] == -1 or kslack < slack(bestedge[b]):
+                            bestedge[b] = k
+                            withbestedge.add(b)
+                    elif label[w] == 0:
+                        if bestedge[w] == -1 or kslack < slack(bestedge[w]):
+                            bestedge[w] = k
+                            withbestedge.add(w)
+
+            if augmented:
+                break
+
+            # No augmenting path with the tight edges, update the dual
+            # variables by the largest delta keeping them feasible
+            deltatype = -1
+            delta = deltaedge = deltablossom = None
+            if not maxcardinality:
+                deltatype = 1
+                delta = min(dualvar[:nvertex])
+            candidates = sorted(withbestedge)
+            for v in candidates:
+                if (v < nvertex and label[inblossom[v]] == 0 and
+                        bestedge[v] != -1):
+                    d = slack(bestedge[v])
+                    if deltatype == -1 or d < delta:
+                        delta = d
+                        deltatype = 2
+                        deltaedge = bestedge[v]
+            for b in candidates:
+                if (blossomparent[b] == -1 and label[b] == 1 and
+                        bestedge[b] != -1):
+                    kslack = slack(bestedge[b])
+                    if isinstance(kslack, int):
+                        d = kslack // 2
+                    else:
+                        d = kslack / 2.0
+                    if deltatype == -1 or d < delta:
+                        delta = d
+                        deltatype = 3
+                        deltaedge = bestedge[b]
+            for b in sorted(usedblossoms):
+                if (blossombase[b] >= 0 and blossomparent[b] == -1 and
+                        label[b] == 2 and
+                        (deltatype == -1 or dualvar[b] < delta)):
+                    delta = dualvar[b]
+                    deltatype = 4
+                    deltablossom = b
+            if deltatype == -1:
+                # no further improvement possible, this is the optimum
+                deltatype = 1
+                delta = max(0, min(dualvar[:nvertex]))
+
+            for v in labeled:
+                if label[inblossom[v]] == 1:
+                    dualvar[v] -= delta
+                elif label[inblossom[v]] == 2:
+                    dualvar[v] += delta
+            for b in usedblossoms:
+                if blossombase[b] >= 0 and blossomparent[b] == -1:
+                    if label[b] == 1:
+                        dualvar[b] += delta
+                    elif label[b] == 2:
+                        dualvar[b] -= delta
+
+            if deltatype == 1:
+                break
+            elif deltatype == 2:
+                allowedge[deltaedge] = True
+                (i, j, wt) = edges[deltaedge]
+                if label[inblossom[i]] == 0:
+                    i, j = j, i
+                queue.append(i)
+            elif deltatype == 3:
+                allowedge[deltaedge] = True
+                (i, j, wt) = edges[deltaedge]
+                queue.append(i)
+            elif deltatype == 4:
+                expand_blossom(deltablossom, False)
+
+        if not augmented:
+            break
+
+        # expand all S-blossoms with zero dual at the end of the stage
+        for b in sorted(usedblossoms):
+            if (blossomparent[b] == -1 and blossombase[b] >= 0 and
+                    label[b] == 1 and dualvar[b] == 0):
+                expand_blossom(b, True)
+
+    for v in range(nvertex):
+        if mate[v] >= 0:
+            mate[v] = endpoint[mate[v]]
+    return mate
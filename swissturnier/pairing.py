@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2020 Andreas Stricker <andy@knitter.ch>
+#
+# This file is part of SwissTurnier.
+#
+# SwissTurnier is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Pairing of teams for the next round on plain Python data
+
+Nothing in here touches the DB. The history of former plays is loaded
+once per round and all pairing decisions are made against it.
+"""
+
+from swissturnier.matching import max_weight_matching
+
+# Teams are only paired with teams at most this many ranks apart, the
+# window is widened if no pairing for all teams is found within.
+MATCHING_WINDOW = 8
+
+class PairingError(Exception): pass
+
+
+class PairingHistory(object):
+    """ Former opponents and byes of all teams, loaded once per round """
+
+    def __init__(self, plays=()):
+        self._pairings = set()
+        self._byes = {}
+        for id_team_a, id_team_b in plays:
+            self.add(id_team_a, id_team_b)
+
+    def add(self, id_team_a, id_team_b):
+        """ Record a play between two teams, byes have no opponent """
+        if id_team_b is None:
+            self._byes[id_team_a] = self._byes.get(id_team_a, 0) + 1
+            return
+        self._pairings.add(frozenset((id_team_a, id_team_b)))
+
+    def bye_count(self, id_team):
+        """ Number of byes the team got so far """
+        return self._byes.get(id_team, 0)
+
+    def has_played(self, id_team1, id_team2):
+        """ check if two teams have already played against before """
+        return frozenset((id_team1, id_team2)) in self._pairings
+
+
+def pick_bye(ranked, history):
+    """
+    Choose the team getting the bye for an odd number of teams
+
+    It's the lowest ranked team of those with the fewest byes so far.
+    Returns its team ID.
+    """
+    if not ranked:
+        raise PairingError("No team for a bye")
+    fewest = min(history.bye_count(id_team) for id_team in ranked)
+    for id_team in reversed(ranked):
+        if history.bye_count(id_team) == fewest:
+            return id_team
+
+def pair_greedy(ranked, history):
+    """
+    Pair the teams top down
+
+    Each team is paired with the next ranked team it hasn't played yet.
+    This can run into a dead end in late rounds. Returns a list of
+    (id_team_a, id_team_b) tuples ordered by the rank of team A.
+    """
+    ranked = list(ranked)
+    pairings = []
+    while len(ranked) > 1:
+        id_team_a = ranked.pop(0)
+        idx = 0
+        while idx < len(ranked) and history.has_played(id_team_a, ranked[idx]):
+            idx += 1
+        if idx == len(ranked):
+            raise PairingError(
+                "Couldn't find a new opponent for team {}, "
+                "try the 'matching' pairing".format(id_team_a))
+        pairings.append((id_team_a, ranked.pop(idx)))
+    return pairings
+
+def pair_by_matching(ranked, history, window=MATCHING_WINDOW):
+    """
+    Pair all teams with a maximum weight matching
+
+    ranked is the list of team IDs, best team first, without the bye. The
+    weight of a pairing drops with the square of the rank distance, teams
+    which already played against each other are never paired. Returns a
+    list of (id_team_a, id_team_b) tuples ordered by the rank of team A.
+    """
+    count = len(ranked)
+    if count % 2 != 0:
+        raise PairingError("Odd number of teams, assign the bye first")
+    if count == 0:
+        return []
+    while True:
+        mate = _match_window(ranked, history, window)
+        if all(position >= 0 for position in mate):
+            break
+        if window >= count:
+            raise PairingError("No pairing without a rematch possible")
+        window *= 2
+    return [(ranked[i], ranked[mate[i]]) for i in range(count) if i < mate[i]]
+
+def _match_window(ranked, history, window):
+    """ Match teams at most window ranks apart, returns mate by position """
+    count = len(ranked)
+    maxweight = count * count
+    edges = []
+    for i in range(count):
+        for j in range(i + 1, min(i + 1 + window, count)):
+            if not history.has_played(ranked[i], ranked[j]):
+                edges.append((i, j, maxweight - (j - i) * (j - i)))
+    # Start from neighbours in rank order, they have maximum weight
+    initial = []
+    paired = set()
+    for k, (i, j, weight) in enumerate(edges):
+        if j == i + 1 and not (i in paired or j in paired):
+            initial.append(k)
+            paired.update((i, j))
+    mate = max_weight_matching(edges, maxcardinality=True, initial=initial)
+    return mate + (count - len(mate)) * [-1]
+
+PAIRING_ENGINES = {
+    'greedy': pair_greedy,
+    'matching': pair_by_matching,
+}
+
+def pair_round(ranked, history, engine='greedy'):
+    """
+    Pair the ranked teams for the next round, with a bye if needed
+
+    Returns a tuple (id_team_bye, pairings), id_team_bye is None for an
+    even number of teams.
+    """
+    if engine not in PAIRING_ENGINES:
+        raise PairingError("Unknown pairing engine '{}'".format(engine))
+    ranked = list(ranked)
+    id_team_bye = None
+    if len(ranked) % 2 != 0:
+        id_team_bye = pick_bye(ranked, history)
+        ranked.remove(id_team_bye)
+    return (id_team_bye, PAIRING_ENGINES[engine](ranked, history))
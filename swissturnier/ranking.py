@@ -18,8 +18,102 @@
 
 import sqlalchemy
 import swissturnier.db
-from swissturnier.db import Category, Team, PlayRound, Rankings
-import math
+from swissturnier.db import Category, Team, PlayRound, Rankings, RankingsHistory
+from swissturnier import standings
+from swissturnier.pairing import PairingHistory, pair_round
+from swissturnier.schedule import Scheduler
+import concurrent.futures
+import threading
+
+# Ranking in the DB with a single statement, see Turnier._rank_sql().
+# Same results as standings.order(): sums over both sides of each scored
+# play, Buchholz from the opponents' sums and unique ranks in the order
+# of standings.sort_key(). Runs on PostgreSQL and SQLite 3.33 or newer.
+RANK_SQL = """
+WITH plays AS (
+    SELECT id_team_a, id_team_b, points_a, points_b
+    FROM playround
+    WHERE round_number <= :to_round
+      AND points_a IS NOT NULL
+      AND (id_team_b IS NULL OR points_b IS NOT NULL)
+), sides AS (
+    SELECT id_team_a AS id_team, id_team_b AS id_opponent, points_a AS points,
+        CASE WHEN points_b IS NULL OR points_a > points_b THEN 1.0
+             WHEN points_a = points_b THEN 0.5
+             ELSE 0.0 END AS wins
+    FROM plays
+    UNION ALL
+    SELECT id_team_b, id_team_a, points_b,
+        CASE WHEN points_b > points_a THEN 1.0
+             WHEN points_b = points_a THEN 0.5
+             ELSE 0.0 END
+    FROM plays
+    WHERE id_team_b IS NOT NULL
+), totals AS (
+    SELECT id_team, SUM(wins) AS wins, SUM(points) AS points
+    FROM sides
+    GROUP BY id_team
+), opponents AS (
+    SELECT sides.id_team,
+        COUNT(*) AS games,
+        SUM(totals.wins) AS buchholz,
+        MAX(totals.wins) AS best,
+        MIN(totals.wins) AS worst,
+        SUM(sides.wins * totals.wins) AS sonneborn_berger
+    FROM sides
+    JOIN totals ON totals.id_team = sides.id_opponent
+    GROUP BY sides.id_team
+), standings AS (
+    SELECT rankings.id_rank,
+        team.id_category,
+        COALESCE(totals.wins, 0.0) AS wins,
+        COALESCE(totals.points, 0) AS points,
+        COALESCE(opponents.buchholz, 0.0) AS buchholz,
+        CASE WHEN opponents.games >= 3
+             THEN opponents.buchholz - opponents.best - opponents.worst
+             ELSE 0.0 END AS median_buchholz,
+        COALESCE(opponents.sonneborn_berger, 0.0) AS sonneborn_berger
+    FROM rankings
+    JOIN team ON team.id_team = rankings.id_team
+    LEFT JOIN totals ON totals.id_team = rankings.id_team
+    LEFT JOIN opponents ON opponents.id_team = rankings.id_team
+), ranked AS (
+    SELECT standings.*,
+        ROW_NUMBER() OVER (
+            {partition}
+            ORDER BY wins DESC, points DESC, buchholz DESC,
+                median_buchholz DESC, sonneborn_berger DESC, id_rank
+        ) AS rank
+    FROM standings
+)
+UPDATE rankings SET
+    rank = ranked.rank,
+    wins = ranked.wins,
+    points = ranked.points,
+    buchholz = ranked.buchholz,
+    median_buchholz = ranked.median_buchholz,
+    sonneborn_berger = ranked.sonneborn_berger
+FROM ranked
+WHERE rankings.id_rank = ranked.id_rank
+"""
+
+# Process pools by number of workers, started on first use and kept for
+# the life of the process, shared by all Turnier instances
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _process_pool(workers):
+    """ The process pool with the given number of workers """
+    with _pools_lock:
+        if workers not in _pools:
+            _pools[workers] = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        return _pools[workers]
+
+def _drop_process_pool(workers, pool):
+    """ Forget a broken process pool, the next call starts a new one """
+    with _pools_lock:
+        if _pools.get(workers) is pool:
+            del _pools[workers]
 
 class Turnier(object):
     """ Encapsulate the turnier logic """
@@ -30,8 +124,16 @@ class Turnier(object):
     # give at least 15 points up to 17 at most for a bye.
     BYE_PLAY_POINTS = 15
 
-    def __init__(self, db):
+    # Fields with fewer teams in total rank and pair faster in this
+    # process than in the process pool, with its pickling of the data
+    POOL_MIN_TEAMS = 2000
+
+    def __init__(self, db, state=None):
         self._db = db
+        self._state = state
+        self._tiebreaks = None
+        # the change counter of the DB the tie-breakers are up to date with
+        self._tiebreaks_counter = None
 
     @property
     def db(self):
@@ -41,184 +143,530 @@ class Turnier(object):
     def play_settings(self):
         return self.db.config.play_settings
 
+    def _reload_state(self):
+        """ Rankings or rounds are rewritten as a whole, load them again """
+        if self._state is not None:
+            self._state.reload()
+
     def init_rankings(self):
         """ Initially clear and regenerate the rankings table """
         with self.db.session_scope() as session:
+            swissturnier.db.bump_change_counter(session)
+            session.query(RankingsHistory).delete()
             session.query(Rankings).delete()
-            teams = session.query(Team).all()
-            # Of course a SQL query can also do this
-            for team in teams:
-                r = Rankings(
-                    id_team=team.id_team,
-                    wins=0,
-                    points=0,
-                )
-                session.add(r)
+            session.execute(Rankings.__table__.insert().from_select(
+                ['id_team', 'wins', 'points'],
+                sqlalchemy.select([Team.id_team, sqlalchemy.literal(0), sqlalchemy.literal(0)])))
+        self._reload_state()
 
     def next_round(self):
         """
         Calculate rankings until current round and then build the next
         round play table.
         """
-        self.rank()
+        with self.db.session_scope() as session:
+            self._rank(session)
         self.generate_round_playplan()
 
     def rank(self, to_round=None):
         """ Calculate rankings until current round """
         with self.db.session_scope() as session:
-            round_count = session.query(PlayRound).distinct(PlayRound.round_number).count()
-            if round_count == 0:
-                return  # no plays yet, nothing to calculate
-
-            if to_round is None or to_round == 0:
-                # rank all plays
-                current_round = swissturnier.db.query_current_round(session)
-            else:
-                current_round = to_round
-
-            # reset wins and points to zero
-            ranks = session.query(Rankings).update({
-                'wins': 0,
-                'points': 0,
-            })
-
-            for play_round in range(1, current_round + 1):
-                plays = session.query(PlayRound).filter_by(round_number=play_round).all()
-                for play in plays:
-                    wins_a, wins_b = self._team_play_wins(play.points_a, play.points_b)
-
-                    rank_a = session.query(Rankings).filter_by(id_team=play.id_team_a).one()
-                    rank_a.points += play.points_a
-                    rank_a.wins += wins_a
-
-                    if play.id_team_b is None:  # byes
-                        continue
-                    rank_b = session.query(Rankings).filter_by(id_team=play.id_team_b).one()
-                    rank_b.points += play.points_b
-                    rank_b.wins += wins_b
-            # sort by wins, then by points
-            for num, rank in enumerate(session.query(Rankings).order_by(sqlalchemy.desc('wins'), sqlalchemy.desc('points')).all()):
-                rank.rank = num + 1
+            self._rank(session, to_round)
+        self._reload_state()
+
+    def _rank(self, session, to_round=None):
+        current_round = swissturnier.db.query_current_round(session)
+        if current_round == 0:
+            return  # no plays yet, nothing to calculate
+        swissturnier.db.bump_change_counter(session)
+
+        if not (to_round is None or to_round == 0):
+            current_round = to_round
+
+        if self.play_settings.ranking_backend == 'sql':
+            self._rank_sql(session, current_round)
+        else:
+            self._rank_standings(session, current_round, to_round)
+        self._snapshot(session, current_round)
+
+    def _rank_standings(self, session, current_round, to_round):
+        """ Rank with the Python or NumPy standings backend """
+        # Load all plays once and sum up in memory
+        plays = self._query_scored_plays(session, current_round)
+        ordered, tiebreaks = self._order_standings(
+            standings.backend(self.play_settings.ranking_backend),
+            plays,
+            self._query_ranking_teams(session))
+        # and write all rows back at once
+        session.bulk_update_mappings(Rankings, [
+            dict(zip(('id_rank', 'id_team', 'wins', 'points') + standings.TIE_BREAKS, row),
+                 rank=num + 1)
+            for partition in ordered
+            for num, row in enumerate(partition)])
+        # keep the tie-breakers for incremental updates of the latest round
+        if to_round in (None, 0):
+            self._keep_tiebreaks(session, tiebreaks)
+        else:
+            self.forget_tiebreaks()
+
+    def _query_ranking_teams(self, session):
+        """ The rankings rows as (id_rank, id_team, id_category) """
+        return (session
+            .query(Rankings.id_rank, Rankings.id_team, Team.id_category)
+            .join(Team, Rankings.id_team == Team.id_team)
+            .order_by(Rankings.id_rank)
+            .all())
+
+    def _order_standings(self, backend, plays, rankings):
+        """
+        Order the rankings rows of each field by wins, points and
+        tie-breakers of the plays with the (accumulate, order) functions
+        of a standings backend
+
+        Returns the ordered partitions as standings.order() rows and the
+        TieBreaks of the plays.
+        """
+        accumulate, order = backend
+        totals = accumulate(plays)
+        tiebreaks = standings.TieBreaks(plays)
+        partitions = self._partition(rankings)
+        # each partition on its own
+        ordered = self._map_partitions(
+            order,
+            partitions,
+            [dict((id_team, totals[id_team])
+                  for (id_rank, id_team) in partition if id_team in totals)
+             for partition in partitions],
+            [tiebreaks.table(id_team for (id_rank, id_team) in partition)
+             for partition in partitions])
+        return ordered, tiebreaks
+
+    def _snapshot(self, session, round_number):
+        """
+        Keep the rankings as the standings after a round, but only once
+        all plays up to this round are scored
+        """
+        history = RankingsHistory.__table__
+        session.execute(history.delete().where(history.c.round_number == round_number))
+        unscored = (sqlalchemy.exists()
+            .where(PlayRound.round_number <= round_number)
+            .where(self._unscored_filter()))
+        columns = ['id_team', 'rank', 'wins', 'points'] + list(standings.TIE_BREAKS)
+        session.execute(history.insert().from_select(
+            ['round_number'] + columns,
+            sqlalchemy.select(
+                [sqlalchemy.literal(round_number)]
+                + [getattr(Rankings, name) for name in columns]
+            ).where(~unscored)))
+
+    def _rebuild_snapshots(self, session, first_round, last_round):
+        """
+        Calculate the snapshots of the rounds first_round to last_round
+        again after a result of one of them changed, all from the plays
+        loaded once. Rounds with unscored plays get none, as in
+        _snapshot().
+        """
+        if first_round > last_round:
+            return
+        plays = (session
+            .query(
+                PlayRound.round_number,
+                PlayRound.id_team_a,
+                PlayRound.id_team_b,
+                PlayRound.points_a,
+                PlayRound.points_b)
+            .filter(PlayRound.round_number <= last_round)
+            .all())
+        rankings = self._query_ranking_teams(session)
+        # the same standings as the SQL backend ranks in the DB
+        backend = standings.backend(
+            'python' if self.play_settings.ranking_backend == 'sql'
+            else self.play_settings.ranking_backend)
+        rows = []
+        for round_number in range(first_round, last_round + 1):
+            round_plays = [tuple(play[1:]) for play in plays if play.round_number <= round_number]
+            if not all(standings.is_scored(*play[1:]) for play in round_plays):
+                break  # the later rounds are not complete either
+            ordered, tiebreaks = self._order_standings(backend, round_plays, rankings)
+            rows.extend(
+                dict(zip(('id_team', 'wins', 'points') + standings.TIE_BREAKS, row[1:]),
+                     round_number=round_number, rank=num + 1)
+                for partition in ordered
+                for num, row in enumerate(partition))
+        history = RankingsHistory.__table__
+        session.execute(history.delete()
+            .where(history.c.round_number >= first_round)
+            .where(history.c.round_number <= last_round))
+        if rows:
+            session.execute(history.insert(), rows)
+
+    def _unscored_filter(self):
+        """ Filter plays without a result, byes only need points of team A """
+        return sqlalchemy.or_(
+            PlayRound.points_a == None,
+            sqlalchemy.and_(PlayRound.id_team_b != None, PlayRound.points_b == None))
+
+    def _rank_sql(self, session, to_round):
+        """ Sum up and rank in the DB, one statement whatever the field size """
+        partition = 'PARTITION BY id_category' if self.play_settings.by_category else ''
+        session.execute(
+            sqlalchemy.text(RANK_SQL.format(partition=partition)),
+            {'to_round': to_round})
+        # the tie-breakers are loaded again on the next incremental update
+        self.forget_tiebreaks()
+
+    def _query_scored_plays(self, session, to_round=None):
+        """ Load the plays with a result as (id_team_a, id_team_b, points_a, points_b) """
+        query = (session
+            .query(
+                PlayRound.id_team_a,
+                PlayRound.id_team_b,
+                PlayRound.points_a,
+                PlayRound.points_b)
+            .filter(PlayRound.points_a != None))
+        if to_round is not None:
+            query = query.filter(PlayRound.round_number <= to_round)
+        return query.all()
+
+    def _partition(self, rows):
+        """
+        Split rows of (..., id_category) into the fields ranked and paired
+        independently: all teams or one field for each category.
+
+        The category is stripped from the rows, the row order is kept.
+        """
+        if not self.play_settings.by_category:
+            return [[row[:-1] for row in rows]]
+        partitions = {}
+        for row in rows:
+            partitions.setdefault(row[-1], []).append(row[:-1])
+        return [partitions[id_category] for id_category in sorted(partitions)]
+
+    def _map_partitions(self, func, *partitions):
+        """
+        Call func for each partition, concurrently in the process pool if
+        there is more than one, more than one worker and enough teams
+        """
+        workers = self.play_settings.workers
+        teams = sum(len(partition) for partition in partitions[0])
+        if len(partitions[0]) < 2 or workers == 1 or teams < self.POOL_MIN_TEAMS:
+            return list(map(func, *partitions))
+        pool = _process_pool(workers)
+        try:
+            return list(pool.map(func, *partitions))
+        except concurrent.futures.BrokenExecutor:
+            # a worker died, e.g. killed for its memory
+            _drop_process_pool(workers, pool)
+            return list(map(func, *partitions))
+
+    def update_play_result(self, session, play, points_a, points_b):
+        """
+        Enter the result of a play and update the rankings incrementally
+
+        Only the difference to the former result is applied to the rankings
+        of both teams. The tie-breakers of both teams and their opponents
+        are adjusted through the TieBreaks cache. Then the ranks are
+        reordered between the old and the new positions of the changed
+        teams, the other ranks stay untouched.
+
+        Returns the changed rankings rows or None if all rankings were
+        calculated from scratch.
+        """
+        swissturnier.db.bump_change_counter(session)
+        old_points = (play.points_a, play.points_b)
+        old_a, old_b = standings.play_totals(play.id_team_b, *old_points)
+        new_a, new_b = standings.play_totals(play.id_team_b, points_a, points_b)
+
+        deltas = {
+            play.id_team_a: (new_a[0] - old_a[0], new_a[1] - old_a[1]),
+        }
+        if play.id_team_b is not None:
+            deltas[play.id_team_b] = (new_b[0] - old_b[0], new_b[1] - old_b[1])
+        if all(delta == (0, 0) for delta in deltas.values()):
+            play.points_a = points_a
+            play.points_b = points_b
+            return []
+        # the snapshots from this round on don't hold anymore
+        (session.query(RankingsHistory)
+            .filter(RankingsHistory.round_number >= play.round_number)
+            .delete(synchronize_session=False))
+
+        with session.no_autoflush:
+            ranks = (session
+                .query(Rankings)
+                .filter(Rankings.id_team.in_(list(deltas.keys())))
+                .all())
+            missing = len(ranks) != len(deltas) or any(rank.rank is None for rank in ranks)
+            if not missing:
+                tiebreaks = self._query_tiebreaks(session, ranks)
+        play.points_a = points_a
+        play.points_b = points_b
+        if missing:
+            # rankings never calculated, there is nothing to update locally
+            session.flush()
+            self._rank(session)
+            self._rebuild_snapshots(session, play.round_number,
+                                    swissturnier.db.query_current_round(session) - 1)
+            return None
+
+        updated = dict((rank.id_rank, rank) for rank in ranks)
+        self._keep_tiebreaks(session, tiebreaks)
+        for rank in ranks:
+            wins, points = deltas[rank.id_team]
+            rank.wins += wins
+            rank.points += points
+        changed = tiebreaks.update_play(
+            play.id_team_a, play.id_team_b, old_points, (points_a, points_b))
+        ranks = (session
+            .query(Rankings)
+            .filter(Rankings.id_team.in_(list(changed)))
+            .all())
+        for rank in ranks:
+            (rank.buchholz,
+             rank.median_buchholz,
+             rank.sonneborn_berger) = tiebreaks.values(rank.id_team)
+        session.flush()
+
+        fields = {}
+        for rank in ranks:
+            fields.setdefault(self._query_field(session, rank), []).append(rank)
+        for field, field_ranks in fields.items():
+            positions = [rank.rank for rank in field_ranks]
+            positions.extend([self._query_rank_position(session, field, rank)
+                              for rank in field_ranks])
+            for rank in self._reorder_ranks(session, field, min(positions), max(positions)):
+                updated[rank.id_rank] = rank
+        updated.update((rank.id_rank, rank) for rank in ranks)
+        session.flush()
+        # the rankings are the standings after the latest round, the
+        # rounds before get theirs from the plays
+        current_round = swissturnier.db.query_current_round(session)
+        self._rebuild_snapshots(session, play.round_number, current_round - 1)
+        self._snapshot(session, current_round)
+        return list(updated.values())
+
+    def update_round_results(self, session, round_number, results):
+        """
+        Enter the results of many plays of a round at once
+
+        results are (id_playround, points_a, points_b) tuples. The points
+        are written with one bulk update, then the rankings are
+        calculated once for all of them. Raises ValueError if a play is
+        not part of the round or a bye gets points_b.
+
+        Returns the column values of the updated plays as dicts.
+        """
+        ids = [id_playround for id_playround, points_a, points_b in results]
+        if len(set(ids)) != len(ids):
+            raise ValueError("A play is entered more than once")
+        columns = list(PlayRound.__table__.columns)
+        plays = dict((row.id_playround, dict(zip([c.name for c in columns], row)))
+                     for row in session.query(*columns).filter(PlayRound.id_playround.in_(ids)))
+        for id_playround, points_a, points_b in results:
+            play = plays.get(id_playround)
+            if play is None or play['round_number'] != round_number:
+                raise ValueError("Play {} is not in round {}".format(id_playround, round_number))
+            if play['id_team_b'] is None and points_b is not None:
+                raise ValueError("Play {} is a bye without points_b".format(id_playround))
+            play['points_a'] = points_a
+            play['points_b'] = points_b
+        if not plays:
+            return []
+
+        swissturnier.db.bump_change_counter(session)
+        session.bulk_update_mappings(PlayRound, [
+            dict(id_playround=id_playround, points_a=points_a, points_b=points_b)
+            for id_playround, points_a, points_b in results])
+        # the snapshots from this round on don't hold anymore
+        (session.query(RankingsHistory)
+            .filter(RankingsHistory.round_number >= round_number)
+            .delete(synchronize_session=False))
+        # one ranking for all, not an incremental update per play
+        self._rank(session)
+        self._rebuild_snapshots(
+            session, round_number, swissturnier.db.query_current_round(session) - 1)
+        return [plays[id_playround] for id_playround in ids]
+
+    def _query_tiebreaks(self, session, ranks):
+        """
+        The tie-breaker cache, loaded from all scored plays if there is
+        none yet, another process wrote since it was kept or it doesn't
+        match the wins of the given rankings rows
+        """
+        counter = swissturnier.db.bump_change_counter(session)
+        tiebreaks = self._tiebreaks
+        # kept by the last write before this transaction or within it
+        if (tiebreaks is None
+                or self._tiebreaks_counter not in (counter - 1, counter)
+                or any(tiebreaks.wins(rank.id_team) != rank.wins for rank in ranks)):
+            tiebreaks = standings.TieBreaks(self._query_scored_plays(session))
+            self._keep_tiebreaks(session, tiebreaks)
+        return tiebreaks
+
+    def _keep_tiebreaks(self, session, tiebreaks):
+        """ Cache the tie-breakers as of the change counter of this transaction """
+        self._tiebreaks = tiebreaks
+        self._tiebreaks_counter = swissturnier.db.bump_change_counter(session)
+        # the cache holds results of the session, they may not be committed
+        sqlalchemy.event.listen(session, 'after_rollback',
+                                lambda session: self.forget_tiebreaks(), once=True)
+
+    def forget_tiebreaks(self):
+        """ Load the tie-breakers again on the next incremental update """
+        self._tiebreaks = None
+        self._tiebreaks_counter = None
+
+    def _query_field(self, session, rank):
+        """
+        The category ranked together with this rankings row or None if
+        all teams are ranked together
+        """
+        if not self.play_settings.by_category:
+            return None
+        return session.query(Team.id_category).filter_by(id_team=rank.id_team).scalar()
+
+    def _field_filter(self, session, field):
+        """ Filter rankings to the teams ranked together """
+        if field is None:
+            return sqlalchemy.true()
+        return Rankings.id_team.in_(
+            session.query(Team.id_team).filter(Team.id_category == field))
+
+    def _query_rank_position(self, session, field, rank):
+        """ Position of a rankings row given the sort keys of all others """
+        # ahead is who has a higher value in one column and the same in all
+        # columns before, see standings.sort_key()
+        ahead = []
+        equal = []
+        for name in ('wins', 'points') + standings.TIE_BREAKS:
+            column = getattr(Rankings, name)
+            ahead.append(sqlalchemy.and_(*(equal + [column > getattr(rank, name)])))
+            equal.append(column == getattr(rank, name))
+        ahead.append(sqlalchemy.and_(*(equal + [Rankings.id_rank < rank.id_rank])))
+        count = (session.query(Rankings)
+            .filter(self._field_filter(session, field))
+            .filter(sqlalchemy.or_(*ahead))
+            .count())
+        return count + 1
+
+    def _reorder_ranks(self, session, field, first, last):
+        """ Sort the rankings rows between two ranks (inclusive), returns them """
+        ranks = (session.query(Rankings)
+            .filter(self._field_filter(session, field))
+            .filter(Rankings.rank >= first)
+            .filter(Rankings.rank <= last)
+            .all())
+        ranks.sort(key=lambda rank: standings.sort_key(
+            rank.wins, rank.points, rank.buchholz, rank.median_buchholz,
+            rank.sonneborn_berger, rank.id_rank))
+        for num, rank in enumerate(ranks):
+            rank.rank = first + num
+        return ranks
 
     def _team_play_wins(self, points_a, points_b):
         """ Winning a game get one point, drawn get a half point """
-        if points_b is None:  # bye
-            return (1.0, 0.0)
-        elif points_a == points_b:
-            return (0.5, 0.5)
-        elif points_a > points_b:
-            return (1.0, 0.0)
-        else:
-            return (0.0, 1.0)
+        return standings.play_wins(points_a, points_b)
+
+    def missing_plays(self, to_round=None):
+        """
+        Plays up to a round (default the current one) without a result
 
-    def check_complete(self, to_round):
+        Returns a list of (id_playround, round_number, id_team_a,
+        id_team_b) tuples, all found with one query on the round index.
+        """
         with self.db.session_scope() as session:
-            missing_a = session.query(PlayRound).filter_by(points_a=None).count()
-            missing_b = session.query(PlayRound).filter_by(points_b=None).count()
-            return (missing_a == 0 or missing_b <= 1)
+            query = (session
+                .query(
+                    PlayRound.id_playround,
+                    PlayRound.round_number,
+                    PlayRound.id_team_a,
+                    PlayRound.id_team_b)
+                .filter(self._unscored_filter()))
+            if not (to_round is None or to_round == 0):
+                query = query.filter(PlayRound.round_number <= to_round)
+            return [tuple(play) for play in
+                    query.order_by(PlayRound.round_number, PlayRound.id_playround)]
+
+    def check_complete(self, to_round=None):
+        """ Whether all plays up to a round (default the current one) have a result """
+        return not self.missing_plays(to_round)
 
     def generate_round_playplan(self):
         """ Assing teams for the next round of play """
         with self.db.session_scope() as session:
             current_round = swissturnier.db.query_current_round(session)
-            team_count = swissturnier.db.query_team_count(session)
 
-            ranks = session.query(Rankings).order_by('rank').all()
+            ranks = (session
+                .query(Rankings.id_team, Team.id_category)
+                .join(Team, Rankings.id_team == Team.id_team)
+                .order_by(Rankings.rank, Rankings.id_rank)
+                .all())
+            history = self._query_pairing_history(session)
+            partitions = [[id_team for (id_team,) in partition]
+                          for partition in self._partition(ranks)]
+            results = self._map_partitions(
+                pair_round,
+                partitions,
+                len(partitions) * [history],
+                len(partitions) * [self.play_settings.pairing])
+
+            # The fields share the courts, their best teams play first
+            pairings = []
+            for nth in range(max([len(result[1]) for result in results], default=0)):
+                for id_team_bye, field_pairings in results:
+                    if nth < len(field_pairings):
+                        pairings.append(field_pairings[nth])
+
+            last_start_time = (session
+                .query(sqlalchemy.func.max(PlayRound.start_time))
+                .filter(PlayRound.round_number == current_round)
+                .scalar())
+            slots = Scheduler(self.play_settings).round_slots(
+                len(pairings), last_start_time)
+
+            plays = []
+            for (id_team_a, id_team_b), (start_time, court) in zip(pairings, slots):
+                plays.append(dict(
+                    round_number=(current_round + 1),
+                    id_team_a=id_team_a,
+                    id_team_b=id_team_b,
+                    start_time=start_time,
+                    court=court,
+                    points_a=None,
+                ))
+
             # check for byes
-            byeplay = None
-            if len(ranks) % 2 != 0:
-                team_a = self._find_bye_candidates(session, ranks)
-                byeplay = PlayRound(
+            for id_team_bye, field_pairings in results:
+                if id_team_bye is None:
+                    continue
+                plays.append(dict(
                     round_number=(current_round + 1),
-                    id_team_a=team_a.id_team,
+                    id_team_a=id_team_bye,
                     id_team_b=None,
-                    points_a = self.BYE_PLAY_POINTS
-                )
-
-            round_nth_play = 1
-            while len(ranks) > 1:
-                team_a = ranks.pop(0)
-                team_b = self._find_new_pairing(session, ranks, team_a)
-                start_time = self._calculate_play_starttime(
-                    current_round,
-                    round_nth_play,
-                    team_count
-                )
-                play = PlayRound(
-                    round_number=(current_round + 1),
-                    id_team_a=team_a.id_team,
-                    id_team_b=team_b.id_team,
-                    start_time=start_time,
-                    court=self._assign_court(round_nth_play)
-                )
-                session.add(play)
-                round_nth_play += 1
-
-            if not byeplay is None:
-                session.add(byeplay)
-
-    def _find_bye_candidates(self, session, ranks):
-        index = len(ranks) - 1
-        while index > 0:
-            count = self._query_byes_by_team(session, ranks[index].team)
-            if count == 0:
-                break
-            index -= 1
-        else:
-            raise Exception("Couldn't find a team without a bye")
-        return ranks.pop(index)
-
-    def _query_byes_by_team(self, session, team):
-        """ Query byes played by a given team """
-        return (session.query(PlayRound)
-            .filter_by(id_team_a=team.id_team)
-            .filter_by(id_team_b=None)
-            .count())
+                    start_time=None,
+                    court=None,
+                    points_a=None,
+                ))
+
+            # the whole round in one executemany, not a flush per play
+            if plays:
+                swissturnier.db.bump_change_counter(session)
+                session.execute(PlayRound.__table__.insert(), plays)
+
+            # a bye counts like a won play, it is entered as its result to
+            # update the rankings and tie-breakers as well
+            byes = (session
+                .query(PlayRound)
+                .filter(PlayRound.round_number == current_round + 1)
+                .filter(PlayRound.id_team_b == None)
+                .all())
+            for play in byes:
+                self.update_play_result(session, play, self.BYE_PLAY_POINTS, None)
+        self._reload_state()
 
-    def _find_new_pairing(self, session, ranks, team):
-        """ find another team which has not played with this team before """
-        idx = 0
-        while self._has_former_pairing(session, team, ranks[idx]):
-            idx += 1
-        return ranks.pop(idx)
-
-    def _has_former_pairing(self, session, team1, team2):
-        """ check if two teams have already played against before """
-        return (session.query(PlayRound)
-            .filter(
-                sqlalchemy.or_(
-                    sqlalchemy.and_(
-                        PlayRound.id_team_a == team1.id_team,
-                        PlayRound.id_team_b == team2.id_team),
-                    sqlalchemy.and_(
-                        PlayRound.id_team_a == team2.id_team,
-                        PlayRound.id_team_b == team1.id_team)
-                )
-            ).count() > 0)
-
-    def _calculate_play_starttime(self, current_round, round_nth_play, team_count):
-        start_time = self.play_settings.start_time
-        play_time = self.play_settings.play_time
-        rotation_time = self.play_settings.rotation_time
-        pause_time = self.play_settings.pause_time
-        courts = self.play_settings.courts
-
-        # team_count halved equals the pairings and therefore plays.
-        # Divided by courts we have the number of plays for each round
-        # that are not at the same time:
-        round_timeslots = int(math.ceil(math.floor(team_count / 2.0) / courts))
-        # Each round duration is the play time plus rotation time times
-        # the number of time slots:
-        round_time = round_timeslots * (play_time + rotation_time) + pause_time
-        # Once we know the round time we are able to calculate the time
-        # a round starts:
-        round_start_time = start_time + current_round * round_time
-        # With all above we can calculate the start time of the play:
-        play_start_time = round_start_time + math.floor(float(round_nth_play - 1) / courts) * (play_time + rotation_time)
-
-        return play_start_time
-
-    def _assign_court(self, round_nth_play):
-        courts = self.play_settings.courts
-        court_number = (round_nth_play - 1) % courts
-        return chr(ord('A') + court_number)
+    def _query_pairing_history(self, session):
+        """ Load all former pairings and byes at once """
+        plays = (session
+            .query(PlayRound.id_team_a, PlayRound.id_team_b)
+            .all())
+        return PairingHistory(plays)
@@ -17,33 +17,39 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import collections
+import glob
+import threading
 import Cheetah.Template
 import sqlalchemy
 import swissturnier.db
 from swissturnier.db import PlayRound, Rankings
 
 class Report(object):
-    def __init__(self, db):
+    """
+    A report from the DB or, if given, from the in-memory state of the
+    turnier in swissturnier.state.TurnierState
+    """
+    def __init__(self, db, state=None):
         self._db = db
+        self._state = state
 
     @property
     def db(self):
         return self._db
 
     @property
-    def config(self):
-        return self.db.config
+    def state(self):
+        return self._state
 
+    def _query_current_round(self, session):
+        if self.state is not None:
+            return self.state.current_round()
+        return swissturnier.db.query_current_round(session)
 
-class ConsoleRankingTableReport(Report):
-    def print(self, output):
-        with self.db.session_scope() as session:
-            current_round = swissturnier.db.query_current_round(session)
-            output.write('Current round: {}\n'.format(current_round))
-            ranks = session.query(Rankings).order_by('rank').all()
-            output.write('Ranks: {}\n'.format(len(ranks)))
-            for rank in ranks:
-                output.write("{0.rank:>3} {0.wins:>2} {0.points:>4} {0.team.name}\n".format(rank))
+    @property
+    def config(self):
+        return self.db.config
 
 
 class RoundNumberMixin(object):
@@ -59,17 +65,66 @@ class RoundNumberMixin(object):
         self._round_number = value
 
 
-class ConsolePlayTableReport(Report, RoundNumberMixin):
-    def __init__(self, db):
-        super(ConsolePlayTableReport, self).__init__(db)
+class RankingsMixin(RoundNumberMixin):
+    """ The current rankings or the snapshot after the selected round """
+    def _query_rankings(self, session):
+        if self.round_number is None and self.state is not None:
+            return (self.state.current_round(), self.state.rankings())
+        if self.round_number is None:
+            current_round = swissturnier.db.query_current_round(session)
+            ranks = (session
+                .query(Rankings)
+                .options(sqlalchemy.orm.joinedload(Rankings.team))
+                .order_by('rank')
+                .all())
+            return (current_round, ranks)
+        ranks = swissturnier.db.query_round_rankings(session, self.round_number)
+        return (self.round_number, ranks)
+
+
+class ConsoleRankingTableReport(Report, RankingsMixin):
+    def __init__(self, db, state=None):
+        super(ConsoleRankingTableReport, self).__init__(db, state)
         self._init_round()
 
     def print(self, output):
         with self.db.session_scope() as session:
-            query = session.query(PlayRound)
-            if not self.round_number is None:
-                query = query.filter_by(round_number=self.round_number)
-            plays = query.order_by('round_number', 'start_time', 'id_playround').all()
+            current_round, ranks = self._query_rankings(session)
+            output.write('Current round: {}\n'.format(current_round))
+            output.write('Ranks: {}\n'.format(len(ranks)))
+            for rank in ranks:
+                output.write("{0.rank:>3} {0.wins:>2} {0.points:>4} {0.team.name}\n".format(rank))
+
+
+class PlaysMixin(RoundNumberMixin):
+    """ The plays of all or the selected round """
+    def _query_plays(self, session):
+        if self.state is not None:
+            plays = self.state.plays(self.round_number)
+            # no start time (byes) first as SQLite orders them
+            plays.sort(key=lambda play: (
+                play.round_number,
+                play.start_time is not None,
+                play.start_time or 0,
+                play.id_playround))
+            return plays
+        # both teams come with the plays, not with a query per play
+        query = session.query(PlayRound).options(
+            sqlalchemy.orm.joinedload(PlayRound.team_a),
+            sqlalchemy.orm.joinedload(PlayRound.team_b))
+        if not self.round_number is None:
+            query = query.filter_by(round_number=self.round_number)
+        return query.order_by('round_number', 'start_time', 'id_playround').all()
+
+
+class ConsolePlayTableReport(Report, PlaysMixin):
+    def __init__(self, db, state=None):
+        super(ConsolePlayTableReport, self).__init__(db, state)
+        self._init_round()
+
+    def print(self, output):
+        with self.db.session_scope() as session:
+            plays = self._query_plays(session)
             for play in plays:
                 output.write((
                         "{play.round_number:<2} "
@@ -88,38 +143,116 @@ class ConsolePlayTableReport(Report, RoundNumberMixin):
                 )
 
 
+class TemplateCache(object):
+    """
+    Cheetah templates compiled to Python classes once per file, compiled
+    again when the file is modified. Rendering only fills the namespace.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._classes = {}
+
+    def get(self, path):
+        """ The compiled template class of the file """
+        mtime = os.stat(path).st_mtime_ns
+        with self._lock:
+            cached = self._classes.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with open(path, 'r', encoding='UTF-8') as f:
+            source = f.read()
+        template_class = Cheetah.Template.Template.compile(source=source)
+        with self._lock:
+            self._classes[path] = (mtime, template_class)
+        return template_class
+
+    def render(self, path, namespace):
+        return str(self.get(path)(searchList=[namespace]))
+
+    def compile(self, path='reports/'):
+        """ Compile all templates below path ahead, returns their paths """
+        paths = sorted(glob.glob(os.path.join(path, '**', '*.tmpl'), recursive=True)
+                       + glob.glob(os.path.join(path, '**', '*.html'), recursive=True))
+        for template_path in paths:
+            self.get(template_path)
+        return paths
+
+# shared by all reports of the process
+templates = TemplateCache()
+
+
+class OutputCache(object):
+    """
+    Rendered reports by key, the least recently used are evicted when
+    there are more than size
+    """
+    SIZE = 32
+
+    def __init__(self, size=SIZE):
+        self._lock = threading.Lock()
+        self._size = size
+        self._outputs = collections.OrderedDict()
+
+    def get(self, key, render):
+        """ The output cached for key or the result of render() """
+        with self._lock:
+            if key in self._outputs:
+                self._outputs.move_to_end(key)
+                return self._outputs[key]
+        output = render()
+        with self._lock:
+            self._outputs[key] = output
+            while len(self._outputs) > self._size:
+                self._outputs.popitem(last=False)
+        return output
+
+    def invalidate(self):
+        with self._lock:
+            self._outputs.clear()
+
+    def __len__(self):
+        return len(self._outputs)
+
+
 class CheetahReport(Report):
-    def __init__(self, db, path='reports/', filename='report.tmpl'):
-        super(CheetahReport, self).__init__(db)
+    def __init__(self, db, state=None, path='reports/', filename='report.tmpl'):
+        super(CheetahReport, self).__init__(db, state)
         self._path = path
         self._filename = filename
+        # served by swissturnier.aioapi, the page follows its /v1/events
+        self.live_events = False
 
     def get_namespace(self):
         pass
 
     def create(self):
+        if self.state is None:
+            return self._render()
+        # same for all viewers until the turnier changes, checked before
+        # rendering the records in a session
+        etag, modified = self.state.validators()
+        key = (type(self).__name__, getattr(self, 'round_number', None),
+               self.live_events, etag)
+        return self.state.output_cache.get(key, self._render)
+
+    def _render(self):
         with self.db.session_scope() as session:
             path = os.path.join(self._path, self._filename)
-            #tmpl = open(path, 'r').read().decode('utf-8') # TODO encoding
-            tmpl = open(path, 'r').read()
             ns = self.get_namespace(session)
-            result = Cheetah.Template.Template(tmpl, searchList=[ns])
-            return str(result)
+            ns['live_events'] = self.live_events
+            return templates.render(path, ns)
 
 
-class HTMLPlayTable(CheetahReport, RoundNumberMixin):
+class HTMLPlayTable(CheetahReport, PlaysMixin):
     TITLE = 'Spielplan Badmintonturnier'
 
-    def __init__(self, db):
-        super(HTMLPlayTable, self).__init__(db, filename='playtable.tmpl')
+    def __init__(self, db, state=None):
+        super(HTMLPlayTable, self).__init__(db, state, filename='playtable.tmpl')
         self._init_round()
 
     def get_namespace(self, session):
-        current_round = swissturnier.db.query_current_round(session)
-        query = session.query(PlayRound)
-        if not self.round_number is None:
-            query = query.filter_by(round_number=self.round_number)
-        plays = query.order_by('round_number', 'start_time', 'id_playround').all()
+        current_round = self._query_current_round(session)
+        plays = self._query_plays(session)
         rounds = [list() for x in range(0, current_round + 1)]
         for play in plays:
             rounds[play.round_number].append(play)
@@ -131,15 +264,15 @@ class HTMLPlayTable(CheetahReport, RoundNumberMixin):
         }
 
 
-class HTMLRankingTableReport(CheetahReport):
+class HTMLRankingTableReport(CheetahReport, RankingsMixin):
     TITLE = 'Rangliste Badmintonturnier'
 
-    def __init__(self, db):
-        super(HTMLRankingTableReport, self).__init__(db, filename='ranking.tmpl')
+    def __init__(self, db, state=None):
+        super(HTMLRankingTableReport, self).__init__(db, state, filename='ranking.tmpl')
+        self._init_round()
 
     def get_namespace(self, session):
-        current_round = swissturnier.db.query_current_round(session)
-        ranks = session.query(Rankings).order_by('rank').all()
+        current_round, ranks = self._query_rankings(session)
         return {
             'title': self.TITLE,
             'current_round': current_round,
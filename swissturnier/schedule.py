@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2020 Andreas Stricker <andy@knitter.ch>
+#
+# This file is part of SwissTurnier.
+#
+# SwissTurnier is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Court and time slot scheduling of a play round
+
+The courts are modelled as a timeline: each court is free from some
+point in time on. A play takes the court that is free first, which then
+is busy for the play time and the rotation to the next teams.
+
+A round starts once the previous round is over and the pause is done,
+so late or moved plays shift the next round instead of overlapping it.
+"""
+
+import heapq
+
+def court_name(court):
+    """ Courts are named A, B, C, ... """
+    return chr(ord('A') + court)
+
+class CourtTimeline(object):
+    """ Free times of all courts, earliest first """
+
+    def __init__(self, courts, start_time, slot_time):
+        # (free_time, court) for each court, ordered as a heap
+        self._free = [(start_time, court) for court in range(courts)]
+        heapq.heapify(self._free)
+        self._slot_time = slot_time
+
+    def assign(self):
+        """ Book the earliest free court, returns (start_time, court) """
+        free_time, court = heapq.heappop(self._free)
+        heapq.heappush(self._free, (free_time + self._slot_time, court))
+        return (free_time, court_name(court))
+
+    def slot_table(self, count):
+        """ Book count plays, returns a list of (start_time, court) """
+        return [self.assign() for num in range(count)]
+
+    @property
+    def end_time(self):
+        """ When all courts are free again """
+        return max(free_time for free_time, court in self._free)
+
+class Scheduler(object):
+    """ Plan start times and courts of the plays of a round """
+
+    def __init__(self, play_settings):
+        self._settings = play_settings
+
+    @property
+    def slot_time(self):
+        """ Time a play occupies a court """
+        return self._settings.play_time + self._settings.rotation_time
+
+    def round_start(self, last_start_time=None):
+        """
+        Start time of a round given the latest start time of the plays
+        of the previous round or None for the first round
+        """
+        if last_start_time is None:
+            return self._settings.start_time
+        return last_start_time + self.slot_time + self._settings.pause_time
+
+    def round_slots(self, count, last_start_time=None):
+        """ The (start_time, court) slots of a round of count plays """
+        timeline = CourtTimeline(
+            self._settings.courts,
+            self.round_start(last_start_time),
+            self.slot_time)
+        return timeline.slot_table(count)
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2020 Andreas Stricker <andy@knitter.ch>
+#
+# This file is part of SwissTurnier.
+#
+# SwissTurnier is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Standings calculation on plain Python data
+
+The functions in here don't touch the DB. They work on play tuples
+(id_team_a, id_team_b, points_a, points_b) as loaded by a single query
+and return dicts keyed by team id.
+
+There are two backends with the same results: plain Python and NumPy
+arrays for big fields and simulations (if NumPy is installed).
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def play_wins(points_a, points_b):
+    """ Winning a game get one point, drawn get a half point """
+    if points_b is None:  # bye
+        return (1.0, 0.0)
+    elif points_a == points_b:
+        return (0.5, 0.5)
+    elif points_a > points_b:
+        return (1.0, 0.0)
+    else:
+        return (0.0, 1.0)
+
+def is_scored(id_team_b, points_a, points_b):
+    """ A play counts once all its points are entered, byes only need A """
+    if points_a is None:
+        return False
+    return id_team_b is None or points_b is not None
+
+def play_totals(id_team_b, points_a, points_b):
+    """
+    Wins and points a play adds to team A and team B
+
+    Returns ((wins_a, points_a), (wins_b, points_b)), all zero as long as
+    the play is not scored.
+    """
+    if not is_scored(id_team_b, points_a, points_b):
+        return ((0.0, 0), (0.0, 0))
+    wins_a, wins_b = play_wins(points_a, points_b)
+    if id_team_b is None:  # byes
+        return ((wins_a, points_a), (0.0, 0))
+    return ((wins_a, points_a), (wins_b, points_b))
+
+def accumulate(plays):
+    """
+    Sum up wins and points for each team of the given plays
+
+    Returns a dict id_team -> [wins, points]. Unscored plays are skipped.
+    """
+    totals = {}
+    for id_team_a, id_team_b, points_a, points_b in plays:
+        if not is_scored(id_team_b, points_a, points_b):
+            continue
+        result_a, result_b = play_totals(id_team_b, points_a, points_b)
+        total = totals.setdefault(id_team_a, [0.0, 0])
+        total[0] += result_a[0]
+        total[1] += result_a[1]
+        if id_team_b is None:  # byes
+            continue
+        total = totals.setdefault(id_team_b, [0.0, 0])
+        total[0] += result_b[0]
+        total[1] += result_b[1]
+    return totals
+
+# Tie-breaker columns of a rankings row in the order they are applied
+TIE_BREAKS = ('buchholz', 'median_buchholz', 'sonneborn_berger')
+
+class TieBreaks(object):
+    """
+    Cache of the Buchholz and Sonneborn-Berger sums of each team
+
+    For each team the wins and the plays against every opponent are kept.
+    When a play result changes only the sums of both teams and of their
+    opponents are adjusted, nobody's history is scanned again.
+
+    Buchholz is the sum of the opponents' wins. Median-Buchholz drops the
+    best and the worst opponent. Sonneborn-Berger weighs each opponent's
+    wins with the wins of the team against that opponent. Only scored
+    plays count, byes add wins but no opponent.
+    """
+
+    def __init__(self, plays=()):
+        self._wins = {}
+        # id_team -> id_opponent -> [plays, wins against the opponent]
+        self._opponents = {}
+        self._buchholz = {}
+        self._sonneborn_berger = {}
+        for id_team_a, id_team_b, points_a, points_b in plays:
+            if not is_scored(id_team_b, points_a, points_b):
+                continue
+            wins_a, wins_b = play_wins(points_a, points_b)
+            self._wins[id_team_a] = self._wins.get(id_team_a, 0.0) + wins_a
+            if id_team_b is None:  # byes
+                continue
+            self._wins[id_team_b] = self._wins.get(id_team_b, 0.0) + wins_b
+            self._meet(id_team_a, id_team_b, 1, wins_a)
+            self._meet(id_team_b, id_team_a, 1, wins_b)
+        for id_team, opponents in self._opponents.items():
+            self._buchholz[id_team] = sum(
+                count * self.wins(id_opponent)
+                for id_opponent, (count, wins) in opponents.items())
+            self._sonneborn_berger[id_team] = sum(
+                wins * self.wins(id_opponent)
+                for id_opponent, (count, wins) in opponents.items())
+
+    def _meet(self, id_team, id_opponent, count, wins):
+        """ Add (or remove with negative values) plays against an opponent """
+        opponents = self._opponents.setdefault(id_team, {})
+        played = opponents.setdefault(id_opponent, [0, 0.0])
+        played[0] += count
+        played[1] += wins
+        if played[0] == 0:
+            del opponents[id_opponent]
+
+    def _add_sums(self, id_team, id_opponent, count, wins):
+        """ Adjust the sums of a team for plays against an opponent """
+        opponent_wins = self.wins(id_opponent)
+        self._buchholz[id_team] = (
+            self._buchholz.get(id_team, 0.0) + count * opponent_wins)
+        self._sonneborn_berger[id_team] = (
+            self._sonneborn_berger.get(id_team, 0.0) + wins * opponent_wins)
+
+    def _add_wins(self, id_team, wins):
+        """ Change the wins of a team and the sums of its opponents """
+        self._wins[id_team] = self.wins(id_team) + wins
+        for id_opponent in self._opponents.get(id_team, {}):
+            count, opponent_wins = self._opponents[id_opponent][id_team]
+            self._buchholz[id_opponent] += count * wins
+            self._sonneborn_berger[id_opponent] += opponent_wins * wins
+
+    def update_play(self, id_team_a, id_team_b, old_points, new_points):
+        """
+        Replace the result of a play, both given as (points_a, points_b)
+
+        Returns the set of teams whose wins or tie-breakers changed.
+        """
+        old_a, old_b = play_totals(id_team_b, *old_points)
+        new_a, new_b = play_totals(id_team_b, *new_points)
+        old_scored = is_scored(id_team_b, *old_points)
+        new_scored = is_scored(id_team_b, *new_points)
+        if id_team_b is None:  # byes
+            self._add_wins(id_team_a, new_a[0] - old_a[0])
+            return set([id_team_a]) | set(self._opponents.get(id_team_a, ()))
+
+        if old_scored:
+            self._add_sums(id_team_a, id_team_b, -1, -old_a[0])
+            self._add_sums(id_team_b, id_team_a, -1, -old_b[0])
+            self._meet(id_team_a, id_team_b, -1, -old_a[0])
+            self._meet(id_team_b, id_team_a, -1, -old_b[0])
+        self._add_wins(id_team_a, new_a[0] - old_a[0])
+        self._add_wins(id_team_b, new_b[0] - old_b[0])
+        if new_scored:
+            self._meet(id_team_a, id_team_b, 1, new_a[0])
+            self._meet(id_team_b, id_team_a, 1, new_b[0])
+            self._add_sums(id_team_a, id_team_b, 1, new_a[0])
+            self._add_sums(id_team_b, id_team_a, 1, new_b[0])
+        changed = set([id_team_a, id_team_b])
+        changed.update(self._opponents.get(id_team_a, ()))
+        changed.update(self._opponents.get(id_team_b, ()))
+        return changed
+
+    def wins(self, id_team):
+        return self._wins.get(id_team, 0.0)
+
+    def values(self, id_team):
+        """ The (buchholz, median_buchholz, sonneborn_berger) of a team """
+        scores = []
+        for id_opponent, (count, wins) in self._opponents.get(id_team, {}).items():
+            scores.extend(count * [self.wins(id_opponent)])
+        scores.sort()
+        return (
+            self._buchholz.get(id_team, 0.0),
+            sum(scores[1:-1]),
+            self._sonneborn_berger.get(id_team, 0.0),
+        )
+
+    def table(self, teams):
+        """ Dict id_team -> values() of the given teams """
+        return dict((id_team, self.values(id_team)) for id_team in teams)
+
+def sort_key(wins, points, buchholz, median_buchholz, sonneborn_berger, id_rank):
+    """
+    Sort key of a rankings row: by wins, then by points, then by the
+    tie-breakers
+
+    Rows with equal values keep their rankings table order.
+    """
+    return (-wins, -points, -buchholz, -median_buchholz, -sonneborn_berger, id_rank)
+
+def order(rankings, totals, tiebreaks):
+    """
+    Order rankings rows by their totals and tie-breakers
+
+    rankings is a sequence of (id_rank, id_team) tuples, tiebreaks a dict
+    as returned by TieBreaks.table(). Returns a list of (id_rank, id_team,
+    wins, points, buchholz, median_buchholz, sonneborn_berger) tuples,
+    best team first.
+    """
+    rows = []
+    for id_rank, id_team in rankings:
+        wins, points = totals.get(id_team, (0.0, 0))
+        rows.append((id_rank, id_team, wins, points)
+                    + tuple(tiebreaks.get(id_team, (0.0, 0.0, 0.0))))
+    rows.sort(key=lambda row: sort_key(*(row[2:] + row[:1])))
+    return rows
+
+def accumulate_arrays(plays):
+    """ Vectorized accumulate() with NumPy arrays """
+    plays = numpy.array(plays, dtype=float).reshape(-1, 4)
+    team_a, team_b, points_a, points_b = plays.T
+    bye = numpy.isnan(team_b)
+    scored = ~numpy.isnan(points_a) & (bye | ~numpy.isnan(points_b))
+    bye, team_a, team_b = bye[scored], team_a[scored], team_b[scored]
+    points_a, points_b = points_a[scored], points_b[scored]
+
+    wins_a = numpy.where(numpy.isnan(points_b), 1.0,
+        numpy.where(points_a > points_b, 1.0,
+            numpy.where(points_a == points_b, 0.5, 0.0)))
+    wins_b = 1.0 - wins_a
+
+    team_b, wins_b, points_b = team_b[~bye], wins_b[~bye], points_b[~bye]
+    teams, index = numpy.unique(
+        numpy.concatenate((team_a, team_b)), return_inverse=True)
+    wins = numpy.zeros(len(teams))
+    points = numpy.zeros(len(teams))
+    numpy.add.at(wins, index, numpy.concatenate((wins_a, wins_b)))
+    numpy.add.at(points, index, numpy.concatenate((points_a, points_b)))
+    return dict((int(id_team), [float(w), int(p)])
+                for id_team, w, p in zip(teams, wins, points))
+
+def order_arrays(rankings, totals, tiebreaks):
+    """ Vectorized order() with NumPy arrays """
+    if not rankings:
+        return []
+    id_rank, id_team = numpy.array(rankings, dtype=numpy.int64).reshape(-1, 2).T
+    teams = id_team.tolist()
+    wins = numpy.array([totals.get(team, (0.0, 0))[0] for team in teams])
+    points = numpy.array([totals.get(team, (0.0, 0))[1] for team in teams])
+    buchholz, median_buchholz, sonneborn_berger = numpy.array(
+        [tiebreaks.get(team, (0.0, 0.0, 0.0)) for team in teams],
+        dtype=float).reshape(-1, 3).T
+    # lexsort sorts by the last key first, see sort_key()
+    index = numpy.lexsort((id_rank, -sonneborn_berger, -median_buchholz,
+                           -buchholz, -points, -wins))
+    return list(zip(id_rank[index].tolist(), id_team[index].tolist(),
+                    wins[index].tolist(), points[index].tolist(),
+                    buchholz[index].tolist(), median_buchholz[index].tolist(),
+                    sonneborn_berger[index].tolist()))
+
+# Ranking backends by name, each a tuple of accumulate and order functions
+BACKENDS = {
+    'python': (accumulate, order),
+    'numpy': (accumulate_arrays, order_arrays),
+}
+
+def backend(name):
+    """ The (accumulate, order) functions of a ranking backend """
+    if name not in BACKENDS:
+        raise ValueError("Unknown ranking backend '{}'".format(name))
+    if name == 'numpy' and numpy is None:
+        raise ValueError("The numpy ranking backend requires NumPy")
+    return BACKENDS[name]
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2020 Andreas Stricker <andy@knitter.ch>
+#
+# This file is part of SwissTurnier.
+#
+# SwissTurnier is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The whole tournament in memory as a read cache
+
+Categories, teams, plays and rankings of a turnier are small. They are
+loaded once and kept as plain records with the same attributes and
+relations as the ORM objects (team.category, play.team_a, rank.team),
+so serializers and report templates work on either.
+
+The DB stays the source of truth. Write paths update the state after
+their transaction is committed. Changes made by other processes, e.g.
+bin/turnier rank --next, are found with the change counter of the DB
+(see swissturnier.db.bump_change_counter()), checked at most every
+check_interval seconds on reads, and cause a reload(). Each change
+increments the version, which is the validator of HTTP caches as
+well, see validators(), and invalidates the rendered reports in
+output_cache. Subscribers get the changed rows of each version, see
+subscribe().
+"""
+
+import collections
+import datetime
+import threading
+import time
+import types
+import sqlalchemy
+import swissturnier.db
+import swissturnier.ranking
+from swissturnier.db import Category, Team, PlayRound, Rankings
+from swissturnier.report import OutputCache
+
+def values(obj):
+    """ The column values of an ORM object as a dict """
+    return dict((column.name, getattr(obj, column.name))
+                for column in obj.__table__.columns)
+
+def _rows(session, model):
+    columns = list(model.__table__.columns)
+    return [dict(zip([column.name for column in columns], row))
+            for row in session.query(*columns)]
+
+# The plays and rankings rows changed with a version, as column values
+Change = collections.namedtuple('Change', ['version', 'current_round', 'plays', 'rankings'])
+
+def _same(record, row):
+    return record is not None and all(
+        getattr(record, name) == value for name, value in row.items())
+
+# Seconds between the checks for changes by other processes
+CHECK_INTERVAL = 2
+
+class TurnierState(object):
+    """
+    Read cache of a turnier, loaded on first use. With check_interval
+    None changes by other processes are only found by reload().
+    """
+
+    def __init__(self, db, check_interval=CHECK_INTERVAL):
+        self._db = db
+        self._check_interval = check_interval
+        self._next_check = 0
+        # the change counter of the DB the records are up to date with
+        self._counter = None
+        self._lock = threading.RLock()
+        self._version = 0
+        self._modified = None
+        # versions restart with the process, the ETags must not repeat
+        self._instance = '{:x}'.format(int(time.time() * 1000))
+        self._output_cache = OutputCache()
+        self._turnier = swissturnier.ranking.Turnier(db, self)
+        self._categories = None
+        self._teams = None
+        self._plays = None
+        self._rankings = None
+        self._subscribers = []
+
+    @property
+    def version(self):
+        """ Incremented on each reload and update """
+        return self._version
+
+    @property
+    def check_interval(self):
+        """ Seconds between the checks for changes by other processes or None """
+        return self._check_interval
+
+    @property
+    def output_cache(self):
+        """ Reports rendered from this state, see report.CheetahReport """
+        return self._output_cache
+
+    @property
+    def turnier(self):
+        """
+        The Turnier of the API writes, it keeps the tie-breakers between
+        the score entries. Use it only within DB.write().
+        """
+        return self._turnier
+
+    def validators(self):
+        """
+        ETag and Last-Modified (naive UTC) of the current version, the
+        same for all resources
+        """
+        with self._lock:
+            self._loaded()
+            return ('{}-{:d}'.format(self._instance, self._version), self._modified)
+
+    def _changed(self):
+        self._output_cache.invalidate()
+        self._version += 1
+        self._modified = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+    def reload(self):
+        """ Load everything from the DB again, e.g. after external changes """
+        with self._db.session_scope() as session:
+            # first, changes while loading are found by the next check
+            counter = swissturnier.db.query_change_counter(session)
+            categories = _rows(session, Category)
+            teams = _rows(session, Team)
+            plays = _rows(session, PlayRound)
+            rankings = _rows(session, Rankings)
+        with self._lock:
+            if self._plays is not None:
+                # new rounds, ranking or results from elsewhere
+                changed_plays = [row for row in plays
+                                 if not _same(self._plays.get(row['id_playround']), row)]
+                changed_rankings = [row for row in rankings
+                                    if not _same(self._rankings.get(row['id_team']), row)]
+            else:
+                changed_plays, changed_rankings = [], []
+            self._categories = dict(
+                (row['id_category'], types.SimpleNamespace(**row)) for row in categories)
+            self._teams = {}
+            for row in teams:
+                self._teams[row['id_team']] = types.SimpleNamespace(
+                    category=self._categories[row['id_category']], **row)
+            self._plays = {}
+            for row in plays:
+                self._set_play(row)
+            self._rankings = {}
+            for row in rankings:
+                self._set_ranking(row)
+            self._counter = counter
+            self._next_check = time.monotonic() + (self._check_interval or 0)
+            # the results may have changed under the tie-breakers as well
+            self._turnier.forget_tiebreaks()
+            self._changed()
+            self._publish(changed_plays, changed_rankings)
+
+    def check(self):
+        """
+        Reload if other processes changed the DB, the same check as on
+        reads for servers waiting on subscribers only
+        """
+        with self._lock:
+            self._loaded()
+
+    def _loaded(self):
+        if self._plays is None or self._counter is None:
+            self.reload()
+        elif self._check_interval is not None and time.monotonic() >= self._next_check:
+            self._next_check = time.monotonic() + self._check_interval
+            with self._db.session_scope() as session:
+                counter = swissturnier.db.query_change_counter(session)
+            if counter != self._counter:
+                self.reload()
+
+    def _set_play(self, row):
+        self._plays[row['id_playround']] = types.SimpleNamespace(
+            team_a=self._teams[row['id_team_a']],
+            team_b=self._teams.get(row['id_team_b']),
+            **row)
+
+    def _set_ranking(self, row):
+        self._rankings[row['id_team']] = types.SimpleNamespace(
+            team=self._teams[row['id_team']], **row)
+
+    def update(self, plays=(), rankings=(), counter=None):
+        """
+        Replace plays and rankings with the column values of the rows,
+        written with this change counter of the DB. Rows equal to the
+        loaded ones are left out, only the others make a new version.
+        """
+        with self._lock:
+            if self._plays is None:
+                return  # not loaded yet, the first read finds the rows in the DB
+            if counter is not None:
+                if self._counter is not None and counter == self._counter + 1:
+                    self._counter = counter
+                else:
+                    self._counter = None  # missed other changes, reload on next read
+            plays = [row for row in plays
+                     if not _same(self._plays.get(row['id_playround']), row)]
+            rankings = [row for row in rankings
+                        if not _same(self._rankings.get(row['id_team']), row)]
+            if not (plays or rankings):
+                return
+            for row in plays:
+                self._set_play(row)
+            for row in rankings:
+                self._set_ranking(row)
+            self._changed()
+            self._publish(plays, rankings)
+
+    def subscribe(self, callback):
+        """
+        Call callback(change) with a Change for each new version with
+        changed plays or rankings. It's called by the writing thread
+        with the state locked, so better only queue the change. A
+        callback raising an exception is unsubscribed.
+        """
+        with self._lock:
+            self._loaded()
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def _publish(self, plays, rankings):
+        if not self._subscribers or not (plays or rankings):
+            return
+        change = Change(self._version, self._current_round(), list(plays), list(rankings))
+        for callback in list(self._subscribers):
+            try:
+                callback(change)
+            except Exception:
+                self._subscribers.remove(callback)
+
+    def update_after_commit(self, session, plays=(), rankings=()):
+        """
+        Same as update() once the session is committed. Writes are
+        serialized, their updates are applied in the same order.
+        """
+        counter = swissturnier.db.bump_change_counter(session)
+        def update(session):
+            self.update(plays, rankings, counter)
+        sqlalchemy.event.listen(session, 'after_commit', update, once=True)
+
+    def categories(self):
+        with self._lock:
+            self._loaded()
+            return sorted(self._categories.values(), key=lambda c: c.id_category)
+
+    def category(self, id_category):
+        """ The category or None if it does not exist """
+        with self._lock:
+            self._loaded()
+            return self._categories.get(id_category)
+
+    def teams(self, category=None):
+        """ All teams or the teams of the category with this name """
+        with self._lock:
+            self._loaded()
+            return [team for id_team, team in sorted(self._teams.items())
+                    if category is None or team.category.name == category]
+
+    def team(self, id_team):
+        """ The team or None if it does not exist """
+        with self._lock:
+            self._loaded()
+            return self._teams.get(id_team)
+
+    def current_round(self):
+        """ Same as swissturnier.db.query_current_round() """
+        with self._lock:
+            self._loaded()
+            return self._current_round()
+
+    def _current_round(self):
+        return max([play.round_number for play in self._plays.values()], default=0)
+
+    def plays(self, round_number=None):
+        """ The plays of all or of one round ordered by round and ID """
+        with self._lock:
+            self._loaded()
+            plays = [play for play in self._plays.values()
+                     if round_number is None or play.round_number == round_number]
+        plays.sort(key=lambda play: (play.round_number, play.id_playround))
+        return plays
+
+    def play(self, id_playround):
+        """ The play or None if it does not exist """
+        with self._lock:
+            self._loaded()
+            return self._plays.get(id_playround)
+
+    def rankings(self):
+        """ The rankings ordered by rank """
+        with self._lock:
+            self._loaded()
+            rankings = list(self._rankings.values())
+        rankings.sort(key=lambda rank: (rank.rank is None, rank.rank or 0, rank.id_rank))
+        return rankings
@@ -0,0 +1,30 @@
+""" Shared by the tests of the DB, the state and the APIs """
+
+import os
+import sqlalchemy
+
+def load_testdata(db):
+    """ Insert the teams and plays of testdata.sql into db """
+    path = os.path.join(os.path.dirname(__file__), 'testdata.sql')
+    with open(path, encoding='UTF-8') as f:
+        statements = f.read().split(';\n')
+    with db.engine.begin() as connection:
+        for statement in statements:
+            if statement.strip():
+                connection.execute(statement)
+
+def executed_statements(db, func, *args, **kwargs):
+    """ The SQL statements executed on db by func(*args, **kwargs) """
+    statements = []
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    sqlalchemy.event.listen(db.engine, 'before_cursor_execute', before_execute)
+    try:
+        func(*args, **kwargs)
+    finally:
+        sqlalchemy.event.remove(db.engine, 'before_cursor_execute', before_execute)
+    return statements
+
+def count_statements(db, func, *args, **kwargs):
+    """ Number of SQL statements executed on db by func(*args, **kwargs) """
+    return len(executed_statements(db, func, *args, **kwargs))
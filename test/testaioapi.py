@@ -0,0 +1,170 @@
+import unittest
+import asyncio
+import json
+import os
+import tempfile
+import swissturnier.api
+import swissturnier.aioapi
+import swissturnier.db
+import swissturnier.ranking
+import swissturnier.state
+import helpers
+
+try:
+    import aiohttp
+    import aiohttp.test_utils
+except ImportError:
+    aiohttp = None
+
+@unittest.skipIf(aiohttp is None, "Requires aiohttp library")
+class TestAsyncAPI(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        # a file, the requests run in other threads than the setup
+        self.path = tempfile.TemporaryDirectory()
+        self.db = swissturnier.db.DB(config={
+            'schema': 'sqlite',
+            'database': os.path.join(self.path.name, 'turnier.db'),
+        })
+        self.db.createdb()
+        helpers.load_testdata(self.db)
+        turnier = swissturnier.ranking.Turnier(self.db)
+        turnier.init_rankings()
+        turnier.rank()
+        app = swissturnier.aioapi.get_application(self.db, workers=4)
+        self.client = aiohttp.test_utils.TestClient(aiohttp.test_utils.TestServer(app))
+        await self.client.start_server()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        self.db.close()
+        self.path.cleanup()
+
+    async def test_same_resources(self):
+        app = swissturnier.api.get_application(self.db)
+        for url in ['/v1/categories', '/v1/category/2', '/v1/teams',
+                    '/v1/teams?category=Mixed', '/v1/team/5', '/v1/currentround',
+                    '/v1/playround/1', '/v1/playround/3', '/v1/play/7',
+                    '/v1/teams?limit=5&after=5&fields=name',
+                    '/v1/playround/2?embed=false&limit=4']:
+            r = await self.client.get(url)
+            self.assertEqual(r.status, 200, url)
+            expected = app.request(url)
+            if url != '/v1/currentround':  # web.py returns a dict unencoded
+                self.assertEqual(await r.json(), json.loads(expected.data), url)
+
+    async def test_reports(self):
+        for url in ['/', '/v1/ranking', '/v1/playtable']:
+            r = await self.client.get(url)
+            self.assertEqual(r.status, 200)
+            self.assertIn('<!DOCTYPE html>', await r.text())
+        r = await self.client.get('/v1/ranking/', allow_redirects=False)
+        self.assertEqual(r.status, 303)
+
+    async def test_not_found(self):
+        r = await self.client.get('/v1/team/999')
+        self.assertEqual(r.status, 404)
+        r = await self.client.get('/v1/category/999')
+        self.assertEqual(r.status, 404)
+        r = await self.client.get('/v1/teams?limit=none')
+        self.assertEqual(r.status, 400)
+        r = await self.client.put('/v1/play/999', data=json.dumps({'points_a': 3, 'points_b': 21}))
+        self.assertEqual(r.status, 404)
+        r = await self.client.put('/v1/play/17', data=json.dumps({'points_a': '3', 'points_b': 21}))
+        self.assertEqual(r.status, 400)
+
+    async def test_update_play(self):
+        r = await self.client.put('/v1/play/17', data=json.dumps({'points_a': 3, 'points_b': 21}))
+        self.assertEqual(r.status, 200)
+        data = await r.json()
+        self.assertEqual((data['points_a'], data['points_b']), (3, 21))
+        r = await self.client.get('/v1/play/17')
+        self.assertEqual((await r.json())['points_a'], 3)
+
+    async def test_conditional_get(self):
+        r = await self.client.get('/v1/playtable')
+        etag = r.headers['ETag']
+        self.assertEqual(r.headers['Cache-Control'], 'no-cache')
+        for url in ['/v1/playtable', '/v1/teams', '/v1/playround/2', '/v1/play/17']:
+            r = await self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(r.status, 304, url)
+            self.assertEqual(r.headers['ETag'], etag)
+        r = await self.client.get('/v1/teams', headers={
+            'If-Modified-Since': r.headers['Last-Modified']})
+        self.assertEqual(r.status, 304)
+        r = await self.client.put('/v1/play/17', data=json.dumps({'points_a': 3, 'points_b': 21}))
+        self.assertEqual(r.status, 200)
+        r = await self.client.get('/v1/playtable', headers={'If-None-Match': etag})
+        self.assertEqual(r.status, 200)
+        self.assertNotEqual(r.headers['ETag'], etag)
+
+    async def test_update_playround(self):
+        lines = '\n'.join(json.dumps({'id_playround': id_play, 'points_a': 21, 'points_b': 3})
+                          for id_play in (17, 18, 19))
+        r = await self.client.put('/v1/playround/2', data=lines,
+                                  headers={'Content-Type': 'application/x-ndjson'})
+        self.assertEqual(r.status, 200)
+        data = await r.json()
+        self.assertEqual([play['points_b'] for play in data['plays'][:4]], [3, 3, 3, 9])
+        r = await self.client.put('/v1/playround/1', data=json.dumps(
+            [{'id_playround': 17, 'points_a': 21, 'points_b': 3}]))
+        self.assertEqual(r.status, 400)
+
+    async def test_events(self):
+        r = await self.client.get('/v1/events')
+        self.assertEqual(r.status, 200)
+        self.assertEqual(r.headers['Content-Type'], 'text/event-stream')
+        self.assertEqual(await r.content.readline(), b'retry: 3000\n')
+        await r.content.readline()
+        put = await self.client.put('/v1/play/17', data=json.dumps({'points_a': 3, 'points_b': 21}))
+        self.assertEqual(put.status, 200)
+        self.assertTrue((await r.content.readline()).startswith(b'id: '))
+        self.assertEqual(await r.content.readline(), b'event: change\n')
+        data = json.loads((await r.content.readline())[len(b'data: '):])
+        self.assertEqual([play['id_playround'] for play in data['plays']], [17])
+        r.close()
+
+    async def test_events_external_change(self):
+        state = swissturnier.state.TurnierState(self.db, check_interval=0.1)
+        app = swissturnier.aioapi.get_application(self.db, workers=2, state=state)
+        client = aiohttp.test_utils.TestClient(aiohttp.test_utils.TestServer(app))
+        await client.start_server()
+        self.addAsyncCleanup(client.close)
+        r = await client.get('/v1/events')
+        self.assertEqual(await r.content.readline(), b'retry: 3000\n')
+        await r.content.readline()
+
+        # another process enters a result, no request reads the state
+        def enter_result():
+            db = swissturnier.db.DB(config=dict(self.db.config))
+            with db.session_scope() as session:
+                play = session.query(swissturnier.db.PlayRound).get(18)
+                swissturnier.ranking.Turnier(db).update_play_result(session, play, 3, 21)
+            db.close()
+        await asyncio.to_thread(enter_result)
+        lines = [await asyncio.wait_for(r.content.readline(), 5) for num in range(3)]
+        self.assertEqual(lines[1], b'event: change\n')
+        data = json.loads(lines[2][len(b'data: '):])
+        self.assertEqual([(play['id_playround'], play['points_a']) for play in data['plays']],
+                         [(18, 3)])
+        r.close()
+
+    async def test_events_many_clients(self):
+        # more display screens than the threads of a web.py server
+        streams = []
+        for num in range(20):
+            r = await self.client.get('/v1/events')
+            self.assertEqual(await r.content.readline(), b'retry: 3000\n')
+            streams.append(r)
+        r = await asyncio.wait_for(self.client.get('/v1/categories'), 5)
+        self.assertEqual(r.status, 200)
+        page = await (await self.client.get('/v1/playtable')).text()
+        self.assertIn("new EventSource('/v1/events')", page)
+        self.assertIn('<noscript><meta http-equiv="refresh" content="71"></noscript>', page)
+        page = await (await self.client.get('/v1/ranking')).text()
+        self.assertIn("new EventSource('/v1/events')", page)
+        for r in streams:
+            r.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,14 @@
 import unittest
 import json
+import os
+import tempfile
+import concurrent.futures
+import sqlalchemy
 import swissturnier.api
+import swissturnier.db
+import swissturnier.ranking
+import swissturnier.state
+import helpers
 
 try:
     import paste
@@ -10,13 +18,31 @@ except ImportError:
 
 class TestAPI(unittest.TestCase):
     def setUp(self):
-        app = swissturnier.api.get_application()
+        self.db = swissturnier.db.DB(config={'schema': 'sqlite', 'database': ''})
+        self.db.createdb()
+        helpers.load_testdata(self.db)
+        # no checks for other processes between the counted queries
+        state = swissturnier.state.TurnierState(self.db, check_interval=None)
+        app = swissturnier.api.get_application(self.db, state)
         self.middleware = []
         self.test_app = paste.fixture.TestApp(app.wsgifunc(*self.middleware))
 
     def tearDown(self):
         self.middleware = None
         self.test_app = None
+        self.db.close()
+
+    @unittest.skipIf(paste is None, "Requires paste library")
+    def test_shared_db(self):
+        connects = []
+        sqlalchemy.event.listen(self.db.engine, 'connect',
+                                lambda dbapi_connection, record: connects.append(record))
+        for num in range(3):
+            r = self.test_app.get('/v1/categories')
+            self.assertEqual(r.status, 200)
+            # the thread local session is gone after each request
+            self.assertFalse(self.db.sessionmaker.registry.has())
+        self.assertEqual(connects, [])
 
     @unittest.skipIf(paste is None, "Requires paste library")
     def test_api_index(self):
@@ -60,3 +86,355 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(play['points_a'], data['points_a'])
         self.assertEqual(play['points_b'], data['points_b'])
 
+    def test_sqlite_concurrent_put(self):
+        with tempfile.TemporaryDirectory() as path:
+            self.db = swissturnier.db.DB(config={
+                'schema': 'sqlite',
+                'database': os.path.join(path, 'turnier.db'),
+            })
+            self.db.createdb()
+            helpers.load_testdata(self.db)
+            turnier = swissturnier.ranking.Turnier(self.db)
+            turnier.init_rankings()
+            turnier.rank()
+            with self.db.engine.connect() as connection:
+                self.assertEqual(connection.execute("PRAGMA journal_mode").scalar(), 'wal')
+                self.assertEqual(connection.execute("PRAGMA busy_timeout").scalar(), 5000)
+            app = swissturnier.api.get_application(self.db)
+
+            def put(id_play):
+                return app.request('/v1/play/{}'.format(id_play), method='PUT',
+                                   data=json.dumps({'points_a': 21, 'points_b': id_play % 21}))
+            def get(num):
+                return app.request('/v1/playround/2')
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+                puts = [executor.submit(put, id_play) for id_play in range(17, 32)]
+                gets = [executor.submit(get, num) for num in range(15)]
+                statuses = [future.result().status for future in puts + gets]
+            self.assertEqual(statuses, 30 * ['200 OK'])
+
+            incremental = self._ranktable()
+            state = json.loads(app.request('/v1/playround/2').data)
+            for play in state['plays'][:15]:
+                self.assertEqual((play['points_a'], play['points_b']),
+                                 (21, play['id_playround'] % 21))
+            turnier.rank()
+            self.assertEqual(incremental, self._ranktable())
+            self.db.close()
+
+    def _ranktable(self):
+        with self.db.session_scope() as session:
+            return (session
+                .query(swissturnier.db.Rankings.id_team, swissturnier.db.Rankings.rank)
+                .order_by(swissturnier.db.Rankings.rank)
+                .all())
+
+    def _count_queries(self, url):
+        responses = []
+        count = helpers.count_statements(
+            self.db, lambda: responses.append(self.test_app.get(url)))
+        self.assertEqual(responses[0].status, 200)
+        return count
+
+    @unittest.skipIf(paste is None, "Requires paste library")
+    def test_query_count(self):
+        turnier = swissturnier.ranking.Turnier(self.db)
+        turnier.init_rankings()
+        turnier.rank()
+        # the change counter and one query per table to load the turnier
+        # state on first use, then all reads are served from memory
+        self.assertEqual(self._count_queries('/v1/teams'), 5)
+        self.assertEqual(self._count_queries('/v1/teams?category=Mixed'), 0)
+        self.assertEqual(self._count_queries('/v1/team/3'), 0)
+        self.assertEqual(self._count_queries('/v1/playround/1'), 0)
+        self.assertEqual(self._count_queries('/v1/play/2'), 0)
+        self.assertEqual(self._count_queries('/v1/playtable'), 0)
+        self.assertEqual(self._count_queries('/v1/ranking'), 0)
+
+    @unittest.skipIf(paste is None, "Requires paste library")
+    def test_state_after_put(self):
+        turnier = swissturnier.ranking.Turnier(self.db)
+        turnier.init_rankings()
+        turnier.rank()
+        self.assertEqual(self._count_queries('/v1/play/17'), 5)
+        r = self.test_app.put('/v1/play/17', params=json.dumps({'points_a': 3, 'points_b': 21}))
+        self.assertEqual(r.status, 200)
+        self.assertEqual(self._count_queries('/v1/play/17'), 0)
+        data = json.loads(self.test_app.get('/v1/play/17').body.decode('UTF-8'))
+        self.assertEqual((data['points_a'], data['points_b']), (3, 21))
+        r = self.test_app.get('/v1/ranking')
+        for id_team, rank in self._ranktable():
+            r.mustcontain('<td>{}</td>'.format(rank))
+
+    def test_put_tiebreaks_cached(self):
+        turnier = swissturnier.ranking.Turnier(self.db)
+        turnier.init_rankings()
+        turnier.rank()
+        app = swissturnier.api.get_application(self.db)
+        def put(id_play, body):
+            r = app.request('/v1/play/{}'.format(id_play), method='PUT', data=body)
+            self.assertEqual(r.status, '200 OK')
+        def scored_plays(statement):
+            return 'FROM playround' in statement and 'points_a IS NOT NULL' in statement
+        first = helpers.executed_statements(self.db, put, 17, '{"points_a": 3, "points_b": 21}')
+        self.assertEqual(len([s for s in first if scored_plays(s)]), 1)
+        # the tie-breakers of the first PUT are used again
+        second = helpers.executed_statements(self.db, put, 18, '{"points_a": 21, "points_b": 9}')
+        self.assertEqual([s for s in second if scored_plays(s)], [])
+        # but not results rolled back
+        with self.assertRaises(RuntimeError):
+            with self.db.session_scope() as session:
+                play = session.query(swissturnier.db.PlayRound).get(19)
+                self.assertIsNotNone(
+                    turnier.update_play_result(session, play, 21, 0))
+                raise RuntimeError()
+        self.assertIsNone(turnier._tiebreaks)
+        incremental = self._ranktable()
+        turnier.rank()
+        self.assertEqual(incremental, self._ranktable())
+
+    def test_external_changes(self):
+        state = swissturnier.state.TurnierState(self.db, check_interval=0)
+        app = swissturnier.api.get_application(self.db, state)
+        r = app.request('/v1/playround/3')
+        self.assertEqual(json.loads(r.data)['count'], 0)
+        etag = r.headers['ETag']
+        # bin/turnier rank --next in another process
+        turnier = swissturnier.ranking.Turnier(self.db)
+        turnier.init_rankings()
+        turnier.next_round()
+        r = app.request('/v1/playround/3', headers={'If-None-Match': etag})
+        self.assertEqual(r.status, '200 OK')
+        self.assertEqual(json.loads(r.data)['count'], 16)
+
+    def _header(self, response, name):
+        return dict(response.headers)[name]
+
+    @unittest.skipIf(paste is None, "Requires paste library")
+    def test_conditional_get(self):
+        turnier = swissturnier.ranking.Turnier(self.db)
+        turnier.init_rankings()
+        turnier.rank()
+        r = self.test_app.get('/v1/ranking')
+        etag = self._header(r, 'ETag')
+        modified = self._header(r, 'Last-Modified')
+        self.assertEqual(self._header(r, 'Cache-Control'), 'no-cache')
+        for url in ['/', '/v1/ranking', '/v1/playtable', '/v1/teams', '/v1/team/3',
+                    '/v1/categories', '/v1/category/1', '/v1/playround/1', '/v1/play/2']:
+            r = self.test_app.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(r.status, 304, url)
+            self.assertEqual(r.body, b'')
+        r = self.test_app.get('/v1/playtable', headers={'If-Modified-Since': modified})
+        self.assertEqual(r.status, 304)
+
+        r = self.test_app.put('/v1/play/17', params=json.dumps({'points_a': 3, 'points_b': 21}))
+        self.assertEqual(r.status, 200)
+        r = self.test_app.get('/v1/ranking', headers={'If-None-Match': etag})
+        self.assertEqual(r.status, 200)
+        self.assertNotEqual(self._header(r, 'ETag'), etag)
+        # the ETag decides over a date of the same second
+        r = self.test_app.get('/v1/ranking', headers={
+            'If-None-Match': etag,
+            'If-Modified-Since': self._header(r, 'Last-Modified')})
+        self.assertEqual(r.status, 200)
+
+    def test_report_output_cache(self):
+        turnier = swissturnier.ranking.Turnier(self.db)
+        turnier.init_rankings()
+        turnier.rank()
+        state = swissturnier.state.TurnierState(self.db)
+        app = swissturnier.api.get_application(self.db, state)
+        ranking = app.request('/v1/ranking').data
+        app.request('/v1/playtable')
+        self.assertEqual(len(state.output_cache), 2)
+        # rendered once for all viewers
+        self.assertEqual(helpers.count_statements(self.db, app.request, '/v1/ranking'), 0)
+        self.assertEqual(app.request('/v1/ranking').data, ranking)
+        self.assertEqual(len(state.output_cache), 2)
+
+        r = app.request('/v1/play/17', method='PUT',
+                        data=json.dumps({'points_a': 3, 'points_b': 21}))
+        self.assertEqual(r.status, '200 OK')
+        self.assertEqual(len(state.output_cache), 0)
+        self.assertNotEqual(app.request('/v1/ranking').data, ranking)
+        playtable = app.request('/v1/playtable').data
+        self.assertIn('<td class="points_a">3</td>\n    <td class="points_b">21</td>',
+                      playtable.decode('UTF-8'))
+
+        swissturnier.ranking.Turnier(self.db, state).rank()
+        self.assertEqual(len(state.output_cache), 0)
+
+    def _put_round(self, app, round_number, body, content_type='application/json'):
+        return app.request('/v1/playround/{}'.format(round_number), method='PUT',
+                           data=body, headers={'Content-Type': content_type})
+
+    def test_playround_put(self):
+        turnier = swissturnier.ranking.Turnier(self.db)
+        turnier.init_rankings()
+        turnier.rank()
+        state = swissturnier.state.TurnierState(self.db)
+        app = swissturnier.api.get_application(self.db, state)
+        results = [{'id_playround': id_play, 'points_a': 21, 'points_b': id_play % 21}
+                   for id_play in range(17, 32)]
+        r = self._put_round(app, 2, json.dumps({'plays': results[:8]}))
+        self.assertEqual(r.status, '200 OK')
+        data = json.loads(r.data)
+        self.assertEqual(data['count'], 16)
+        self.assertEqual([(play['points_a'], play['points_b']) for play in data['plays'][:8]],
+                         [(21, id_play % 21) for id_play in range(17, 25)])
+        changes = []
+        state.subscribe(changes.append)
+        before = self._state_rankings(state)
+        lines = '\n'.join(json.dumps(result) for result in results[8:])
+        r = self._put_round(app, 2, lines, 'application/x-ndjson')
+        self.assertEqual(r.status, '200 OK')
+        # only the rankings that changed are published
+        after = self._state_rankings(state)
+        self.assertEqual(len(changes), 1)
+        self.assertEqual(sorted(rank['id_team'] for rank in changes[0].rankings),
+                         sorted(id_team for id_team in after if after[id_team] != before[id_team]))
+        self.assertLess(len(changes[0].rankings), len(after))
+        # and nothing at all for the same results again
+        version = state.version
+        r = self._put_round(app, 2, lines, 'application/x-ndjson')
+        self.assertEqual(r.status, '200 OK')
+        self.assertEqual((len(changes), state.version), (1, version))
+
+        incremental = self._ranktable()
+        self.assertEqual([(rank.id_team, rank.rank) for rank in state.rankings()], incremental)
+        turnier.rank()
+        self.assertEqual(incremental, self._ranktable())
+        data = json.loads(app.request('/v1/play/31').data)
+        self.assertEqual((data['points_a'], data['points_b']), (21, 10))
+
+    def _state_rankings(self, state):
+        return dict((rank.id_team, dict((name, value) for name, value in vars(rank).items()
+                                        if name != 'team'))
+                    for rank in state.rankings())
+
+    def test_playround_put_invalid(self):
+        app = swissturnier.api.get_application(self.db)
+        for body in [
+                '{"plays": 1}',
+                '[{"id_playround": 17, "points_a": 21}]',
+                '[{"id_playround": 17, "points_a": -1, "points_b": 3}]',
+                '[{"id_playround": 17, "points_a": "21", "points_b": 3}]',
+                '[{"id_playround": 2, "points_a": 21, "points_b": 3}]',
+                '[{"id_playround": 32, "points_a": 21, "points_b": 3}]',
+                '[{"id_playround": 17, "points_a": 21, "points_b": 3},'
+                ' {"id_playround": 17, "points_a": 21, "points_b": 3}]',
+                'no JSON']:
+            r = self._put_round(app, 2, body)
+            self.assertEqual(r.status, '400 Bad Request', body)
+        data = json.loads(app.request('/v1/play/17').data)
+        self.assertEqual((data['points_a'], data['points_b']), (14, 26))
+
+    def test_play_put_invalid(self):
+        app = swissturnier.api.get_application(self.db)
+        for body in [
+                '{"points_a": "21", "points_b": 3}',
+                '{"points_a": 21, "points_b": -3}',
+                '{"points_a": 21}',
+                '[21, 3]',
+                'no JSON']:
+            r = app.request('/v1/play/17', method='PUT', data=body)
+            self.assertEqual(r.status, '400 Bad Request', body)
+        r = app.request('/v1/play/32', method='PUT', data='{"points_a": 21, "points_b": 3}')
+        self.assertEqual(r.status, '400 Bad Request')
+        r = app.request('/v1/play/999', method='PUT', data='{"points_a": 21, "points_b": 3}')
+        self.assertEqual(r.status, '404 Not Found')
+        data = json.loads(app.request('/v1/play/17').data)
+        self.assertEqual((data['points_a'], data['points_b']), (14, 26))
+
+    def _get_json(self, app, url):
+        r = app.request(url)
+        self.assertEqual(r.status, '200 OK', url)
+        return json.loads(r.data)
+
+    def test_list_pages(self):
+        app = swissturnier.api.get_application(self.db)
+        teams = self._get_json(app, '/v1/teams')['items']
+        url = '/v1/teams?limit=7'
+        pages = []
+        while url:
+            data = self._get_json(app, url)
+            self.assertLessEqual(data['count'], 7)
+            pages.extend(data['items'])
+            url = data['_links'].get('next', {}).get('href')
+        self.assertEqual(pages, teams)
+        self.assertEqual(len(teams), 31)
+
+        data = self._get_json(app, '/v1/teams?category=Mixed&after=10&limit=2')
+        self.assertEqual([team['category'] for team in data['items']], 2 * ['Mixed'])
+        self.assertTrue(all(team['id_team'] > 10 for team in data['items']))
+        self.assertIn('category=Mixed', data['_links']['next']['href'])
+        self.assertEqual(self._get_json(app, '/v1/teams?after=31')['items'], [])
+
+        data = self._get_json(app, '/v1/teams?fields=id_team,name&limit=1')
+        self.assertEqual(sorted(data['items'][0].keys()), ['_links', 'id_team', 'name'])
+
+    def test_playround_embed(self):
+        app = swissturnier.api.get_application(self.db)
+        full = app.request('/v1/playround/2').data
+        data = self._get_json(app, '/v1/playround/2?embed=false&fields=id_playround,points_a,points_b')
+        play = data['plays'][0]
+        self.assertNotIn('_embedded', play)
+        self.assertEqual(sorted(play.keys()), ['_links', 'id_playround', 'points_a', 'points_b'])
+        self.assertEqual(play['_links']['team_a']['href'], '/v1/team/29')
+        self.assertEqual(play['_links']['team_b']['href'], '/v1/team/20')
+        self.assertNotIn('team_b', data['plays'][-1]['_links'])  # bye
+        self.assertLess(len(app.request('/v1/playround/2?embed=false').data), len(full) / 2)
+
+        data = self._get_json(app, '/v1/playround/2?after=20&limit=3&embed=false')
+        self.assertEqual([play['id_playround'] for play in data['plays']], [21, 22, 23])
+        self.assertIn('after=23', data['_links']['next']['href'])
+        self.assertIn('embed=false', data['_links']['next']['href'])
+
+    def test_list_invalid(self):
+        app = swissturnier.api.get_application(self.db)
+        for url in ['/v1/teams?limit=0', '/v1/teams?after=x', '/v1/teams?fields=id_team,secret',
+                    '/v1/playround/1?limit=-1', '/v1/playround/1?fields=team_a']:
+            self.assertEqual(app.request(url).status, '400 Bad Request', url)
+
+    def test_events(self):
+        # no stream holding a server thread per display screen
+        app = swissturnier.api.get_application(self.db)
+        r = app.request('/v1/events')
+        self.assertEqual(r.status, '501 Not Implemented')
+        # the pages are refreshed instead
+        page = app.request('/v1/playtable').data.decode('UTF-8')
+        self.assertIn('<meta http-equiv="refresh" content="71">', page)
+        self.assertNotIn('EventSource', page)
+        self.assertNotIn('EventSource', app.request('/v1/ranking').data.decode('UTF-8'))
+
+    def test_format_event(self):
+        turnier = swissturnier.ranking.Turnier(self.db)
+        turnier.init_rankings()
+        turnier.rank()
+        state = swissturnier.state.TurnierState(self.db)
+        app = swissturnier.api.get_application(self.db, state)
+        changes = []
+        state.subscribe(changes.append)
+        app.request('/v1/play/17', method='PUT', data=json.dumps({'points_a': 3, 'points_b': 21}))
+        lines = swissturnier.api.format_event(changes[0]).splitlines()
+        self.assertEqual(lines[:2], ['id: {}'.format(state.version), 'event: change'])
+        data = json.loads(lines[2][len('data: '):])
+        self.assertEqual(data['round'], 2)
+        self.assertEqual([(play['id_playround'], play['points_a'], play['points_b'])
+                          for play in data['plays']], [(17, 3, 21)])
+        ranks = dict(self._ranktable())
+        for rank in data['rankings']:
+            self.assertEqual(rank['rank'], ranks[rank['id_team']])
+
+    @unittest.skipIf(paste is None, "Requires paste library")
+    def test_reload(self):
+        self.test_app.get('/v1/playround/1')
+        with self.db.engine.begin() as connection:
+            connection.execute("UPDATE playround SET points_a = 7 WHERE id_playround = 2")
+        data = json.loads(self.test_app.get('/v1/play/2').body.decode('UTF-8'))
+        self.assertNotEqual(data['points_a'], 7)
+        r = self.test_app.post('/v1/reload', params='')
+        self.assertEqual(r.status, 200)
+        data = json.loads(self.test_app.get('/v1/play/2').body.decode('UTF-8'))
+        self.assertEqual(data['points_a'], 7)
@@ -1,4 +1,8 @@
 import unittest
+import os
+import tempfile
+import threading
+import concurrent.futures
 import swissturnier.db
 import sqlalchemy
 
@@ -41,6 +45,97 @@ class TestDB(unittest.TestCase):
         session = self.db.create_session()
         self.assertIsInstance(session, sqlalchemy.orm.session.Session)
 
+    def test_sessionmaker(self):
+        self.assertIs(self.db.sessionmaker, self.db.sessionmaker)
+        with self.db.session_scope() as session:
+            self.assertIs(session, self.db.create_session())
+        self.assertFalse(self.db.sessionmaker.registry.has())
+
+    def test_engine_options(self):
+        db = swissturnier.db.DB(config={'schema': 'postgres', 'pool_size': 2})
+        self.assertEqual(db._engine_options(),
+            {'pool_size': 2, 'pool_pre_ping': True, 'pool_recycle': 3600})
+        db = swissturnier.db.DB(config={'schema': 'sqlite', 'database': 'turnier.db'})
+        self.assertEqual(db._engine_options(), {})
+        self.assertEqual(db._buildurl(), 'sqlite:///turnier.db')
+
+    def test_createdb_migrated(self):
+        self.assertEqual(self.db.createdb(), [])
+        with self.db.session_scope() as session:
+            version = session.query(sqlalchemy.func.max(swissturnier.db.SchemaVersion.version)).scalar()
+            self.assertEqual(version, len(swissturnier.db.MIGRATIONS))
+
+    def test_migrate_old_schema(self):
+        db = swissturnier.db.DB(config={'schema': 'sqlite'})
+        db._engine = sqlalchemy.create_engine('sqlite://')
+        with db.engine.begin() as connection:
+            for statement in [
+                    "CREATE TABLE category (id_category INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)",
+                    "CREATE TABLE team (id_team INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, id_category INTEGER NOT NULL)",
+                    "CREATE TABLE playround (id_playround INTEGER PRIMARY KEY, round_number INTEGER NOT NULL, "
+                    "id_team_a INTEGER NOT NULL, id_team_b INTEGER, points_a INTEGER, points_b INTEGER, "
+                    "start_time DATETIME, court TEXT)",
+                    "CREATE TABLE rankings (id_rank INTEGER PRIMARY KEY, id_team INTEGER NOT NULL, "
+                    "rank INTEGER, wins FLOAT, points INTEGER)",
+                    "INSERT INTO rankings (id_team, rank, wins, points) VALUES (1, 1, 1.0, 21)",
+                ]:
+                connection.execute(statement)
+        self.assertEqual(db.createdb(), [1, 2, 3, 4])
+        self.assertEqual(db.createdb(), [])
+
+        inspector = sqlalchemy.inspect(db.engine)
+        columns = [column['name'] for column in inspector.get_columns('rankings')]
+        self.assertIn('sonneborn_berger', columns)
+        indexes = dict((index['name'], index) for index in inspector.get_indexes('rankings'))
+        self.assertTrue(indexes['rankings_id_team_key']['unique'])
+        self.assertIn('ix_rankings_rank', indexes)
+        with db.session_scope() as session:
+            rank = session.query(swissturnier.db.Rankings).one()
+            self.assertEqual(rank.buchholz, 0)
+            plan = session.execute(
+                "EXPLAIN QUERY PLAN SELECT * FROM playround WHERE round_number = 3").fetchall()
+            self.assertIn('ix_playround_round_number', str(plan))
+            self.assertEqual(swissturnier.db.query_change_counter(session), 0)
+
+    def test_change_counter(self):
+        with self.db.session_scope() as session:
+            self.assertEqual(swissturnier.db.query_change_counter(session), 0)
+            self.assertEqual(swissturnier.db.bump_change_counter(session), 1)
+            # once per transaction
+            self.assertEqual(swissturnier.db.bump_change_counter(session), 1)
+        with self.db.session_scope() as session:
+            self.assertEqual(swissturnier.db.bump_change_counter(session), 2)
+        with self.assertRaises(RuntimeError):
+            with self.db.session_scope() as session:
+                swissturnier.db.bump_change_counter(session)
+                raise RuntimeError()
+        with self.db.session_scope() as session:
+            self.assertEqual(swissturnier.db.query_change_counter(session), 2)
+
+    def test_write_queue(self):
+        path = tempfile.TemporaryDirectory()
+        self.addCleanup(path.cleanup)
+        self.db = swissturnier.db.DB(config={
+            'schema': 'sqlite',
+            'database': os.path.join(path.name, 'turnier.db'),
+        })
+        self.db.createdb()
+        self._insert_categories()
+        threads = set()
+        def add_team(session, num):
+            threads.add(threading.get_ident())
+            category = session.query(swissturnier.db.Category).filter_by(name='Male').one()
+            session.add(swissturnier.db.Team(name='Team {}'.format(num), id_category=category.id_category))
+            return num
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(
+                lambda num: self.db.write(lambda session: add_team(session, num)), range(8)))
+        self.assertEqual(results, list(range(8)))
+        self.assertEqual(len(threads), 1)
+        self.assertNotIn(threading.get_ident(), threads)
+        with self.db.session_scope() as session:
+            self.assertEqual(session.query(swissturnier.db.Team).count(), 8)
+
     def test_teams(self):
         self._insert_categories()
         self._insert_teams('Mixed', ['Duo A', 'Duo B', 'Duo C', 'Duo D'])
@@ -0,0 +1,125 @@
+import unittest
+import random
+import itertools
+import swissturnier.pairing
+import swissturnier.matching
+
+class TestPairingHistory(unittest.TestCase):
+    def test_has_played(self):
+        history = swissturnier.pairing.PairingHistory([(1, 2), (3, None), (4, 1)])
+        self.assertTrue(history.has_played(1, 2))
+        self.assertTrue(history.has_played(2, 1))
+        self.assertTrue(history.has_played(1, 4))
+        self.assertFalse(history.has_played(2, 4))
+        self.assertFalse(history.has_played(3, None))
+
+    def test_add(self):
+        history = swissturnier.pairing.PairingHistory()
+        self.assertFalse(history.has_played(5, 6))
+        history.add(6, 5)
+        self.assertTrue(history.has_played(5, 6))
+
+    def test_bye_count(self):
+        history = swissturnier.pairing.PairingHistory([(1, None), (2, 3), (1, None)])
+        self.assertEqual(history.bye_count(1), 2)
+        self.assertEqual(history.bye_count(2), 0)
+        history.add(2, None)
+        self.assertEqual(history.bye_count(2), 1)
+
+    def test_pick_bye(self):
+        history = swissturnier.pairing.PairingHistory([(5, None), (4, None)])
+        self.assertEqual(swissturnier.pairing.pick_bye([1, 2, 3, 4, 5], history), 3)
+        history.add(3, None)
+        history.add(2, None)
+        self.assertEqual(swissturnier.pairing.pick_bye([1, 2, 3, 4, 5], history), 1)
+        history.add(1, None)
+        history.add(5, None)
+        self.assertEqual(swissturnier.pairing.pick_bye([1, 2, 3, 4, 5], history), 4)
+
+
+class TestMaxWeightMatching(unittest.TestCase):
+    def _brute_force(self, count, edges):
+        """ Best (cardinality, weight) of all matchings """
+        best = (0, 0)
+        for size in range(1, count // 2 + 1):
+            for subset in itertools.combinations(edges, size):
+                vertices = [v for (i, j, w) in subset for v in (i, j)]
+                if len(set(vertices)) == len(vertices):
+                    best = max(best, (size, sum(w for (i, j, w) in subset)))
+        return best
+
+    def test_triangle(self):
+        mate = swissturnier.matching.max_weight_matching(
+            [(0, 1, 5), (1, 2, 6), (0, 2, 4)])
+        self.assertEqual(mate, [-1, 2, 1])
+
+    def test_blossom(self):
+        # a blossom of 0, 1, 2 with a tail on 1 and 2
+        edges = [(0, 1, 8), (0, 2, 9), (1, 2, 10), (1, 3, 7), (2, 4, 7)]
+        mate = swissturnier.matching.max_weight_matching(edges)
+        self.assertEqual(mate, [2, 3, 0, 1, -1])
+        edges.append((0, 5, 1))
+        mate = swissturnier.matching.max_weight_matching(edges, True)
+        self.assertEqual(mate, [5, 3, 4, 1, 2, 0])
+
+    def test_random_max_cardinality(self):
+        rnd = random.Random(3)
+        for trial in range(200):
+            count = rnd.randint(2, 8)
+            edges = [(i, j, rnd.randint(0, 9))
+                     for i in range(count) for j in range(i + 1, count)
+                     if rnd.random() < 0.6]
+            if not edges:
+                continue
+            mate = swissturnier.matching.max_weight_matching(edges, True)
+            matched = [(i, j, w) for (i, j, w) in edges
+                       if i < len(mate) and mate[i] == j]
+            self.assertEqual(
+                (len(matched), sum(w for (i, j, w) in matched)),
+                self._brute_force(count, edges))
+
+
+class TestPairByMatching(unittest.TestCase):
+    def test_first_round(self):
+        history = swissturnier.pairing.PairingHistory()
+        pairings = swissturnier.pairing.pair_by_matching([4, 3, 2, 1], history)
+        self.assertEqual(pairings, [(4, 3), (2, 1)])
+
+    def test_greedy_dead_end(self):
+        # top down the first team would take 3, leaving 2 and 4 which met
+        history = swissturnier.pairing.PairingHistory([(1, 2), (2, 4)])
+        pairings = swissturnier.pairing.pair_by_matching([1, 2, 3, 4], history)
+        self.assertEqual(pairings, [(1, 4), (2, 3)])
+
+    def test_no_pairing(self):
+        history = swissturnier.pairing.PairingHistory([(1, 2), (1, 3), (1, 4)])
+        with self.assertRaises(swissturnier.pairing.PairingError):
+            swissturnier.pairing.pair_by_matching([1, 2, 3, 4], history)
+
+    def test_window(self):
+        # all near teams already met, the window has to grow
+        teams = list(range(20))
+        history = swissturnier.pairing.PairingHistory(
+            [(0, team) for team in range(1, 19)])
+        pairings = swissturnier.pairing.pair_by_matching(teams, history, window=2)
+        self.assertIn((0, 19), pairings)
+        self.assertEqual(sorted(t for pair in pairings for t in pair), teams)
+
+    def test_rounds(self):
+        rnd = random.Random(7)
+        teams = list(range(1, 61))
+        wins = dict((team, 0) for team in teams)
+        history = swissturnier.pairing.PairingHistory()
+        for play_round in range(6):
+            ranked = sorted(teams, key=lambda team: (-wins[team], team))
+            pairings = swissturnier.pairing.pair_by_matching(ranked, history)
+            self.assertEqual(sorted(t for pair in pairings for t in pair), teams)
+            for id_team_a, id_team_b in pairings:
+                self.assertFalse(history.has_played(id_team_a, id_team_b))
+                self.assertLess(ranked.index(id_team_a), ranked.index(id_team_b))
+                history.add(id_team_a, id_team_b)
+                wins[rnd.choice((id_team_a, id_team_b))] += 1
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+import os
+import tempfile
+import swissturnier.report
+
+class TestTemplateCache(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.TemporaryDirectory()
+        self.cache = swissturnier.report.TemplateCache()
+
+    def tearDown(self):
+        self.path.cleanup()
+
+    def _write(self, name, source, mtime):
+        path = os.path.join(self.path.name, name)
+        with open(path, 'w', encoding='UTF-8') as f:
+            f.write(source)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_compiled_once(self):
+        path = self._write('hello.tmpl', 'Grüezi $name', 1000)
+        template_class = self.cache.get(path)
+        self.assertIs(self.cache.get(path), template_class)
+        self.assertEqual(self.cache.render(path, {'name': 'Duo A'}), 'Grüezi Duo A')
+
+    def test_modified(self):
+        path = self._write('hello.tmpl', 'Hello $name', 1000)
+        template_class = self.cache.get(path)
+        self._write('hello.tmpl', 'Bye $name', 2000)
+        self.assertIsNot(self.cache.get(path), template_class)
+        self.assertEqual(self.cache.render(path, {'name': 'Duo A'}), 'Bye Duo A')
+
+    def test_compile(self):
+        self._write('a.tmpl', '$title', 1000)
+        os.mkdir(os.path.join(self.path.name, 'api'))
+        self._write('api/index.html', '$title', 1000)
+        self._write('notes.txt', 'not a template', 1000)
+        paths = self.cache.compile(self.path.name)
+        self.assertEqual([os.path.relpath(path, self.path.name) for path in paths],
+                         ['a.tmpl', 'api/index.html'])
+
+    def test_reports(self):
+        paths = swissturnier.report.templates.compile('reports/')
+        self.assertIn(os.path.join('reports', 'ranking.tmpl'), paths)
+        self.assertIn(os.path.join('reports', 'api', 'index.html'), paths)
+
+
+class TestOutputCache(unittest.TestCase):
+    def test_lru(self):
+        cache = swissturnier.report.OutputCache(size=2)
+        renders = []
+        def render(key):
+            def render():
+                renders.append(key)
+                return 'output {}'.format(key)
+            return render
+        self.assertEqual(cache.get('a', render('a')), 'output a')
+        self.assertEqual(cache.get('a', render('a')), 'output a')
+        cache.get('b', render('b'))
+        cache.get('a', render('a'))
+        cache.get('c', render('c'))  # evicts b, used least recently
+        cache.get('a', render('a'))
+        cache.get('b', render('b'))
+        self.assertEqual(renders, ['a', 'b', 'c', 'b'])
+        self.assertEqual(len(cache), 2)
+
+    def test_invalidate(self):
+        cache = swissturnier.report.OutputCache()
+        cache.get('a', lambda: 'old')
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.get('a', lambda: 'new'), 'new')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+import datetime
+import swissturnier.db
+import swissturnier.schedule
+
+class TestScheduler(unittest.TestCase):
+    START = datetime.datetime(2020, 2, 15, 17, 45)
+
+    def _scheduler(self, courts):
+        return swissturnier.schedule.Scheduler(swissturnier.db.PlaySettings(
+            start_time=self.START.isoformat(),
+            play_time=480,
+            rotation_time=60,
+            pause_time=600,
+            courts=courts,
+        ))
+
+    def test_first_round(self):
+        slots = self._scheduler(2).round_slots(5)
+        minutes = datetime.timedelta(minutes=1)
+        self.assertEqual(slots, [
+            (self.START, 'A'),
+            (self.START, 'B'),
+            (self.START + 9 * minutes, 'A'),
+            (self.START + 9 * minutes, 'B'),
+            (self.START + 18 * minutes, 'A'),
+        ])
+
+    def test_next_round(self):
+        scheduler = self._scheduler(4)
+        last_start_time = self.START + datetime.timedelta(minutes=30)
+        slots = scheduler.round_slots(6, last_start_time)
+        round_start = self.START + datetime.timedelta(minutes=49)
+        self.assertEqual(slots[0], (round_start, 'A'))
+        self.assertEqual(slots[3], (round_start, 'D'))
+        self.assertEqual(slots[5], (round_start + datetime.timedelta(minutes=9), 'B'))
+
+    def test_timeline(self):
+        timeline = swissturnier.schedule.CourtTimeline(3, 0, 10)
+        self.assertEqual(timeline.slot_table(4), [(0, 'A'), (0, 'B'), (0, 'C'), (10, 'A')])
+        self.assertEqual(timeline.end_time, 20)
+        self.assertEqual(timeline.assign(), (10, 'B'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import unittest
+import random
+import swissturnier.standings
+
+class TestStandings(unittest.TestCase):
+    PLAYS = [
+        (1, 2, 21, 15),
+        (3, 4, 18, 18),
+        (5, None, 15, None),
+        (1, 3, 10, 21),
+        (2, 4, 21, None),  # not complete yet
+        (5, 2, None, None),
+    ]
+
+    def test_accumulate(self):
+        totals = swissturnier.standings.accumulate(self.PLAYS)
+        self.assertEqual(totals, {
+            1: [1.0, 31],
+            2: [0.0, 15],
+            3: [1.5, 39],
+            4: [0.5, 18],
+            5: [1.0, 15],
+        })
+
+    def test_order(self):
+        totals = swissturnier.standings.accumulate(self.PLAYS)
+        rankings = [(10 + id_team, id_team) for id_team in range(1, 7)]
+        ordered = swissturnier.standings.order(rankings, totals, {})
+        self.assertEqual([row[1] for row in ordered], [3, 1, 5, 4, 2, 6])
+
+    def test_order_tiebreaks(self):
+        plays = [
+            (1, 2, 21, 15),
+            (3, 4, 21, 15),
+            (2, 4, 21, 15),
+            (1, 3, 10, 21),
+        ]
+        # team 1 and team 2 with the same wins and points
+        totals = {1: [1.0, 31], 2: [1.0, 31], 3: [2.0, 42], 4: [0.0, 30]}
+        rankings = [(10 + id_team, id_team) for id_team in range(1, 5)]
+        tiebreaks = swissturnier.standings.TieBreaks(plays)
+        self.assertEqual(tiebreaks.values(1), (3.0, 0.0, 1.0))
+        self.assertEqual(tiebreaks.values(2), (1.0, 0.0, 0.0))
+        ordered = swissturnier.standings.order(
+            rankings, totals, tiebreaks.table(range(1, 5)))
+        self.assertEqual([row[1] for row in ordered], [3, 1, 2, 4])
+        self.assertEqual(ordered[1][4:], (3.0, 0.0, 1.0))
+
+    def test_median_buchholz(self):
+        plays = [(1, 2, 21, 0), (1, 3, 21, 0), (1, 4, 21, 0), (3, 4, 21, 0),
+                 (2, 5, 15, 15), (2, 6, 21, 0), (3, 6, 21, 0)]
+        tiebreaks = swissturnier.standings.TieBreaks(plays)
+        # opponents of team 1 have 1.5, 2.0 and 0.0 wins
+        self.assertEqual(tiebreaks.values(1), (3.5, 1.5, 0.0 + 3.5))
+
+    def test_tiebreaks_update_play(self):
+        rnd = random.Random(8)
+        for trial in range(50):
+            plays = [[
+                    rnd.randint(1, 8),
+                    rnd.choice([None] + list(range(1, 9))),
+                    None,
+                    None,
+                ] for num in range(20)]
+            plays = [play for play in plays if play[0] != play[1]]
+            tiebreaks = swissturnier.standings.TieBreaks()
+            for trial in range(60):
+                play = rnd.choice(plays)
+                old_points = tuple(play[2:])
+                play[2:] = [rnd.choice([None, 0, 9, 15, 21]),
+                            rnd.choice([None, 0, 9, 15, 21])]
+                changed = tiebreaks.update_play(
+                    play[0], play[1], old_points, tuple(play[2:]))
+                expected = swissturnier.standings.TieBreaks(plays)
+                for id_team in range(1, 9):
+                    self.assertEqual(tiebreaks.wins(id_team), expected.wins(id_team))
+                    self.assertEqual(tiebreaks.values(id_team), expected.values(id_team))
+                self.assertIn(play[0], changed)
+
+    def test_play_totals(self):
+        play_totals = swissturnier.standings.play_totals
+        self.assertEqual(play_totals(2, 21, 15), ((1.0, 21), (0.0, 15)))
+        self.assertEqual(play_totals(None, 15, None), ((1.0, 15), (0.0, 0)))
+        self.assertEqual(play_totals(2, 21, None), ((0.0, 0), (0.0, 0)))
+
+    @unittest.skipIf(swissturnier.standings.numpy is None, "Requires numpy library")
+    def test_arrays(self):
+        rnd = random.Random(5)
+        rankings = [(100 + id_team, id_team) for id_team in range(1, 13)]
+        for trial in range(100):
+            plays = [(
+                    rnd.randint(1, 12),
+                    rnd.choice([None] + list(range(1, 13))),
+                    rnd.choice([None, 0, 9, 15, 21]),
+                    rnd.choice([None, 0, 9, 15, 21]),
+                ) for num in range(rnd.randint(0, 20))]
+            totals = swissturnier.standings.accumulate(plays)
+            tiebreaks = swissturnier.standings.TieBreaks(plays).table(range(1, 13))
+            self.assertEqual(swissturnier.standings.accumulate_arrays(plays), totals)
+            self.assertEqual(
+                swissturnier.standings.order_arrays(rankings, totals, tiebreaks),
+                swissturnier.standings.order(rankings, totals, tiebreaks))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+import unittest
+import swissturnier.db
+import swissturnier.ranking
+import swissturnier.state
+import helpers
+from swissturnier.db import Team, PlayRound, Rankings
+
+class TestTurnierState(unittest.TestCase):
+    def setUp(self):
+        self.db = swissturnier.db.DB(config={'schema': 'sqlite', 'database': ''})
+        self.db.createdb()
+        helpers.load_testdata(self.db)
+        self.state = swissturnier.state.TurnierState(self.db, check_interval=None)
+        self.turnier = swissturnier.ranking.Turnier(self.db, self.state)
+
+    def tearDown(self):
+        self.db.close()
+
+    def _values(self, model, rows):
+        names = [column.name for column in model.__table__.columns]
+        return [[getattr(row, name) for name in names] for row in rows]
+
+    def _assert_same_as_db(self):
+        with self.db.session_scope() as session:
+            self.assertEqual(self.state.current_round(),
+                             swissturnier.db.query_current_round(session))
+            teams = session.query(Team).order_by(Team.id_team).all()
+            self.assertEqual([(team.id_team, team.name, team.category.name) for team in teams],
+                             [(team.id_team, team.name, team.category.name)
+                              for team in self.state.teams()])
+            plays = session.query(PlayRound).order_by(
+                PlayRound.round_number, PlayRound.id_playround).all()
+            self.assertEqual(self._values(PlayRound, plays),
+                             self._values(PlayRound, self.state.plays()))
+            ranks = session.query(Rankings).order_by(Rankings.rank, Rankings.id_rank).all()
+            self.assertEqual(self._values(Rankings, ranks),
+                             self._values(Rankings, self.state.rankings()))
+
+    def test_load(self):
+        self.assertEqual(self.state.version, 0)
+        self.assertEqual(helpers.count_statements(self.db, self.state.teams), 5)
+        self.assertEqual(self.state.version, 1)
+        self.assertEqual(helpers.count_statements(self.db, self.state.plays, 2), 0)
+        self.assertEqual(len(self.state.teams('Mixed')),
+                         len([team for team in self.state.teams()
+                              if team.category.name == 'Mixed']))
+        self.assertIsNone(self.state.team(999))
+        play = self.state.play(32)
+        self.assertEqual(play.team_a.id_team, 24)
+        self.assertIsNone(play.team_b)
+        self._assert_same_as_db()
+
+    def test_turnier_writes(self):
+        self.state.reload()
+        self.turnier.init_rankings()
+        self.assertEqual(self.state.version, 2)
+        self._assert_same_as_db()
+        self.turnier.next_round()
+        self.assertEqual(self.state.current_round(), 3)
+        self._assert_same_as_db()
+
+    def test_update_after_commit(self):
+        self.turnier.init_rankings()
+        self.turnier.rank()
+        version = self.state.version
+        with self.db.session_scope() as session:
+            play = session.query(PlayRound).get(17)
+            ranks = self.turnier.update_play_result(session, play, 3, 21)
+            self.state.update_after_commit(
+                session,
+                [swissturnier.state.values(play)],
+                [swissturnier.state.values(rank) for rank in ranks])
+            self.assertEqual(self.state.version, version)
+        self.assertEqual(self.state.version, version + 1)
+        self.assertEqual(self.state.play(17).points_a, 3)
+        self._assert_same_as_db()
+
+    def test_rollback(self):
+        self.state.reload()
+        with self.assertRaises(RuntimeError):
+            with self.db.session_scope() as session:
+                play = session.query(PlayRound).get(17)
+                play.points_a = 3
+                self.state.update_after_commit(session, [swissturnier.state.values(play)])
+                raise RuntimeError()
+        self.assertEqual(self.state.version, 1)
+        self._assert_same_as_db()
+
+    def test_reload(self):
+        self.state.reload()
+        with self.db.engine.begin() as connection:
+            connection.execute("UPDATE team SET name = 'Renamed' WHERE id_team = 5")
+        self.assertNotEqual(self.state.team(5).name, 'Renamed')
+        self.state.reload()
+        self.assertEqual(self.state.team(5).name, 'Renamed')
+        self.assertEqual(self.state.play(3).team_a.name, 'Renamed')
+
+    def test_external_changes(self):
+        state = swissturnier.state.TurnierState(self.db, check_interval=0)
+        state.reload()
+        version = state.version
+        # unchanged, only the change counter is queried
+        self.assertEqual(helpers.count_statements(self.db, state.plays), 1)
+        self.assertEqual(state.version, version)
+
+        # another process starts the next round
+        turnier = swissturnier.ranking.Turnier(self.db)
+        turnier.init_rankings()
+        turnier.next_round()
+        self.assertEqual(state.current_round(), 3)
+        self.assertEqual(len(state.plays(3)), 16)
+        self.assertEqual(state.version, version + 1)
+
+        # the own writes need no reload
+        with self.db.session_scope() as session:
+            play = session.query(PlayRound).get(33)
+            ranks = state.turnier.update_play_result(session, play, 3, 21)
+            state.update_after_commit(
+                session,
+                [swissturnier.state.values(play)],
+                [swissturnier.state.values(rank) for rank in ranks])
+        self.assertEqual(helpers.count_statements(self.db, state.plays), 1)
+        self.assertEqual(state.play(33).points_a, 3)
+        self.assertIsNotNone(state.turnier._tiebreaks)
+
+        # unless another write came in between
+        turnier.rank()
+        with self.db.session_scope() as session:
+            play = session.query(PlayRound).get(34)
+            play.points_a, play.points_b = 21, 4
+            state.update_after_commit(session, [swissturnier.state.values(play)])
+        self.assertEqual(helpers.count_statements(self.db, state.plays), 5)
+        self.assertIsNone(state.turnier._tiebreaks)
+        self.state = state
+        self._assert_same_as_db()
+
+    def test_subscribe(self):
+        self.turnier.init_rankings()
+        self.turnier.rank()
+        changes = []
+        self.state.subscribe(changes.append)
+        before = dict((rank.id_team, rank.rank) for rank in self.state.rankings())
+        with self.db.session_scope() as session:
+            play = session.query(PlayRound).get(17)
+            ranks = [swissturnier.state.values(rank)
+                     for rank in self.turnier.update_play_result(session, play, 3, 21)]
+            self.state.update_after_commit(session, [swissturnier.state.values(play)], ranks)
+        self.assertEqual(len(changes), 1)
+        change = changes[0]
+        self.assertEqual(change.version, self.state.version)
+        self.assertEqual(change.current_round, 2)
+        self.assertEqual([(play['id_playround'], play['points_a']) for play in change.plays],
+                         [(17, 3)])
+        # only the rankings that differ, not all those updated
+        moved = [rank['id_team'] for rank in ranks if rank['rank'] != before[rank['id_team']]]
+        published = [rank['id_team'] for rank in change.rankings]
+        self.assertLess(len(published), len(ranks))
+        self.assertLessEqual(set(moved), set(published))
+        for rank in change.rankings:
+            self.assertIn(rank, ranks)
+
+        # reloads publish only what differs
+        self.state.reload()
+        self.assertEqual(len(changes), 1)
+        self.turnier.next_round()
+        change = changes[-1]
+        self.assertEqual(change.current_round, 3)
+        self.assertEqual(sorted(play['round_number'] for play in change.plays), 16 * [3])
+
+        self.state.unsubscribe(changes.append)
+        self.state.reload()
+        self.turnier.rank(1)
+        self.assertEqual(changes[-1], change)
+
+    def test_failing_subscriber(self):
+        def fail(change):
+            raise RuntimeError()
+        self.state.subscribe(fail)
+        self.turnier.init_rankings()
+        self.turnier.rank()
+        self.assertEqual(self.state._subscribers, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,17 @@
 import unittest
+import datetime
+import random
+import io
 import swissturnier.db
 import swissturnier.ranking
+import swissturnier.report
 import sqlalchemy
+import helpers
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class TestDB(unittest.TestCase):
     def setUp(self):
@@ -38,6 +48,105 @@ class TestDB(unittest.TestCase):
             rcount = session.query(swissturnier.db.Rankings).count()
             self.assertEqual(rcount, len(teams))
 
+    def test_turnier_rank_statements(self):
+        teams = ['Team {}'.format(n) for n in range(20)]
+        self._insert_teams('Mixed', teams)
+        turnier = swissturnier.ranking.Turnier(self.db)
+        turnier.init_rankings()
+        turnier.next_round()
+        with self.db.session_scope() as session:
+            for play in session.query(swissturnier.db.PlayRound).all():
+                play.points_a = 21
+                play.points_b = play.id_playround
+        turnier.next_round()
+        with self.db.session_scope() as session:
+            play = session.query(swissturnier.db.PlayRound).filter_by(round_number=2).first()
+            play.points_a = 10  # B still missing, not counted yet
+        few = helpers.count_statements(self.db, turnier.rank)
+
+        with self.db.session_scope() as session:
+            for play in session.query(swissturnier.db.PlayRound).filter_by(round_number=2).all():
+                play.points_a = 21
+                play.points_b = 1
+        more = helpers.count_statements(self.db, turnier.rank)
+        self.assertEqual(few, more)
+
+        ranktable = self._get_ranktable()
+        self.assertEqual(len(ranktable), len(teams))
+        self.assertEqual([rank[0] for rank in ranktable], list(range(1, len(teams) + 1)))
+        self.assertEqual(ranktable[-1][2:], (0, 2))
+
+    def test_turnier_round_statements(self):
+        turnier = swissturnier.ranking.Turnier(self.db)
+        counts = []
+        # both fields have a bye, 7 and 27 teams
+        for category, size in [('Mixed', 7), ('Female', 20)]:
+            self._insert_teams(category, ['{} {}'.format(category, n) for n in range(size)])
+            counts.append(helpers.count_statements(self.db, turnier.init_rankings))
+            counts.append(helpers.count_statements(self.db, turnier.generate_round_playplan))
+            with self.db.session_scope() as session:
+                session.query(swissturnier.db.PlayRound).delete()
+        self.assertEqual(counts[0:2], counts[2:4])
+        playtable = self._get_playtable()
+        self.assertEqual(len(playtable), 0)
+        turnier.generate_round_playplan()
+        playtable = self._get_playtable()
+        self.assertEqual(len(playtable), 14)
+        self.assertEqual(playtable[-1][1:3], ('bye', turnier.BYE_PLAY_POINTS))
+
+    def test_turnier_round_schedule(self):
+        self._insert_teams('Mixed', ['Team {}'.format(n) for n in range(10)])
+        turnier = swissturnier.ranking.Turnier(self.db)
+        turnier.init_rankings()
+        turnier.next_round()
+        with self.db.session_scope() as session:
+            plays = session.query(swissturnier.db.PlayRound).all()
+            for play in plays:
+                play.points_a, play.points_b = 21, play.id_playround
+            # the last play of the round was moved back by a quarter hour
+            plays[-1].start_time += datetime.timedelta(minutes=15)
+            last_start_time = plays[-1].start_time
+        turnier.next_round()
+        with self.db.session_scope() as session:
+            plays = (session.query(swissturnier.db.PlayRound)
+                .filter_by(round_number=2)
+                .order_by('id_playround')
+                .all())
+            settings = self.db.config.play_settings
+            round_start = (last_start_time + settings.play_time
+                + settings.rotation_time + settings.pause_time)
+            self.assertEqual([play.start_time for play in plays[:settings.courts]],
+                             settings.courts * [round_start])
+            self.assertEqual([play.court for play in plays],
+                             [chr(ord('A') + n % settings.courts) for n in range(5)])
+
+    def test_turnier_missing_plays(self):
+        self._insert_teams('Mixed', ['Team {}'.format(n) for n in range(5)])
+        turnier = swissturnier.ranking.Turnier(self.db)
+        turnier.init_rankings()
+        turnier.next_round()
+        self.assertFalse(turnier.check_complete())
+        self.assertEqual(len(turnier.missing_plays()), 2)
+        with self.db.session_scope() as session:
+            plays = session.query(swissturnier.db.PlayRound).order_by('id_playround').all()
+            for play in plays:
+                if play.id_team_b is not None:
+                    play.points_a, play.points_b = 21, 15
+            # only A entered yet
+            plays[1].points_b = None
+            missing = [(plays[1].id_playround, 1, plays[1].id_team_a, plays[1].id_team_b)]
+        self.assertEqual(turnier.missing_plays(), missing)
+        self.assertEqual(helpers.count_statements(self.db, turnier.missing_plays, to_round=1), 1)
+
+        with self.db.session_scope() as session:
+            play = session.query(swissturnier.db.PlayRound).get(missing[0][0])
+            play.points_b = 18
+        self.assertTrue(turnier.check_complete())
+        turnier.next_round()
+        self.assertTrue(turnier.check_complete(to_round=1))
+        self.assertFalse(turnier.check_complete())
+        self.assertEqual(set(play[1] for play in turnier.missing_plays()), set([2]))
+
     def _get_playtable(self):
         with self.db.session_scope() as session:
             plays = session.query(swissturnier.db.PlayRound).all()
@@ -91,6 +200,73 @@ class TestDB(unittest.TestCase):
                 rank.rank, rank.team.name, rank.wins, rank.points
                 ) for rank in ranks]
 
+    def _get_tiebreaktable(self):
+        with self.db.session_scope() as session:
+            ranks = session.query(swissturnier.db.Rankings).order_by('rank').all()
+            return [(
+                rank.team.name, rank.buchholz, rank.median_buchholz,
+                rank.sonneborn_berger
+                ) for rank in ranks]
+
+    def _get_historytable(self, round_number):
+        with self.db.session_scope() as session:
+            ranks = swissturnier.db.query_round_rankings(session, round_number)
+            return [(
+                rank.rank, rank.team.name, rank.wins, rank.points
+                ) for rank in ranks]
+
+    def test_turnier_rankings_history(self):
+        self._insert_teams('Mixed', ['Team {}'.format(n) for n in range(8)])
+        turnier = swissturnier.ranking.Turnier(self.db)
+        turnier.init_rankings()
+        turnier.next_round()
+
+        def enter_results(round_number, results):
+            with self.db.session_scope() as session:
+                plays = (session.query(swissturnier.db.PlayRound)
+                    .filter_by(round_number=round_number)
+                    .order_by('id_playround')
+                    .all())
+                for play, (points_a, points_b) in zip(plays, results):
+                    turnier.update_play_result(session, play, points_a, points_b)
+
+        # no snapshot as long as the round is incomplete
+        enter_results(1, [(21, 15), (12, 12), (5, 21), (18, None)])
+        turnier.rank()
+        self.assertEqual(self._get_historytable(1), [])
+        enter_results(1, [(21, 15), (12, 12), (5, 21), (18, 19)])
+        after_first = self._get_ranktable()
+        self.assertEqual(self._get_historytable(1), after_first)
+
+        turnier.next_round()
+        enter_results(2, [(21, 10), (21, 11), (21, 12), (21, 13)])
+        after_second = self._get_ranktable()
+        self.assertEqual(self._get_historytable(2), after_second)
+        self.assertEqual(self._get_historytable(1), after_first)
+
+        # a corrected result updates the snapshots from its round on
+        enter_results(1, [(15, 21)])
+        after_first = self._get_historytable(1)
+        self.assertEqual(self._get_historytable(2), self._get_ranktable())
+        self.assertNotEqual(self._get_historytable(2), after_second)
+        turnier.rank(1)
+        self.assertEqual(self._get_ranktable(), after_first)
+        turnier.rank()
+
+        # as well with the results of a whole round at once
+        with self.db.session_scope() as session:
+            turnier.update_round_results(session, 1, [(1, 21, 3)])
+        after_first = self._get_historytable(1)
+        turnier.rank(1)
+        self.assertEqual(self._get_ranktable(), after_first)
+        turnier.rank()
+
+        output = io.StringIO()
+        report = swissturnier.report.ConsoleRankingTableReport(self.db)
+        report.round_number = 2
+        report.print(output)
+        self.assertIn('Current round: 2\nRanks: 8\n', output.getvalue())
+
     def test_turnier_ranktable(self):
         teams = ['Duo A', 'Duo B', 'Duo C', 'Duo D']
         self._insert_teams('Mixed', teams)
@@ -115,6 +291,206 @@ class TestDB(unittest.TestCase):
             (4, 'Duo A', 0, 5),
         ])
 
+    def test_turnier_update_play_result(self):
+        teams = ['Team {}'.format(n) for n in range(8)]
+        self._insert_teams('Female', teams)
+        turnier = swissturnier.ranking.Turnier(self.db)
+        turnier.init_rankings()
+        turnier.next_round()
+
+        def enter_results(results):
+            with self.db.session_scope() as session:
+                plays = (session.query(swissturnier.db.PlayRound)
+                    .order_by('id_playround')
+                    .all())
+                for (id_playround, points_a, points_b) in results:
+                    play = plays[id_playround - 1]
+                    turnier.update_play_result(session, play, points_a, points_b)
+
+        # first result without a ranking calculated falls back to rank()
+        enter_results([(1, 21, 15), (2, 12, 12), (3, 5, 21), (4, 18, None)])
+        incremental = self._get_ranktable()
+        turnier.rank()
+        self.assertEqual(incremental, self._get_ranktable())
+
+        # corrections and the completed play move teams up and down
+        enter_results([(4, 18, 19), (1, 10, 21), (2, 30, 12), (4, 25, 19)])
+        incremental = self._get_ranktable()
+        turnier.rank()
+        self.assertEqual(incremental, self._get_ranktable())
+
+        turnier.next_round()
+        enter_results([(5, 15, 21), (6, 21, 3), (7, 9, 9), (8, 21, 20)])
+        incremental = self._get_ranktable()
+        tiebreaks = self._get_tiebreaktable()
+        turnier.rank()
+        self.assertEqual(incremental, self._get_ranktable())
+        self.assertEqual(tiebreaks, self._get_tiebreaktable())
+
+        # a changed result of the first round moves the opponents' tie-breakers
+        enter_results([(1, 21, 10), (2, 12, 30), (3, 21, 5)])
+        incremental = self._get_ranktable()
+        tiebreaks = self._get_tiebreaktable()
+        # a new Turnier has no cached tie-breakers and loads them once
+        swissturnier.ranking.Turnier(self.db).rank()
+        self.assertEqual(incremental, self._get_ranktable())
+        self.assertEqual(tiebreaks, self._get_tiebreaktable())
+
+    def test_turnier_update_play_result_bye(self):
+        self._insert_teams('Mixed', ['Team {}'.format(n) for n in range(5)])
+        turnier = swissturnier.ranking.Turnier(self.db)
+        turnier.init_rankings()
+        turnier.next_round()
+        with self.db.session_scope() as session:
+            for play in session.query(swissturnier.db.PlayRound).filter(
+                    swissturnier.db.PlayRound.id_team_b != None):
+                play.points_a, play.points_b = 21, 10 + play.id_playround
+        turnier.next_round()
+
+        # the bye of round 2 is part of the incremental rankings
+        with self.db.session_scope() as session:
+            plays = (session.query(swissturnier.db.PlayRound)
+                .filter_by(round_number=2)
+                .filter(swissturnier.db.PlayRound.id_team_b != None)
+                .order_by('id_playround')
+                .all())
+            for play in plays:
+                turnier.update_play_result(session, play, 12, 21)
+        incremental = self._get_ranktable()
+        tiebreaks = self._get_tiebreaktable()
+        history = self._get_historytable(2)
+        turnier.rank()
+        self.assertEqual(incremental, self._get_ranktable())
+        self.assertEqual(tiebreaks, self._get_tiebreaktable())
+        self.assertEqual(history, self._get_historytable(2))
+
+    def test_turnier_update_play_result_two_processes(self):
+        self._insert_teams('Mixed', ['Team {}'.format(n) for n in range(8)])
+        first = swissturnier.ranking.Turnier(self.db)
+        first.init_rankings()
+        first.next_round()
+        with self.db.session_scope() as session:
+            for play in session.query(swissturnier.db.PlayRound):
+                play.points_a, play.points_b = 21, 10 + play.id_playround
+        first.next_round()
+        second = swissturnier.ranking.Turnier(self.db)
+
+        def enter_result(turnier, id_playround, points_a, points_b):
+            with self.db.session_scope() as session:
+                play = session.query(swissturnier.db.PlayRound).get(id_playround)
+                turnier.update_play_result(session, play, points_a, points_b)
+
+        # the second one changes the wins of opponents behind the first one's back
+        enter_result(first, 5, 21, 3)
+        enter_result(second, 6, 21, 3)
+        enter_result(first, 7, 3, 21)
+        enter_result(first, 8, 3, 21)
+        incremental = self._get_ranktable()
+        tiebreaks = self._get_tiebreaktable()
+        swissturnier.ranking.Turnier(self.db).rank()
+        self.assertEqual(incremental, self._get_ranktable())
+        self.assertEqual(tiebreaks, self._get_tiebreaktable())
+
+    def test_turnier_no_rematch(self):
+        teams = ['Team {}'.format(n) for n in range(12)]
+        self._insert_teams('Male', teams)
+        turnier = swissturnier.ranking.Turnier(self.db)
+        turnier.init_rankings()
+        for play_round in range(1, 4):
+            turnier.next_round()
+            with self.db.session_scope() as session:
+                plays = (session.query(swissturnier.db.PlayRound)
+                    .filter_by(round_number=play_round)
+                    .all())
+                for play in plays:
+                    play.points_a = (play.id_team_a * 7) % 22
+                    play.points_b = (play.id_team_b * 5) % 21
+
+        playtable = self._get_playtable()
+        self.assertEqual(len(playtable), 3 * len(teams) // 2)
+        pairings = set(frozenset(play[:2]) for play in playtable)
+        self.assertEqual(len(pairings), len(playtable))
+
+    def test_turnier_matching_pairing(self):
+        self.db.config['play_settings'] = dict(
+            self.db.config['play_settings'], pairing='matching')
+        teams = ['Team {}'.format(n) for n in range(10)]
+        self._insert_teams('Male', teams)
+        turnier = swissturnier.ranking.Turnier(self.db)
+        turnier.init_rankings()
+        for play_round in range(1, 6):
+            turnier.next_round()
+            with self.db.session_scope() as session:
+                plays = (session.query(swissturnier.db.PlayRound)
+                    .filter_by(round_number=play_round)
+                    .all())
+                for play in plays:
+                    play.points_a = (play.id_team_a * 7) % 22
+                    play.points_b = (play.id_team_b * 5) % 21
+
+        playtable = self._get_playtable()
+        self.assertEqual(len(playtable), 5 * len(teams) // 2)
+        pairings = set(frozenset(play[:2]) for play in playtable)
+        self.assertEqual(len(pairings), len(playtable))
+
+    def test_turnier_by_category(self):
+        self.db.config['play_settings'] = dict(
+            self.db.config['play_settings'], by_category=True, workers=2,
+            pairing='matching')
+        self._insert_teams('Mixed', ['Mixed {}'.format(n) for n in range(6)])
+        self._insert_teams('Female', ['Female {}'.format(n) for n in range(4)])
+        turnier = swissturnier.ranking.Turnier(self.db)
+        # the process pool even for the small fields
+        turnier.POOL_MIN_TEAMS = 0
+        turnier.init_rankings()
+        for play_round in range(1, 4):
+            turnier.next_round()
+            with self.db.session_scope() as session:
+                plays = (session.query(swissturnier.db.PlayRound)
+                    .filter_by(round_number=play_round)
+                    .filter(swissturnier.db.PlayRound.id_team_b != None)
+                    .all())
+                self.assertEqual(len(plays), 3 + 2)
+                self.assertEqual(
+                    [play.team_a.category.name for play in plays],
+                    ['Mixed', 'Female', 'Mixed', 'Female', 'Mixed'])
+                for play in plays:
+                    self.assertEqual(play.team_a.id_category, play.team_b.id_category)
+                    turnier.update_play_result(session, play,
+                        (play.id_team_a * 7) % 22, (play.id_team_b * 5) % 21)
+        incremental = self._get_ranktable()
+        turnier.rank()
+        ranktable = self._get_ranktable()
+        self.assertEqual(incremental, ranktable)
+
+        with self.db.session_scope() as session:
+            ranks = session.query(swissturnier.db.Rankings).all()
+            categories = {}
+            for rank in ranks:
+                categories.setdefault(rank.team.category.name, []).append(rank.rank)
+            self.assertEqual(sorted(categories['Mixed']), list(range(1, 7)))
+            self.assertEqual(sorted(categories['Female']), list(range(1, 5)))
+
+    def test_turnier_process_pool(self):
+        settings = dict(self.db.config['play_settings'], by_category=True)
+        settings.pop('workers', None)
+        self.db.config['play_settings'] = settings
+        turnier = swissturnier.ranking.Turnier(self.db)
+        # by default all in this process
+        pools = dict(swissturnier.ranking._pools)
+        self.assertEqual(turnier._map_partitions(sum, [[1, 2], [3]]), [3, 3])
+        self.assertEqual(swissturnier.ranking._pools, pools)
+
+        # with workers only for big fields, in the same pool each time
+        self.db.config['play_settings']['workers'] = 2
+        turnier.POOL_MIN_TEAMS = 4
+        self.assertEqual(turnier._map_partitions(sum, [[1, 2], [3]]), [3, 3])
+        self.assertEqual(swissturnier.ranking._pools, pools)
+        self.assertEqual(turnier._map_partitions(sum, [[1, 2], [3, 4]]), [3, 7])
+        pool = swissturnier.ranking._pools[2]
+        self.assertEqual(turnier._map_partitions(sum, [[5, 6], [7, 8]]), [11, 15])
+        self.assertIs(swissturnier.ranking._pools[2], pool)
+
     def test_turnier4(self):
         teams = ['Duo A', 'Duo B', 'Duo C', 'Duo D']
         self._insert_teams('Mixed', teams)
@@ -220,11 +596,12 @@ class TestDB(unittest.TestCase):
 
         turnier.next_round()
 
+        # the bye of the new round is ranked already
         ranktable = self._get_ranktable()
         self.assertEqual(ranktable, [
-            (1, 'Team A', 1, 20),
-            (2, 'Team C', 1, BYE_PLAY_POINTS),
-            (3, 'Team B', 0, 11),
+            (1, 'Team B', 1, 11 + BYE_PLAY_POINTS),
+            (2, 'Team A', 1, 20),
+            (3, 'Team C', 1, BYE_PLAY_POINTS),
         ])
 
         playtable = self._get_playtable()
@@ -255,3 +632,55 @@ class TestDB(unittest.TestCase):
             (2, 'Team A', 1, 37),
             (3, 'Team B', 1, 11 + BYE_PLAY_POINTS),
         ])
+
+
+    def test_turnier_sql_ranking(self):
+        self.db.config['play_settings'] = dict(
+            self.db.config['play_settings'], by_category=True, workers=1,
+            pairing='matching')
+        self._insert_teams('Mixed', ['Mixed {}'.format(n) for n in range(9)])
+        self._insert_teams('Female', ['Female {}'.format(n) for n in range(6)])
+        turnier = swissturnier.ranking.Turnier(self.db)
+        turnier.init_rankings()
+        rnd = random.Random(13)
+        for play_round in range(1, 5):
+            turnier.next_round()
+            with self.db.session_scope() as session:
+                plays = (session.query(swissturnier.db.PlayRound)
+                    .filter_by(round_number=play_round)
+                    .all())
+                for play in plays:
+                    if play.id_team_b is not None:
+                        play.points_a = rnd.choice([15, 18, 21])
+                        play.points_b = rnd.choice([15, 18, 21])
+                # one result still missing
+                plays[0].points_b = None
+            for to_round in [None, play_round - 1]:
+                self._set_ranking_backend('python')
+                turnier.rank(to_round)
+                expected = (self._get_ranktable(), self._get_tiebreaktable())
+                self._set_ranking_backend('sql')
+                turnier.rank(to_round)
+                self.assertEqual(expected, (self._get_ranktable(), self._get_tiebreaktable()))
+        # current round, change counter, ranking and the snapshot of the round
+        self.assertEqual(helpers.count_statements(self.db, turnier.rank), 6)
+
+    def _set_ranking_backend(self, name):
+        self.db.config['play_settings'] = dict(
+            self.db.config['play_settings'], ranking_backend=name)
+
+
+@unittest.skipIf(numpy is None, "Requires numpy library")
+class TestNumpyRanking(TestDB):
+    """ Same turniers with the NumPy ranking backend """
+    def _setupdb(self):
+        super(TestNumpyRanking, self)._setupdb()
+        self.db.config['play_settings'] = dict(
+            self.db.config['play_settings'], ranking_backend='numpy')
+
+
+class TestSQLRanking(TestDB):
+    """ Same turniers with the ranking in the DB """
+    def _setupdb(self):
+        super(TestSQLRanking, self)._setupdb()
+        self._set_ranking_backend('sql')